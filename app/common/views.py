@@ -1,5 +1,8 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from starlette.responses import PlainTextResponse
 
+from cores import metrics
+from cores.config import settings
 from cores.response import ResponseModel
 
 common_router = APIRouter()
@@ -12,3 +15,10 @@ common_router = APIRouter()
 )
 async def healthy():
     return ResponseModel()
+
+
+@common_router.get("/metrics", summary="Prometheus 指标", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    if not settings.metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics disabled")
+    return PlainTextResponse(await metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,223 @@
+"""
+大批量短信上传（POST /mas/bulk）
+
+请求体为 NDJSON，每行一条短信，边接收边解析，按 bulk_chunk_size 条一批去重入队，内存占用与上传大小无关：
+    {"phone_number": "13800000001", "message": "内容", "priority": "bulk"}
+    "13800000002"                       # 只有手机号时使用查询参数中的 message
+任务进度（已解析行数、入队、重复、无效条数）存于 hash sms_bulk_job:{job_id}，上传过程中即可查询
+"""
+
+import asyncio
+import re
+import time
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional
+
+import orjson
+
+from cores.config import settings
+from cores.redis import ASYNC_REDIS
+
+BULK_JOB_KEY = "sms_bulk_job:{job_id}"
+MAX_LINE_BYTES = 64 * 1024  # 单行最大字节数，超过时整行记为无效，不再缓存
+MAX_ERRORS = 20  # 任务中保留的无效行明细条数
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+async def iter_lines(
+    chunks: AsyncIterator[bytes], max_line: int = MAX_LINE_BYTES
+) -> AsyncIterator[Optional[bytes]]:
+    """
+    将上传流按行切分，只缓存当前未结束的一行；超过 max_line 的行返回 None
+    >>> import asyncio
+    >>> async def stream(*chunks):
+    ...     for chunk in chunks:
+    ...         yield chunk
+    >>> async def collect(*chunks, max_line=MAX_LINE_BYTES):
+    ...     return [line async for line in iter_lines(stream(*chunks), max_line)]
+    >>> asyncio.run(collect(b'{"a": 1}\\n{"b"', b': 2}\\r\\n\\n3'))
+    [b'{"a": 1}', b'{"b": 2}', b'', b'3']
+    >>> asyncio.run(collect(b'12', b'3456\\n78\\n', b'9' * 10, max_line=4))
+    [None, b'78', None]
+    """
+    buffer, skipping = bytearray(), False
+    async for chunk in chunks:
+        start = 0
+        while (end := chunk.find(b"\n", start)) >= 0:
+            if skipping or len(buffer) + end - start > max_line:
+                skipping = False
+                buffer.clear()
+                yield None
+            else:
+                buffer += chunk[start:end]
+                yield bytes(buffer.rstrip(b"\r"))
+                buffer.clear()
+            start = end + 1
+        if not skipping:
+            buffer += chunk[start:]
+            if len(buffer) > max_line:
+                skipping = True
+                buffer.clear()
+    if skipping:
+        yield None
+    elif buffer:
+        yield bytes(buffer.rstrip(b"\r"))
+
+
+def parse_line(line: bytes, defaults: dict, lanes: Iterable[str]) -> dict:
+    """
+    解析一行，返回 Message 的字段；无效时抛出 ValueError
+    >>> parse_line(b'"13800000001"', {"message": "hi"}, ["otp"])  # doctest: +NORMALIZE_WHITESPACE
+    {'phone_number': '13800000001', 'message': 'hi', 'sign': '', 'add_serial': '',
+     'priority': '', 'room': ''}
+    >>> line = b'{"phone_number": " 13800000001 ", "message": "a", "priority": "otp"}'
+    >>> parse_line(line, {}, ["otp"])["priority"]
+    'otp'
+    >>> parse_line(b'{"phone_number": "13800000001"}', {}, ["otp"])
+    Traceback (most recent call last):
+    ...
+    ValueError: 手机号或内容不能为空
+    """
+    try:
+        item = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        raise ValueError("不是合法的 JSON")
+    if isinstance(item, (str, int)) and not isinstance(item, bool):
+        item = {"phone_number": str(item)}
+    if not isinstance(item, dict):
+        raise ValueError("每行应为 JSON 对象或手机号")
+
+    phone_number = str(item.get("phone_number") or "").strip()
+    message = item.get("message") or defaults.get("message")
+    if not phone_number or not message or not isinstance(message, str):
+        raise ValueError("手机号或内容不能为空")
+    priority = item.get("priority") or defaults.get("priority") or ""
+    if priority and priority not in lanes:
+        raise ValueError(f"未知的优先级: {priority}")
+    return {
+        "phone_number": phone_number,
+        "message": message,
+        "sign": item.get("sign") or defaults.get("sign") or "",
+        "add_serial": item.get("add_serial") or defaults.get("add_serial") or "",
+        "priority": priority,
+        "room": item.get("room") or defaults.get("room") or "",
+    }
+
+
+class BulkJob:
+    """上传任务的进度，只有处理上传的请求写入"""
+
+    def __init__(self, job_id: str, send_at: Optional[float] = None):
+        self.id = job_id
+        self.key = BULK_JOB_KEY.format(job_id=job_id)
+        self.send_at = send_at
+        self.created = time.time()
+        self.counts = {"lines": 0, "accepted": 0, "duplicate": 0, "invalid": 0}
+        self.errors: List[dict] = []
+
+    def invalid(self, line: int, reason: str):
+        self.counts["invalid"] += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({"line": line, "error": reason})
+
+    def to_dict(self, status: str) -> dict:
+        return {
+            "job_id": self.id,
+            "status": status,
+            **self.counts,
+            "errors": self.errors,
+            "send_at": self.send_at,
+            "created": self.created,
+            "updated": time.time(),
+        }
+
+    async def create(self) -> bool:
+        """创建任务，job_id 已存在时返回 False"""
+        created = await ASYNC_REDIS.hsetnx(self.key, "status", orjson.dumps("running"))
+        if created:
+            await self.save("running")
+        return bool(created)
+
+    async def save(self, status: str) -> dict:
+        data = self.to_dict(status)
+        async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+            pipe.hset(self.key, mapping={name: orjson.dumps(value) for name, value in data.items()})
+            pipe.expire(self.key, settings.queue.bulk_job_ttl)
+            await pipe.execute()
+        return data
+
+    @staticmethod
+    async def load(job_id: str) -> Optional[dict]:
+        data = await ASYNC_REDIS.hgetall(BULK_JOB_KEY.format(job_id=job_id))
+        return {name: orjson.loads(value) for name, value in data.items()} if data else None
+
+
+async def iter_chunks(
+    lines: AsyncIterator[Optional[bytes]],
+    job: BulkJob,
+    defaults: dict,
+    lanes: Iterable[str],
+    size: int,
+) -> AsyncIterator[List[dict]]:
+    """
+    逐行解析，每 size 条有效短信返回一批；跳过空行，无效行记入任务进度
+    >>> async def lines(*items):
+    ...     for item in items:
+    ...         yield item
+    >>> async def collect(*items):
+    ...     chunks = iter_chunks(lines(*items), job, {"message": "hi"}, ["otp"], size=2)
+    ...     return [[fields["phone_number"] for fields in chunk] async for chunk in chunks]
+    >>> job = BulkJob("doctest")
+    >>> asyncio.run(collect(b'"1"', b"", b"{", b'"2"', None, b'"3"'))
+    [['1', '2'], ['3']]
+    >>> job.counts["lines"], job.counts["invalid"], [error["line"] for error in job.errors]
+    (5, 2, [2, 4])
+    """
+    chunk: List[dict] = []
+    async for line in lines:
+        if line is not None and not line.strip():
+            continue
+        job.counts["lines"] += 1
+        try:
+            if line is None:
+                raise ValueError(f"单行超过 {MAX_LINE_BYTES} 字节")
+            chunk.append(parse_line(line, defaults, lanes))
+        except ValueError as e:
+            job.invalid(job.counts["lines"], str(e))
+            continue
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def run_pipelined(
+    chunks: AsyncIterator[list], handle: Callable[[list], Awaitable[None]]
+) -> None:
+    """
+    逐批处理，处理上一批的同时读取下一批；同时最多一批在处理中，内存只占两批
+    出错或被取消时取消未完成的一批
+    >>> async def chunks():
+    ...     for i in range(3):
+    ...         events.append(f"read {i}")
+    ...         yield i
+    >>> async def handle(chunk):
+    ...     await asyncio.sleep(0)
+    ...     events.append(f"done {chunk}")
+    >>> events = []
+    >>> asyncio.run(run_pipelined(chunks(), handle))
+    >>> events
+    ['read 0', 'read 1', 'done 0', 'read 2', 'done 1', 'done 2']
+    """
+    pending: Optional[asyncio.Task] = None
+    try:
+        async for chunk in chunks:
+            if pending:
+                await pending
+            pending = asyncio.create_task(handle(chunk))
+        if pending:
+            await pending
+    except BaseException:
+        if pending and not pending.done():
+            pending.cancel()
+        raise
@@ -0,0 +1,196 @@
+"""
+飞书告警合并
+
+告警风暴时同一个 webhook 在短时间内收到大量相似但不相同的告警，逐条转发会触发飞书机器人的频率限制而丢失告警：
+- 窗口外的第一条告警立即转发，并开启 digest_window 秒的合并窗口
+- 窗口内通过过滤的告警只记录条数和前 digest_max_items 条摘要
+- 窗口结束时由任一 worker 认领，合并为一张汇总卡片发送，并开启下一个窗口；窗口内没有告警时窗口自然结束
+"""
+
+import json
+import time
+from typing import List, Optional, Tuple
+
+from cores.config import settings
+from cores.redis import ASYNC_REDIS
+
+# 合并窗口：存在即表示窗口未结束
+DIGEST_WINDOW_KEY = "feishu_digest_window:{token}"
+# 窗口内的告警摘要（最多 digest_max_items 条）
+DIGEST_ITEMS_KEY = "feishu_digest_items:{token}"
+# 窗口内的告警条数
+DIGEST_COUNT_KEY = "feishu_digest_count:{token}"
+# 有待发送汇总的 token：zset token -> 窗口结束时间（毫秒）
+DIGEST_DUE_KEY = "feishu_digest_due"
+
+# 窗口未开启时开启窗口并返回 1（立即转发），否则记录到汇总并返回 0
+# KEYS: 窗口、摘要、条数、待发送 zset；ARGV: token、当前时间（毫秒）、窗口（毫秒）、最多记录条数、摘要
+COALESCE_SCRIPT = ASYNC_REDIS.register_script(
+    """
+local window = tonumber(ARGV[3])
+if redis.call('SET', KEYS[1], '1', 'PX', window, 'NX') then
+    return 1
+end
+local due = tonumber(ARGV[2]) + math.max(redis.call('PTTL', KEYS[1]), 0)
+redis.call('ZADD', KEYS[4], 'NX', due, ARGV[1])
+if redis.call('INCR', KEYS[3]) <= tonumber(ARGV[4]) then
+    redis.call('RPUSH', KEYS[2], ARGV[5])
+end
+redis.call('PEXPIRE', KEYS[2], window * 2)
+redis.call('PEXPIRE', KEYS[3], window * 2)
+return 0
+"""
+)
+
+# 认领到期的汇总：只有一个 worker 能 ZREM 成功；发送汇总的同时开启下一个窗口
+# KEYS: 窗口、摘要、条数、待发送 zset；ARGV: token、当前时间（毫秒）、窗口（毫秒）
+CLAIM_SCRIPT = ASYNC_REDIS.register_script(
+    """
+local due = redis.call('ZSCORE', KEYS[4], ARGV[1])
+if not due or tonumber(due) > tonumber(ARGV[2]) then
+    return false
+end
+redis.call('ZREM', KEYS[4], ARGV[1])
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+local count = tonumber(redis.call('GET', KEYS[3]) or '0')
+redis.call('DEL', KEYS[2], KEYS[3])
+redis.call('SET', KEYS[1], '1', 'PX', tonumber(ARGV[3]))
+return {count, items}
+"""
+)
+
+
+def digest_keys(token: str) -> List[str]:
+    return [
+        DIGEST_WINDOW_KEY.format(token=token),
+        DIGEST_ITEMS_KEY.format(token=token),
+        DIGEST_COUNT_KEY.format(token=token),
+        DIGEST_DUE_KEY,
+    ]
+
+
+def message_summary(data: dict, limit: int = 200) -> str:
+    """
+    汇总卡片中每条告警显示的内容：卡片标题，或文本消息内容，或卡片中第一段文本
+    >>> message_summary({"card": {"header": {"title": {"content": "CPU 过高"}}}})
+    'CPU 过高'
+    >>> message_summary({"msg_type": "text", "content": {"text": "磁盘已满"}})
+    '磁盘已满'
+    >>> card = {"elements": [{"tag": "div", "text": {"content": "x" * 300}}]}
+    >>> message_summary({"card": card}, limit=5)
+    'xxxxx…'
+    """
+    card = data.get("card") or {}
+    summary = ((card.get("header") or {}).get("title") or {}).get("content")
+    if not summary and isinstance(data.get("content"), dict):
+        summary = data["content"].get("text")
+    if not summary:
+        for element in card.get("elements") or []:
+            text = (element.get("text") or {}).get("content") if isinstance(element, dict) else None
+            if isinstance(text, str) and text.strip():
+                summary = text
+                break
+    summary = (summary or json.dumps(data, ensure_ascii=False)).strip()
+    return summary if len(summary) <= limit else summary[:limit] + "…"
+
+
+def digest_card(count: int, items: List[str], window: float) -> dict:
+    """
+    汇总卡片，告警内容来自请求方，使用 plain_text 原样显示，不解析其中的 Markdown 和 @
+    >>> card = digest_card(120, ["a", "**b** <at id=all></at>"], 60)
+    >>> card["card"]["header"]["title"]["content"]
+    '告警汇总：60 秒内 120 条'
+    >>> card["card"]["elements"][0]["text"]
+    {'tag': 'plain_text', 'content': '1. a\\n2. **b** <at id=all></at>'}
+    >>> card["card"]["elements"][-1]["elements"][0]["content"]
+    '仅显示前 2 条，其余 118 条已合并'
+    """
+    elements = [
+        {
+            "tag": "div",
+            "text": {
+                "tag": "plain_text",
+                "content": "\n".join(f"{i}. {item}" for i, item in enumerate(items, 1)),
+            },
+        }
+    ]
+    if count > len(items):
+        elements.append(
+            {
+                "tag": "note",
+                "elements": [
+                    {
+                        "tag": "plain_text",
+                        "content": f"仅显示前 {len(items)} 条，其余 {count - len(items)} 条已合并",
+                    }
+                ],
+            }
+        )
+    return {
+        "msg_type": "interactive",
+        "card": {
+            "header": {
+                "template": "orange",
+                "title": {"tag": "plain_text", "content": f"告警汇总：{window:g} 秒内 {count} 条"},
+            },
+            "elements": elements,
+        },
+    }
+
+
+async def coalesce(token: str, data: dict) -> bool:
+    """
+    通过过滤的告警进入合并阶段
+    :return: 是否立即转发；False 表示已记入汇总
+    """
+    config = settings.feishu
+    return bool(
+        await COALESCE_SCRIPT(
+            keys=digest_keys(token),
+            args=[
+                token,
+                int(time.time() * 1000),
+                int(config.digest_window * 1000),
+                config.digest_max_items,
+                message_summary(data),
+            ],
+        )
+    )
+
+
+async def claim_due(limit: int = 100, now: Optional[int] = None) -> List[Tuple[str, dict]]:
+    """
+    认领到期的汇总，返回 [(token, 汇总卡片)]
+    :param limit:
+    :param now: 当前时间（毫秒）
+
+    窗口内的 N 条告警只转发第一条，其余在窗口结束后合并为一张汇总卡片，且只会被认领一次：
+
+    >>> import asyncio
+    >>> from unittest import mock
+    >>> async def storm(count):
+    ...     alerts = [{"msg_type": "text", "content": {"text": f"告警 {i}"}} for i in range(count)]
+    ...     forwarded = [await coalesce("doctest", alert) for alert in alerts]
+    ...     due = int(time.time() * 1000) + 60000
+    ...     early = await claim_due(now=due - 1000)
+    ...     return forwarded, early, await claim_due(now=due), await claim_due(now=due)
+    >>> with mock.patch.multiple(settings.feishu, digest_window=60, digest_max_items=2):
+    ...     forwarded, early, claimed, again = asyncio.run(storm(5))
+    >>> forwarded, early, again
+    ([True, False, False, False, False], [], [])
+    >>> [(token, card["card"]["header"]["title"]["content"]) for token, card in claimed]
+    [('doctest', '告警汇总：60 秒内 4 条')]
+    >>> claimed[0][1]["card"]["elements"][0]["text"]["content"]
+    '1. 告警 1\\n2. 告警 2'
+    """
+    now = int(time.time() * 1000) if now is None else now
+    window = settings.feishu.digest_window
+    claimed = []
+    for token in await ASYNC_REDIS.zrangebyscore(DIGEST_DUE_KEY, "-inf", now, start=0, num=limit):
+        result: Optional[list] = await CLAIM_SCRIPT(
+            keys=digest_keys(token), args=[token, now, int(window * 1000)]
+        )
+        if result:
+            count, items = result
+            claimed.append((token, digest_card(int(count), items, window)))
+    return claimed
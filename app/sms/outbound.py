@@ -0,0 +1,277 @@
+"""
+飞书出站队列（dispatch_mode = queued）
+
+同步转发时飞书的限流和临时错误直接返回给调用方，消息随之丢失；排队模式下接口过滤后立即返回，由后台按 webhook 发送：
+- 每个 token 一个 Redis List（feishu_outbound:{token}），先进先出
+- zset feishu_outbound_due 记录每个 token 可以发送的时间；被某个 worker 认领时改为租约到期时间，
+  同一个 token 同时只有一个 worker 发送，保证顺序
+- 开启 [ratelimit] enabled 时发送前先从该 webhook 的令牌桶取令牌；
+  飞书返回 429 / 9499 / 11232 时按 Retry-After 或指数退避重试队首消息，不会丢弃
+- 网络错误和 5xx 最多重试 dispatch_max_attempts 次，之后移入 feishu_outbound_dead:{token}
+- 成功或其他业务错误时才出队；worker 在发送中退出时租约到期后由其他 worker 重发（至少一次）
+"""
+
+import asyncio
+import time
+from typing import Dict, Optional
+
+import httpx
+import orjson
+
+from cores.config import settings
+from cores.http import FEISHU_LIMIT, get_http_client
+from cores.log import LOG
+from cores.metrics import COLLECTORS, FEISHU_DISPATCH_TOTAL, FEISHU_FORWARD_SECONDS
+from cores.ratelimit import feishu_rate_limiter
+from cores.redis import ASYNC_REDIS
+
+OUTBOUND_QUEUE_KEY = "feishu_outbound:{token}"
+# zset token -> 可以发送的时间（毫秒），被认领时为租约到期时间
+OUTBOUND_DUE_KEY = "feishu_outbound_due"
+# hash token -> 队首消息已尝试的次数
+OUTBOUND_ATTEMPTS_KEY = "feishu_outbound_attempts"
+OUTBOUND_DEAD_KEY = "feishu_outbound_dead:{token}"
+OUTBOUND_DEAD_MAXLEN = 1000
+
+# 飞书的限流错误码
+RATE_LIMIT_CODES = {9499, 11232}
+
+POLL_INTERVAL = 0.1  # 扫描到期 token 的间隔（秒）
+DRAIN_BUDGET = 5.0  # 每次认领最多连续发送的时间（秒），之后让出给其他 worker
+LEASE = 60.0  # 认领的租约（秒），需大于 DRAIN_BUDGET 加一次请求的超时时间
+
+# 入队：超过 max_pending 时返回 -1，否则返回队列长度
+# KEYS: 队列、到期 zset；ARGV: token、当前时间（毫秒）、max_pending、消息
+ENQUEUE_SCRIPT = ASYNC_REDIS.register_script(
+    """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[3]) then
+    return -1
+end
+local length = redis.call('RPUSH', KEYS[1], ARGV[4])
+redis.call('ZADD', KEYS[2], 'NX', ARGV[2], ARGV[1])
+return length
+"""
+)
+
+# 认领到期的 token，成功时把到期时间改为租约到期时间
+# KEYS: 到期 zset；ARGV: token、当前时间（毫秒）、租约到期时间（毫秒）
+CLAIM_SCRIPT = ASYNC_REDIS.register_script(
+    """
+local due = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not due or tonumber(due) > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+)
+
+# 释放：队列已空时移除 token，否则设置下次可以发送的时间
+# KEYS: 队列、到期 zset；ARGV: token、下次发送时间（毫秒）
+RELEASE_SCRIPT = ASYNC_REDIS.register_script(
+    """
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+)
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+async def post_webhook(token: str, body: bytes) -> httpx.Response:
+    """请求飞书 webhook，受进程内并发上限约束；body 为已序列化的 JSON，原样发送"""
+    async with FEISHU_LIMIT:
+        start = time.perf_counter()
+        response = await get_http_client().post(
+            url=f"{settings.feishu.hook_base_url}/{token}",
+            content=body,
+            headers={"Content-Type": "application/json"},
+        )
+        FEISHU_FORWARD_SECONDS.observe(time.perf_counter() - start, status=response.status_code)
+    return response
+
+
+async def enqueue(token: str, body: bytes) -> int:
+    """
+    加入 token 的出站队列
+    :return: 队列长度，-1 表示积压超过 dispatch_max_pending
+    """
+    return await ENQUEUE_SCRIPT(
+        keys=[OUTBOUND_QUEUE_KEY.format(token=token), OUTBOUND_DUE_KEY],
+        args=[token, now_ms(), settings.feishu.dispatch_max_pending, body],
+    )
+
+
+def retry_after(response: Optional[httpx.Response], attempts: int) -> float:
+    """
+    退避时间：优先使用飞书返回的 Retry-After / x-ogw-ratelimit-reset，否则指数退避
+    >>> retry_after(None, 1), retry_after(None, 3), retry_after(None, 20)
+    (1.0, 4.0, 60.0)
+    >>> retry_after(httpx.Response(429, headers={"Retry-After": "7"}), 1)
+    7.0
+    """
+    if response is not None:
+        for header in ("Retry-After", "x-ogw-ratelimit-reset"):
+            try:
+                return min(float(response.headers[header]), settings.feishu.dispatch_max_backoff)
+            except (KeyError, ValueError):
+                continue
+    return float(min(2 ** (attempts - 1), settings.feishu.dispatch_max_backoff))
+
+
+async def pop_head(token: str, dead: bool = False):
+    """队首消息发送完成（或放弃）后出队，并清零尝试次数"""
+    queue = OUTBOUND_QUEUE_KEY.format(token=token)
+    async with ASYNC_REDIS.pipeline(transaction=True) as pipe:
+        if dead:
+            dead_key = OUTBOUND_DEAD_KEY.format(token=token)
+            pipe.lmove(queue, dead_key, "LEFT", "RIGHT")
+            pipe.ltrim(dead_key, -OUTBOUND_DEAD_MAXLEN, -1)
+        else:
+            pipe.lpop(queue)
+        pipe.hdel(OUTBOUND_ATTEMPTS_KEY, token)
+        await pipe.execute()
+
+
+async def send_head(token: str, payload: str) -> float:
+    """
+    发送队首消息
+    :return: 0 表示已出队，可以继续发送下一条；否则为重试前需要等待的秒数
+    """
+    response, error = None, ""
+    try:
+        response = await post_webhook(token, payload.encode())
+        try:
+            code = orjson.loads(response.content).get("code", 0)
+        except (orjson.JSONDecodeError, AttributeError):
+            code = 0
+        if response.status_code == 429 or code in RATE_LIMIT_CODES:
+            attempts = await ASYNC_REDIS.hincrby(OUTBOUND_ATTEMPTS_KEY, token, 1)
+            FEISHU_DISPATCH_TOTAL.inc(result="throttled")
+            return retry_after(response, attempts)
+        if response.status_code < 500:
+            if code:
+                LOG.warning(f"飞书返回错误，丢弃消息 {token}: {response.text}")
+            FEISHU_DISPATCH_TOTAL.inc(
+                result="failed" if code or response.status_code >= 400 else "sent"
+            )
+            await pop_head(token)
+            return 0
+        error = f"HTTP {response.status_code}"
+    except httpx.HTTPError as e:
+        error = repr(e)
+
+    # 网络错误或 5xx：有限次重试
+    attempts = await ASYNC_REDIS.hincrby(OUTBOUND_ATTEMPTS_KEY, token, 1)
+    if attempts >= settings.feishu.dispatch_max_attempts:
+        LOG.error(f"飞书消息重试 {attempts} 次仍失败，移入死信队列 {token}: {error}")
+        FEISHU_DISPATCH_TOTAL.inc(result="dead")
+        await pop_head(token, dead=True)
+        return 0
+    FEISHU_DISPATCH_TOTAL.inc(result="retry")
+    return retry_after(None, attempts)
+
+
+async def drain(token: str):
+    """
+    在租约内按顺序连续发送 token 的队列（开启限流时按令牌桶速率），结束时释放并设置下次发送时间
+
+    限流时等待后重发队首消息，5xx 重试 dispatch_max_attempts 次后移入死信队列，其余消息顺序不变：
+
+    >>> import asyncio
+    >>> from cores.http import _clients
+    >>> replies = [429, 200, 200, 503, 503]
+    >>> sent = []
+    >>> def webhook(request):
+    ...     sent.append(orjson.loads(request.content)["n"])
+    ...     status = replies.pop(0)
+    ...     return httpx.Response(status, headers={"Retry-After": "3"} if status == 429 else {})
+    >>> _clients["default"] = httpx.AsyncClient(transport=httpx.MockTransport(webhook))
+    >>> max_attempts = settings.feishu.dispatch_max_attempts
+    >>> settings.feishu.dispatch_max_attempts = 2
+    >>> async def state():
+    ...     due = await ASYNC_REDIS.zscore(OUTBOUND_DUE_KEY, "t")
+    ...     return (
+    ...         sent,
+    ...         await ASYNC_REDIS.lrange(OUTBOUND_QUEUE_KEY.format(token="t"), 0, -1),
+    ...         await ASYNC_REDIS.lrange(OUTBOUND_DEAD_KEY.format(token="t"), 0, -1),
+    ...         due and round((due - now_ms()) / 1000),
+    ...     )
+    >>> async def dispatch():
+    ...     for n in range(3):
+    ...         await enqueue("t", orjson.dumps({"n": n}))
+    ...     for _ in range(3):
+    ...         await drain("t")
+    ...         print(await state())
+    >>> asyncio.run(dispatch())
+    ([0], ['{"n":0}', '{"n":1}', '{"n":2}'], [], 3)
+    ([0, 0, 1, 2], ['{"n":2}'], [], 1)
+    ([0, 0, 1, 2, 2], [], ['{"n":2}'], None)
+    >>> settings.feishu.dispatch_max_attempts = max_attempts
+    >>> del _clients["default"]
+    """
+    queue = OUTBOUND_QUEUE_KEY.format(token=token)
+    limiter = feishu_rate_limiter(token) if settings.ratelimit.enabled else None
+    deadline = time.monotonic() + DRAIN_BUDGET
+    delay = 0.0
+    try:
+        while time.monotonic() < deadline:
+            if (payload := await ASYNC_REDIS.lindex(queue, 0)) is None:
+                break
+            if limiter is not None and (delay := await limiter.acquire()):
+                break
+            if delay := await send_head(token, payload):
+                break
+    except Exception as e:
+        LOG.warning(f"飞书出站队列发送失败 {token}: {e}")
+        delay = 1.0
+    finally:
+        await RELEASE_SCRIPT(
+            keys=[queue, OUTBOUND_DUE_KEY], args=[token, now_ms() + int(delay * 1000)]
+        )
+
+
+async def run_dispatcher():
+    """后台发送出站队列，各 worker 都运行"""
+    draining: Dict[str, asyncio.Task] = {}
+    try:
+        while True:
+            try:
+                now = now_ms()
+                for token in await ASYNC_REDIS.zrangebyscore(
+                    OUTBOUND_DUE_KEY, "-inf", now, start=0, num=100
+                ):
+                    if token in draining or not await CLAIM_SCRIPT(
+                        keys=[OUTBOUND_DUE_KEY], args=[token, now, now + int(LEASE * 1000)]
+                    ):
+                        continue
+                    task = draining[token] = asyncio.create_task(drain(token))
+                    task.add_done_callback(lambda _, token=token: draining.pop(token, None))
+            except Exception as e:
+                LOG.warning(f"扫描飞书出站队列失败: {e}")
+            await asyncio.sleep(POLL_INTERVAL)
+    finally:
+        for task in list(draining.values()):
+            task.cancel()
+
+
+async def outbound_metrics():
+    """抓取 /metrics 时采集出站队列积压"""
+    tokens = await ASYNC_REDIS.zrange(OUTBOUND_DUE_KEY, 0, -1)
+    async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+        for token in tokens:
+            pipe.llen(OUTBOUND_QUEUE_KEY.format(token=token))
+        lengths = await pipe.execute() if tokens else []
+    return [
+        ("feishu_outbound_webhooks", "有待发送消息的飞书 webhook 数", {"": len(tokens)}),
+        ("feishu_outbound_pending", "飞书出站队列中待发送的消息数", {"": sum(lengths)}),
+    ]
+
+
+COLLECTORS.append(outbound_metrics)
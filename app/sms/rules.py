@@ -0,0 +1,233 @@
+import re
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Pattern
+
+from pydantic import BaseModel
+
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS
+
+# 每个 token 的规则版本号，规则变更时自增，用于各 worker 失效进程内缓存
+RULE_VERSION_KEY = "rules_version:{token}"
+# 每个 token 的全部规则：hash rule_id -> 规则 JSON
+RULE_SET_KEY = "rule_set:{token}"
+# 每条规则的过期时间：zset rule_id -> 过期时间戳（秒），不过期的规则不在其中
+RULE_EXPIRY_KEY = "rule_set_expiry:{token}"
+# 旧版存储：每条规则一个 string key
+LEGACY_RULE_PATTERN = "rules:*"
+
+# 清理已过期规则，返回全部规则和最近一条规则的过期时间
+LOAD_RULES_SCRIPT = ASYNC_REDIS.register_script(
+    """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for i = 1, #expired, 1000 do
+    local chunk = {unpack(expired, i, math.min(i + 999, #expired))}
+    redis.call('HDEL', KEYS[1], unpack(chunk))
+    redis.call('ZREM', KEYS[2], unpack(chunk))
+end
+local next_expiry = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+return {redis.call('HGETALL', KEYS[1]), next_expiry[2] or false}
+"""
+)
+
+# 将一条旧版规则原地迁移到新结构，保留剩余过期时间
+MIGRATE_RULE_SCRIPT = ASYNC_REDIS.register_script(
+    """
+local data = redis.call('GET', KEYS[1])
+if not data then
+    return 0
+end
+local ttl = redis.call('PTTL', KEYS[1])
+redis.call('HSET', KEYS[2], ARGV[1], data)
+if ttl > 0 then
+    redis.call('ZADD', KEYS[3], tonumber(ARGV[2]) + ttl / 1000, ARGV[1])
+else
+    redis.call('ZREM', KEYS[3], ARGV[1])
+end
+redis.call('DEL', KEYS[1])
+redis.call('INCR', KEYS[4])
+return 1
+"""
+)
+
+
+class FilterRule(BaseModel):
+    include: List[str]
+    exclude: List[str]
+    expires: int = 0  # 过期时间（秒）
+
+
+class AnyPattern:
+    """无法合并为单个正则时（例如模式中间带全局标志、带分组）逐个匹配"""
+
+    def __init__(self, patterns: Iterable[Pattern]):
+        self.patterns = list(patterns)
+
+    def search(self, item: str):
+        for pattern in self.patterns:
+            if match := pattern.search(item):
+                return match
+        return None
+
+
+def compile_patterns(patterns: List[str]):
+    """
+    将多个模式合并为一个预编译的匹配器，任一模式命中即命中
+    带分组的模式合并后组号会变化（反向引用随之失效），逐个匹配
+    >>> compile_patterns(["a+", "b"]).search("xbx") is not None
+    True
+    >>> compile_patterns(["(?i)a", "b"]).search("A") is not None
+    True
+    >>> matcher = compile_patterns([r"(a)\\1", r"(b)\\1", "c"])
+    >>> [matcher.search(item) is not None for item in ("aa", "bb", "c", "ab")]
+    [True, True, True, False]
+    >>> compile_patterns([]) is None
+    True
+
+    :param patterns:
+    :return:
+    """
+    if not patterns:
+        return None
+    compiled = [re.compile(pattern) for pattern in patterns]
+    plain = [pattern for pattern in compiled if not pattern.groups]
+    if len(plain) > 1:
+        try:
+            plain = [re.compile("|".join(f"(?:{pattern.pattern})" for pattern in plain))]
+        except re.error:
+            pass
+    matchers = plain + [pattern for pattern in compiled if pattern.groups]
+    return matchers[0] if len(matchers) == 1 else AnyPattern(matchers)
+
+
+class CompiledRuleSet:
+    """
+    一个 token 下全部规则的编译结果
+    - 每条规则的 include 合并为一个匹配器，所有规则都需命中（规则之间是"与"的关系）
+    - 所有规则的 exclude 合并为一个匹配器，任一命中即过滤
+    """
+
+    def __init__(
+        self, rules: List[FilterRule], version: Optional[str] = None, expires_at: float = 0
+    ):
+        self.version = version
+        self.expires_at = expires_at  # 最早过期规则的时间戳，0 表示无过期规则
+        self.includes = [compile_patterns(rule.include) for rule in rules if rule.include]
+        self.exclude = compile_patterns([pattern for rule in rules for pattern in rule.exclude])
+
+    @property
+    def expired(self) -> bool:
+        return bool(self.expires_at) and time.time() >= self.expires_at
+
+    def match(self, contents: List[str]) -> bool:
+        """
+        >>> rule_set = CompiledRuleSet([FilterRule(include=["a", "b"], exclude=["c"])])
+        >>> [rule_set.match(contents) for contents in (["xa"], ["xa", "c"], ["x"], [])]
+        [True, False, False, True]
+
+        include 中任一模式命中任一内容即通过，exclude 中任一模式命中任一内容即过滤，内容为空时总是通过：
+
+        >>> def match(contents, include=(), exclude=()):
+        ...     rule = FilterRule(include=list(include), exclude=list(exclude))
+        ...     return CompiledRuleSet([rule]).match(contents)
+        >>> [match(["a", "b", "c"], include=p) for p in (["a", "b"], ["d", "e"], ["a"], [])]
+        [True, False, True, True]
+        >>> [match(["abc", "bc", "c"], exclude=p) for p in (["a", "b"], ["d", "e"], [])]
+        [False, True, True]
+        >>> match(["abc", "bc"], exclude=["c"]), match([], include=["a"], exclude=["b"])
+        (False, True)
+
+        :param contents:
+        :return:
+        """
+        if not contents:
+            return True
+        for include in self.includes:
+            if not any(include.search(item) for item in contents):
+                return False
+        if self.exclude is not None and any(self.exclude.search(item) for item in contents):
+            return False
+        return True
+
+
+def rule_keys(token: str) -> List[str]:
+    return [
+        RULE_SET_KEY.format(token=token),
+        RULE_EXPIRY_KEY.format(token=token),
+        RULE_VERSION_KEY.format(token=token),
+    ]
+
+
+async def load_rule_set(token: str, version: Optional[str]) -> CompiledRuleSet:
+    """一次往返从 Redis 加载 token 的全部规则并编译"""
+    rule_set_key, rule_expiry_key, _ = rule_keys(token)
+    rule_items, next_expiry = await LOAD_RULES_SCRIPT(
+        keys=[rule_set_key, rule_expiry_key], args=[time.time()]
+    )
+    # HGETALL 在 Lua 中返回扁平的 [field, value, ...]
+    rules = [FilterRule.model_validate_json(rule_data) for rule_data in rule_items[1::2]]
+    LOG.info(f"加载过滤规则 {token} {version = } 共 {len(rules)} 条")
+    return CompiledRuleSet(rules, version, float(next_expiry) if next_expiry else 0)
+
+
+class RuleCache:
+    """进程内的规则缓存，按版本号和规则过期时间失效"""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._rule_sets: "OrderedDict[str, CompiledRuleSet]" = OrderedDict()
+
+    async def get(self, token: str, version: Optional[str]) -> CompiledRuleSet:
+        rule_set = self._rule_sets.get(token)
+        if rule_set is None or rule_set.version != version or rule_set.expired:
+            rule_set = await load_rule_set(token, version)
+            self._rule_sets[token] = rule_set
+            if len(self._rule_sets) > self.max_size:
+                self._rule_sets.popitem(last=False)
+        else:
+            self._rule_sets.move_to_end(token)
+        return rule_set
+
+
+RULE_CACHE = RuleCache()
+
+
+async def save_rule(token: str, rule_id: str, rule_data: str, expires: int = 0):
+    """保存规则并自增版本号（事务内完成）"""
+    rule_set_key, rule_expiry_key, rule_version_key = rule_keys(token)
+    async with ASYNC_REDIS.pipeline(transaction=True) as pipe:
+        pipe.hset(rule_set_key, rule_id, rule_data)
+        if expires:
+            pipe.zadd(rule_expiry_key, {rule_id: time.time() + expires})
+        else:
+            pipe.zrem(rule_expiry_key, rule_id)
+        pipe.incr(rule_version_key)
+        await pipe.execute()
+
+
+async def delete_rules(token: str, rule_id: Optional[str] = None):
+    """删除指定规则，未指定 rule_id 时原子地删除 token 的全部规则"""
+    rule_set_key, rule_expiry_key, rule_version_key = rule_keys(token)
+    async with ASYNC_REDIS.pipeline(transaction=True) as pipe:
+        if rule_id is None:
+            pipe.delete(rule_set_key, rule_expiry_key)
+        else:
+            pipe.hdel(rule_set_key, rule_id)
+            pipe.zrem(rule_expiry_key, rule_id)
+        pipe.incr(rule_version_key)
+        await pipe.execute()
+
+
+async def migrate_legacy_rules():
+    """将旧版 rules:{token}:{rule_id} 规则迁移到按 token 索引的结构，使用 SCAN 不阻塞 Redis"""
+    migrated = 0
+    async for rule_name in ASYNC_REDIS.scan_iter(match=LEGACY_RULE_PATTERN, count=1000):
+        token, _, rule_id = rule_name[len("rules:") :].rpartition(":")
+        if not token:
+            continue
+        migrated += await MIGRATE_RULE_SCRIPT(
+            keys=[rule_name, *rule_keys(token)], args=[rule_id, time.time()]
+        )
+    if migrated:
+        LOG.warning(f"已迁移旧版过滤规则 {migrated} 条")
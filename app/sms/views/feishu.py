@@ -1,134 +1,259 @@
+import asyncio
 import hashlib
 import json
-import re
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
 
-import requests
-from fastapi import APIRouter
-from pydantic import BaseModel
+import orjson
+from fastapi import APIRouter, HTTPException
 from starlette.requests import Request
 
+from app.sms.digest import claim_due, coalesce
+from app.sms.outbound import enqueue, post_webhook
+from app.sms.rules import (
+    RULE_CACHE,
+    RULE_VERSION_KEY,
+    FilterRule,
+    delete_rules,
+    save_rule,
+)
 from cores.config import settings
+from cores.dedupe import FEISHU_DEDUPER, FEISHU_LOCAL_CACHE
 from cores.log import LOG
+from cores.metrics import (
+    DEDUPE_TOTAL,
+    FEISHU_DIGEST_TOTAL,
+    FEISHU_FILTER_SECONDS,
+    FEISHU_FILTER_TOTAL,
+)
+from cores.ratelimit import feishu_rate_limiter
 from cores.redis import ASYNC_REDIS
 
 feishu_router = APIRouter()
 
+# 日志中记录的请求体最大字节数，大卡片不再完整格式化输出
+LOG_BODY_LIMIT = 1024
 
-class FilterRule(BaseModel):
-    include: List[str]
-    exclude: List[str]
-    expires: int = 0  # 过期时间（秒）
+# 与飞书 webhook 成功时的返回一致，被过滤、合并或已加入出站队列时返回
+SUCCESS_RESPONSE = {
+    "StatusCode": 0,
+    "StatusMessage": "success",
+    "code": 0,
+    "data": {},
+    "msg": "success",
+}
 
 
-def search_value(data: dict, key: str):
+def parse_paths(paths: str) -> List[Tuple[str, ...]]:
     """
-    递归获取字典中的值
-    :param data:
-    :param key:
-    :return:
+    解析逗号分隔的 JSON 路径：以 . 分隔，* 匹配任意一个子节点，** 匹配任意层级（后面必须是字段名），数字匹配列表下标
+    >>> parse_paths("**.content, card.header.title.content")
+    [('**', 'content'), ('card', 'header', 'title', 'content')]
+    """
+    parsed = []
+    for path in filter(None, (path.strip() for path in paths.split(","))):
+        segments = tuple(path.split("."))
+        for i, segment in enumerate(segments):
+            if segment == "**" and (i + 1 == len(segments) or segments[i + 1] in ("*", "**")):
+                raise ValueError(f"JSON 路径 {path} 中 ** 后必须是字段名")
+        parsed.append(segments)
+    return parsed
+
+
+def find_keys(data, keys: frozenset) -> Iterator:
+    """
+    按文档顺序取出任意层级中字段名属于 keys 的值，字段值为 dict、list 时继续向下查找
+    使用迭代器栈，不受嵌套深度限制，每个节点只访问一次
+    >>> list(find_keys({"a": [{"k": 1}, {"b": {"k": {"j": 2}}}], "k": 3}, frozenset({"k", "j"})))
+    [1, {'j': 2}, 2, 3]
     """
     if isinstance(data, dict):
-        for k, v in data.items():
-            if k == key and len(v.strip()) > 0:
-                yield v
-            else:
-                yield from search_value(v, key)
+        stack = [iter(data.items())]
     elif isinstance(data, list):
-        for item in data:
-            yield from search_value(item, key)
+        stack = [enumerate(data)]
+    else:
+        return
+    while stack:
+        for k, v in stack[-1]:
+            if k in keys:
+                yield v
+            # JSON 解析结果只有 dict / list 两种容器，直接比较类型比 isinstance 快
+            kind = type(v)
+            if kind is dict:
+                stack.append(iter(v.items()))
+                break
+            if kind is list:
+                stack.append(enumerate(v))
+                break
+        else:
+            stack.pop()
 
 
-def apply_include(contents: list, include: list):
+def extract_values(data, paths: List[Tuple[str, ...]]) -> Iterator[str]:
     """
-    >>> apply_include(["a", "b", "c"], ["a", "b"])
-    True
-    >>> apply_include(["a", "b", "c"], ["d", "e"])
-    False
-    >>> apply_include(["a", "b", "c"], ["a"])
-    True
-    >>> apply_include(["a", "b", "c"], [])
-    True
-    >>> apply_include([], ["a", "b", "c"])
-    True
+    按 JSON 路径取出非空字符串，同一路径内按文档顺序，非字符串的值跳过
+    >>> elements = [{"content": "b"}, {"content": 1}, {"content": " "}]
+    >>> card = {"content": {"text": "a"}, "elements": elements, "x": {"content": "c"}}
+    >>> list(extract_values(card, parse_paths("**.content")))
+    ['b', 'c']
+    >>> card = {"elements": [{"text": {"content": "a"}}, {"text": {"content": "b"}}]}
+    >>> list(extract_values({"card": card}, parse_paths("card.elements.*.text.content")))
+    ['a', 'b']
+    >>> data = {"content": {"text": "hi"}, "items": ["x", "y"]}
+    >>> list(extract_values(data, parse_paths("content.text,items.1")))
+    ['hi', 'y']
+    >>> list(extract_values({"a": [{"b": {"c": "x"}}, {"b": {"d": "y"}}]}, parse_paths("**.b.*")))
+    ['x', 'y']
+    >>> data = {"content": {"text": "a"}, "x": [{"tag": "text", "text": "b"}, {"content": "c"}]}
+    >>> list(extract_values(data, parse_paths("**.content,**.text")))
+    ['a', 'b', 'c']
+    """
+    # 形如 **.字段 的路径合并为一次遍历，按文档顺序交错取值
+    keys = frozenset(path[1] for path in paths if len(path) == 2 and path[0] == "**")
+    if keys:
+        for value in find_keys(data, keys):
+            if isinstance(value, str) and value.strip():
+                yield value
+    for path in paths:
+        if not (len(path) == 2 and path[0] == "**"):
+            yield from extract_path(data, path)
+
+
+def extract_path(data, path: Tuple[str, ...]) -> Iterator[str]:
+    stack = [(data, 0)]
+    while stack:
+        node, i = stack.pop()
+        if i == len(path):
+            if isinstance(node, str) and node.strip():
+                yield node
+        elif path[i] == "**":
+            for value in find_keys(node, frozenset((path[i + 1],))):
+                yield from extract_path(value, path[i + 2 :])
+        else:
+            stack.extend((child, i + 1) for child in reversed(child_nodes(node, path[i])))
 
-    :param contents:
-    :param include:
-    :return:
+
+def child_nodes(node, segment: str) -> list:
     """
-    if not include or not contents:
-        return True
-    for item in contents:
-        for pattern in include:
-            if re.search(pattern, item):
-                return True
-    else:
-        return False
+    按路径中的一段（* 、字段名或列表下标）取出子节点，按文档顺序
+    >>> child_nodes({"a": 1, "b": 2}, "*"), child_nodes(["x", "y"], "1"), child_nodes({"a": 1}, "b")
+    ([1, 2], ['y'], [])
+    """
+    if segment == "*":
+        if isinstance(node, dict):
+            return list(node.values())
+        return node if isinstance(node, list) else []
+    if isinstance(node, dict):
+        return [node[segment]] if segment in node else []
+    if isinstance(node, list) and segment.isdigit() and int(segment) < len(node):
+        return [node[int(segment)]]
+    return []
 
 
-def apply_exclude(contents: list, exclude: list):
+def content_digest(contents: List[str]) -> str:
     """
-    >>> apply_exclude(["abc", "bc", "c"], ["a", "b"])
-    False
-    >>> apply_exclude(["abc", "bc", "c"], ["d", "e"])
+    逐段增量计算内容摘要，不再序列化整个列表
+    >>> content_digest(["a", "b"]) != content_digest(["ab"])
     True
-    >>> apply_exclude(["abc", "bc"], ["c"])
-    False
-    >>> apply_exclude(["abc", "bc", "c"], [])
-    True
-    >>> apply_exclude([], ["a", "b", "c"])
-    True
-
-    :param contents:
-    :param exclude:
-    :return:
     """
-    for item in contents:
-        for pattern in exclude:
-            if re.search(pattern, item):
-                return False
-    else:
-        return True
+    digest = hashlib.md5()
+    for content in contents:
+        digest.update(content.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
 
 
-async def apply_filter_rule(data: dict, token: str):
-    rule_names = await ASYNC_REDIS.keys(f"rules:{token}:*")
-    contents = list(search_value(data, "content"))
+CONTENT_PATHS = parse_paths(settings.feishu.content_paths)
 
+
+async def apply_filter_rule(data: dict, token: str):
     # 过滤时间
-    contents = [content for content in contents if "时间" not in content]
+    contents = [content for content in extract_values(data, CONTENT_PATHS) if "时间" not in content]
 
     # 过滤最近发送的内容
-    msg_hash = hashlib.md5(json.dumps(contents).encode()).hexdigest()
-    cache_key = f"feishu:{msg_hash}"
+    msg_hash = content_digest(contents)
+
+    # 本进程最近确认过的重复消息，不访问 Redis
+    if FEISHU_LOCAL_CACHE.seen(msg_hash):
+        DEDUPE_TOTAL.inc(namespace="feishu", result="hit")
+        FEISHU_FILTER_TOTAL.inc(result="duplicate")
+        return False
 
-    if not await ASYNC_REDIS.set(cache_key, "sent", ex=settings.rules.feishu_same_message_interval, nx=True):
-        LOG.warning(f"相同消息 60 秒内不重复发送")
+    # 去重与规则版本号在同一次往返中完成
+    async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+        await FEISHU_DEDUPER.is_new(msg_hash, client=pipe)
+        pipe.get(RULE_VERSION_KEY.format(token=token))
+        (is_new, remaining), version = await pipe.execute()
+    FEISHU_LOCAL_CACHE.remember(msg_hash, remaining)
+
+    if not is_new:
+        DEDUPE_TOTAL.inc(namespace="feishu", result="hit")
+        FEISHU_FILTER_TOTAL.inc(result="duplicate")
+        LOG.warning("相同消息 60 秒内不重复发送")
         return False
+    DEDUPE_TOTAL.inc(namespace="feishu", result="miss")
+
+    rule_set = await RULE_CACHE.get(token, version)
+    passed = rule_set.match(contents)
+    FEISHU_FILTER_TOTAL.inc(result="passed" if passed else "blocked")
+    return passed
+
+
+async def forward(token: str, body: bytes) -> dict:
+    """同步转发到飞书 webhook，受出站限流和并发上限约束"""
+    if settings.ratelimit.enabled and not await feishu_rate_limiter(token).wait(
+        max_wait=settings.ratelimit.feishu_max_wait
+    ):
+        return {"code": 9499, "msg": "Too Many Request", "data": {}}
+    response = await post_webhook(token, body)
+    LOG.info(response.text)
+    return orjson.loads(response.content)
+
 
-    for rule_name in rule_names:
-        rule_data = await ASYNC_REDIS.get(rule_name)
-        rule = FilterRule.model_validate_json(rule_data)
-        if not (apply_include(contents, rule.include) and apply_exclude(contents, rule.exclude)):
-            return False
-    return True
+async def deliver(token: str, body: bytes) -> dict:
+    """按 dispatch_mode 同步转发，或加入出站队列后立即返回；body 为原始请求体，原样转发"""
+    if settings.feishu.dispatch_mode != "queued":
+        return await forward(token, body)
+    if await enqueue(token, body) < 0:
+        LOG.warning(f"飞书出站队列积压超过 {settings.feishu.dispatch_max_pending} 条 {token}")
+        return {"code": 9499, "msg": "Too Many Request", "data": {}}
+    return SUCCESS_RESPONSE
 
 
 @feishu_router.post("/send/{token}")
 async def send(token: str, request: Request):
-    json_data = await request.json()
-    LOG.info(f"请求参数: {token} {json_data = }")
+    body = await request.body()
+    LOG.info(f"请求参数: {token} {body[:LOG_BODY_LIMIT].decode(errors='replace')}")
+    try:
+        json_data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="请求体不是合法的 JSON")
 
     # 过滤
-    if await apply_filter_rule(data=json_data, token=token):
-        response = requests.post(
-            url=f"https://open.feishu.cn/open-apis/bot/v2/hook/{token}",
-            json=json_data,
-        )
-        LOG.info(response.json())
-        return response.json()
+    with FEISHU_FILTER_SECONDS.time():
+        passed = await apply_filter_rule(data=json_data, token=token)
+    if passed and settings.feishu.digest_window > 0:
+        # 合并窗口内的告警，窗口结束时以汇总卡片发送
+        passed = await coalesce(token, json_data)
+        FEISHU_DIGEST_TOTAL.inc(result="forwarded" if passed else "coalesced")
+    if passed:
+        return await deliver(token, body)
     else:
-        return {'StatusCode': 0, 'StatusMessage': 'success', 'code': 0, 'data': {}, 'msg': 'success'}
+        return SUCCESS_RESPONSE
+
+
+async def run_digest_flusher():
+    """后台定期发送到期的告警汇总，各 worker 都运行，同一个汇总只会被一个 worker 认领"""
+    interval = min(1.0, settings.feishu.digest_window / 4)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            for token, card in await claim_due():
+                FEISHU_DIGEST_TOTAL.inc(result="digest")
+                result = await deliver(token, orjson.dumps(card))
+                if result.get("code"):
+                    LOG.warning(f"发送告警汇总失败 {token}: {result}")
+        except Exception as e:
+            LOG.warning(f"发送告警汇总失败: {e}")
 
 
 @feishu_router.post("/config/{token}")
@@ -137,29 +262,14 @@ async def configure_filter(token: str, rule: FilterRule):
     rule_data = json.dumps(rule.model_dump(exclude={"expires"}))
     # 计算 rule_id
     rule_id = hashlib.md5(rule_data.encode()).hexdigest()
-    rule_name = f"rules:{token}:{rule_id}"
     # 添加规则
-    await ASYNC_REDIS.set(
-        name=rule_name,
-        value=rule_data,
-        ex=rule.expires or None
-    )
+    await save_rule(token=token, rule_id=rule_id, rule_data=rule_data, expires=rule.expires)
     return {"rule_id": rule_id}
 
 
 @feishu_router.delete("/config/{token}")
 async def delete_filter(token: str, rule_id: Optional[str] = None):
-    """删除过滤规则"""
-    if rule_id is None:
-        # 删除所有规则
-        rule_names = await ASYNC_REDIS.keys(f"rules:{token}:*")
-        for rule_name in rule_names:
-            LOG.warning(f"删除规则 {rule_name}")
-            await ASYNC_REDIS.delete(rule_name)
-    else:
-        # 删除指定规则
-        rule_name = f"rules:{token}:{rule_id}"
-        LOG.warning(f"删除规则 {rule_name}")
-        await ASYNC_REDIS.delete(rule_name)
-
+    """删除过滤规则，不指定 rule_id 时删除所有规则"""
+    LOG.warning(f"删除规则 {token} {rule_id or '全部'}")
+    await delete_rules(token=token, rule_id=rule_id)
     return {"message": "success"}
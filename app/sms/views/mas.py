@@ -1,15 +1,26 @@
 import hashlib
 import json
+import secrets
+import time
+import uuid
 from dataclasses import dataclass
-from typing import Union, List, Dict
+from datetime import datetime
+from typing import Dict, List, Optional, Union
 
-from fastapi import APIRouter, HTTPException, Depends
+import orjson
+from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
+from starlette.requests import Request
 
+from app.sms.bulk import JOB_ID_PATTERN, BulkJob, iter_chunks, iter_lines, run_pipelined
 from cores.config import settings
+from cores.journal import JournalFull
 from cores.log import LOG
-from cores.redis import ASYNC_REDIS
+from cores.metrics import DEDUPE_TOTAL, SMS_ENQUEUE_MESSAGES, SMS_ENQUEUE_SECONDS
 from cores.security import verify_api_key
+from cores.sms_journal import REDIS_UNAVAILABLE, enqueue_or_spill
+from cores.sms_queue import make_queue, parse_lanes
+from cores.sms_status import ingest_reports, lookup, record_accepted
 
 mas_router = APIRouter()
 
@@ -18,29 +29,115 @@ mas_router = APIRouter()
 class SmsRequest(BaseModel):
     phone_numbers: Union[List[str], str]
     message: Union[Dict, str]
+    sign: str = ""  # 签名，默认使用配置中的签名
+    add_serial: str = ""  # 扩展码
+    priority: str = ""  # 优先级通道，如 otp、normal、bulk，默认 normal
+    send_at: Optional[datetime] = None  # 定时发送时间，不带时区时按服务器本地时间
+    delay: Optional[float] = None  # 延迟发送的秒数，与 send_at 二选一
+    room: str = ""  # Socket.IO 房间，短信状态变化时推送到该房间
+
+
+class StatusRequest(BaseModel):
+    ids: List[str]
 
 
 @dataclass
 class Message:
     phone_number: str
     message: str
+    sign: str = ""
+    add_serial: str = ""
+    priority: str = ""
+    room: str = ""
+
+
+# 单次查询状态的最多短信数
+MAX_STATUS_IDS = 1000
 
 
-async def enqueue_sms(messages: List[Message]):
-    for message in messages:
-        msg_hash = hashlib.md5(f"{message.phone_number}_{message.message}".encode()).hexdigest()
-        cache_key = f"mas:sms:{msg_hash}"
+def sms_payload(message: Message, message_id: str, ts: float, send_at: Optional[float]) -> str:
+    """
+    队列中的短信，只写入非空的可选字段
+    :param ts: 入队（或定时到期）时间，用于统计队列中最早短信的等待时间
+    """
+    sms_data = {
+        "id": message_id,
+        "phone_number": message.phone_number,
+        "message": message.message,
+        "ts": ts,
+    }
+    for name in ("sign", "add_serial", "priority", "room"):
+        if value := getattr(message, name):
+            sms_data[name] = value
+    if send_at is not None:
+        sms_data["send_at"] = send_at
+    return json.dumps(sms_data)
 
-        if not await ASYNC_REDIS.set(cache_key, "sent", ex=settings.rules.sms_same_message_interval, nx=True):
-            LOG.warning(f"相同短信 60 秒内不重复发送 {message = }")
-            continue
 
-        # 存入 Redis List
-        sms_data = {
-            "phone_number": message.phone_number,
-            "message": message.message
-        }
-        await ASYNC_REDIS.lpush("sms_queue", json.dumps(sms_data))
+async def enqueue_sms(
+    messages: List[Message], send_at: Optional[float] = None
+) -> List[Optional[str]]:
+    """
+    批量去重并入队，整个列表只需一次 Redis 往返，已入队的短信再用一次往返写入状态
+    :param messages:
+    :param send_at: 定时发送的时间戳，未到期的短信先放入定时集合
+    :return: 与 messages 一一对应，已入队时为短信 id，重复时为 None；Redis 不可用时写入本地日志，全部视为已接收
+    """
+    now = time.time()
+    if send_at is not None and send_at <= now:
+        send_at = None
+    ids = [uuid.uuid4().hex for _ in messages]
+    items = [
+        (
+            hashlib.md5(f"{message.phone_number}_{message.message}".encode()).hexdigest(),
+            sms_payload(message, message_id, send_at or now, send_at),
+        )
+        for message, message_id in zip(messages, ids)
+    ]
+
+    try:
+        results = await enqueue_or_spill(items, [message.priority for message in messages], send_at)
+    except JournalFull:
+        raise HTTPException(status_code=503, detail="Redis 不可用且本地日志已满，请稍后重试")
+    if results is None:
+        # 已写入本地日志
+        return ids
+
+    duplicates = [message for message, accepted in zip(messages, results) if not accepted]
+    DEDUPE_TOTAL.inc(len(duplicates), namespace="mas:sms", result="hit")
+    DEDUPE_TOTAL.inc(len(results) - len(duplicates), namespace="mas:sms", result="miss")
+    if duplicates:
+        LOG.warning(f"相同短信 60 秒内不重复发送 {len(duplicates)} 条: {duplicates[:10]}")
+
+    ids = [message_id if accepted else None for message_id, accepted in zip(ids, results)]
+    try:
+        await record_accepted(
+            [
+                (message_id, message.phone_number, message.room)
+                for message_id, message in zip(ids, messages)
+                if message_id
+            ],
+            send_at=send_at,
+        )
+    except REDIS_UNAVAILABLE as e:
+        # 短信已入队，状态记录失败不影响发送
+        LOG.warning(f"记录短信状态失败: {e}")
+    return ids
+
+
+def resolve_send_at(
+    priority: str, send_at: Optional[datetime], delay: Optional[float]
+) -> Optional[float]:
+    """校验优先级和定时参数，返回定时发送的时间戳"""
+    if priority and priority not in parse_lanes(settings.queue.lanes):
+        raise HTTPException(status_code=400, detail=f"未知的优先级: {priority}")
+    if send_at is not None and delay is not None:
+        raise HTTPException(status_code=400, detail="send_at 与 delay 不能同时指定")
+    if delay is not None:
+        if delay < 0:
+            raise HTTPException(status_code=400, detail="delay 不能为负数")
+        return time.time() + delay
+    return send_at.timestamp() if send_at is not None else None
 
 
 # 短信发送接口
@@ -51,6 +148,8 @@ async def send_sms(request: SmsRequest):
     if not request.phone_numbers or not request.message:
         raise HTTPException(status_code=400, detail="手机号或内容不能为空")
 
+    send_at = resolve_send_at(request.priority, request.send_at, request.delay)
+
     if isinstance(request.message, dict):
         request.phone_numbers = list(request.message.keys())
     if isinstance(request.phone_numbers, str):
@@ -61,12 +160,137 @@ async def send_sms(request: SmsRequest):
     messages = [
         Message(
             phone_number=phone_number.strip(),
-            message=request.message[phone_number]
+            message=request.message[phone_number],
+            sign=request.sign,
+            add_serial=request.add_serial,
+            priority=request.priority,
+            room=request.room,
         )
         for phone_number in request.phone_numbers
     ]
     LOG.info(f"短信发送列表: {messages}")
 
-    await enqueue_sms(messages)
+    with SMS_ENQUEUE_SECONDS.time():
+        ids = await enqueue_sms(messages, send_at=send_at)
+    SMS_ENQUEUE_MESSAGES.observe(len(messages))
+
+    accepted = len(ids) - ids.count(None)
+    return {
+        "message": "SMS sent successfully",
+        "accepted": accepted,
+        "duplicate": len(ids) - accepted,
+        "send_at": send_at,
+        "results": [
+            {
+                "phone_number": message.phone_number,
+                "id": message_id,
+                "status": "accepted" if message_id else "duplicate",
+            }
+            for message, message_id in zip(messages, ids)
+        ],
+    }
+
+
+@mas_router.post("/bulk", dependencies=[Depends(verify_api_key)])
+async def bulk_send(
+    request: Request,
+    message: str = "",
+    sign: str = "",
+    add_serial: str = "",
+    priority: str = "",
+    send_at: Optional[datetime] = None,
+    delay: Optional[float] = None,
+    job_id: str = "",
+    room: str = "",
+):
+    """
+    大批量发送：请求体为 NDJSON（可分块上传），每行一条短信，查询参数为各行的默认值
+    边接收边解析，每 bulk_chunk_size 条去重入队一次，入队与解析下一批并行；进度可通过 GET /mas/bulk/{job_id} 查询
+    """
+    send_at = resolve_send_at(priority, send_at, delay)
+    if job_id and not JOB_ID_PATTERN.match(job_id):
+        raise HTTPException(
+            status_code=400, detail="job_id 只能包含字母、数字、- 和 _，最长 64 个字符"
+        )
+    job = BulkJob(job_id or uuid.uuid4().hex, send_at=send_at)
+    if not await job.create():
+        raise HTTPException(status_code=409, detail=f"任务已存在: {job.id}")
+    LOG.info(f"批量短信任务 {job.id} 开始")
+
+    defaults = {
+        "message": message,
+        "sign": sign,
+        "add_serial": add_serial,
+        "priority": priority,
+        "room": room,
+    }
+    lanes = parse_lanes(settings.queue.lanes)
+
+    async def enqueue_chunk(chunk: List[dict]):
+        messages = [Message(**fields) for fields in chunk]
+        with SMS_ENQUEUE_SECONDS.time():
+            ids = await enqueue_sms(messages, send_at=send_at)
+        SMS_ENQUEUE_MESSAGES.observe(len(messages))
+        duplicate = ids.count(None)
+        job.counts["accepted"] += len(ids) - duplicate
+        job.counts["duplicate"] += duplicate
+        await job.save("running")
+
+    lines = iter_lines(request.stream())
+    try:
+        chunks = iter_chunks(lines, job, defaults, lanes, settings.queue.bulk_chunk_size)
+        await run_pipelined(chunks, enqueue_chunk)
+    except BaseException:
+        await job.save("failed")
+        LOG.error(f"批量短信任务 {job.id} 中断: {job.counts}")
+        raise
+
+    LOG.info(f"批量短信任务 {job.id} 完成: {job.counts}")
+    return await job.save("done")
+
+
+@mas_router.get("/bulk/{job_id}", dependencies=[Depends(verify_api_key)])
+async def bulk_status(job_id: str):
+    """批量发送任务的进度"""
+    if not (job := await BulkJob.load(job_id)):
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return job
+
+
+@mas_router.post("/status", dependencies=[Depends(verify_api_key)])
+async def sms_status(request: StatusRequest):
+    """批量查询短信状态，返回 {id: 状态记录}，不存在或已过期的为 null"""
+    if len(request.ids) > MAX_STATUS_IDS:
+        raise HTTPException(status_code=400, detail=f"单次最多查询 {MAX_STATUS_IDS} 条")
+    return await lookup(request.ids)
+
+
+@mas_router.post("/report/{token}")
+async def mas_report(token: str, request: Request):
+    """
+    接收 MAS 状态报告推送，请求体为单条报告或报告列表；MAS 不支持自定义请求头，使用路径中的 token 鉴权
+    整批报告两次 Redis 往返写入
+    """
+    if not settings.status.report_token or not secrets.compare_digest(
+        token, settings.status.report_token
+    ):
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        reports = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="请求体不是合法的 JSON")
+    if isinstance(reports, dict):
+        reports = [reports]
+    if not isinstance(reports, list) or not all(isinstance(report, dict) for report in reports):
+        raise HTTPException(status_code=400, detail="请求体应为状态报告或状态报告列表")
+
+    counts = await ingest_reports(reports)
+    if counts["unmatched"]:
+        LOG.warning(f"状态报告找不到对应短信 {counts['unmatched']} 条")
+    return {"success": True, **counts}
+
 
-    return {"message": "SMS sent successfully"}
+@mas_router.get("/queue", dependencies=[Depends(verify_api_key)])
+async def queue_stats():
+    """各优先级通道的队列长度、待重试、死信及各消费者的积压情况"""
+    return await make_queue().stats()
@@ -1,15 +1,76 @@
+from typing import List, Tuple
+
+import orjson
 from fastapi import APIRouter, HTTPException
+from pydantic import ValidationError
+from starlette.requests import Request
 
 from cores.constant.socket import WsMessage
-from cores.sio import sio
+from cores.emitter import EMITTER
 
 message_router = APIRouter()
 
+# 批量接口单次最多消息数
+MAX_BATCH = 10000
+
 
 @message_router.post("/message_proxy")
 async def send_message(message: WsMessage):
     try:
-        await sio.emit(event=message.event, data=message.data, room=message.room)
+        await EMITTER.emit(event=message.event, data=message.data, room=message.room)
         return {"status": "success", "message": "消息已发送"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+async def read_batch(request: Request) -> list:
+    """读取批量请求体，不是消息列表或超过单次上限时返回 400"""
+    try:
+        items = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="请求体不是合法的 JSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="请求体应为消息列表")
+    if len(items) > MAX_BATCH:
+        raise HTTPException(status_code=400, detail=f"单次最多 {MAX_BATCH} 条消息")
+    return items
+
+
+def validate_batch(items: list) -> Tuple[List[dict], List[int], List[tuple]]:
+    """
+    逐条校验消息
+    :return: (与 items 一一对应的结果, 有效消息的下标, 有效消息的 (事件, 数据, 房间))
+    """
+    results, valid, emits = [], [], []
+    for index, item in enumerate(items):
+        try:
+            message = WsMessage.model_validate(item)
+        except ValidationError as e:
+            errors = e.errors(include_url=False, include_context=False, include_input=False)
+            results.append({"status": "invalid", "error": errors})
+            continue
+        results.append({"status": "published"})
+        valid.append(index)
+        emits.append((message.event, message.data, message.room))
+    return results, valid, emits
+
+
+@message_router.post("/message_proxy/batch")
+async def send_messages(request: Request, coalesce: bool = True):
+    """
+    批量转发：请求体为 WsMessage 列表，逐条校验，有效的消息在一次 Redis 往返内发布
+    coalesce 为 true 时事件和数据相同、发往不同房间的消息合并为一次发布
+    """
+    results, valid, emits = validate_batch(await read_batch(request))
+    try:
+        errors, publishes = await EMITTER.emit_many(emits, coalesce=coalesce)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    for index, error in zip(valid, errors):
+        if error:
+            results[index] = {"status": "failed", "error": error}
+
+    counts = {"published": 0, "invalid": 0, "failed": 0}
+    for result in results:
+        counts[result["status"]] += 1
+    return {"status": "success", **counts, "publishes": publishes, "results": results}
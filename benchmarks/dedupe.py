@@ -0,0 +1,101 @@
+"""
+重复消息过滤基准
+
+对比 key / hash / bloom 三种去重方式写入 N 条不同消息后的 Redis 内存、key 数量、吞吐和误判数，
+在 config.ini 配置的 Redis 上运行（需真实 Redis，内存取自 INFO memory），使用 benchmark: 前缀的 key，结束后清理：
+    python -m benchmarks.dedupe --messages 1000000 --fp-rate 0.001
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+
+from cores.config import DedupeConfig
+from cores.dedupe import Deduper
+from cores.redis import ASYNC_REDIS
+
+PIPELINE_SIZE = 1000
+
+
+async def used_memory() -> int:
+    info = await ASYNC_REDIS.info("memory")
+    return int(info.get("used_memory", 0))
+
+
+async def cleanup(namespace: str):
+    for pattern in (f"{namespace}:*", f"dedupe:{namespace}:*"):
+        keys = []
+        async for key in ASYNC_REDIS.scan_iter(match=pattern, count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                await ASYNC_REDIS.unlink(*keys)
+                keys = []
+        if keys:
+            await ASYNC_REDIS.unlink(*keys)
+
+
+async def check(deduper: Deduper, digests) -> int:
+    """批量检查，返回判为首次出现的数量"""
+    new = 0
+    for start in range(0, len(digests), PIPELINE_SIZE):
+        async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+            for digest in digests[start : start + PIPELINE_SIZE]:
+                await deduper.is_new(digest, client=pipe)
+            new += sum(is_new for is_new, _ in await pipe.execute())
+    return new
+
+
+async def run(backend: str, messages: int, ttl: int, fp_rate: float, shards: int) -> dict:
+    namespace = f"benchmark:dedupe:{backend}"
+    deduper = Deduper(
+        namespace,
+        ttl,
+        DedupeConfig(backend=backend, capacity=messages, fp_rate=fp_rate, shards=shards),
+    )
+    marker = uuid.uuid4().hex
+    digests = [hashlib.md5(f"{marker}:{i}".encode()).hexdigest() for i in range(messages)]
+
+    await cleanup(namespace)
+    memory_before, keys_before = await used_memory(), await ASYNC_REDIS.dbsize()
+    start = time.perf_counter()
+    new = await check(deduper, digests)
+    elapsed = time.perf_counter() - start
+    memory = await used_memory() - memory_before
+    keys = await ASYNC_REDIS.dbsize() - keys_before
+
+    # 重复提交前 1% 的消息，应全部判为重复
+    replayed = digests[: max(1, messages // 100)]
+    missed = await check(deduper, replayed)
+    await cleanup(namespace)
+
+    return {
+        "backend": backend,
+        "messages": messages,
+        "ops_per_s": round(messages / elapsed, 1),
+        "memory_bytes": memory,
+        "bytes_per_message": round(memory / messages, 2),
+        "keys": keys,
+        "false_positives": messages - new,
+        "false_positive_rate": round((messages - new) / messages, 6),
+        "missed_duplicates": missed,
+    }
+
+
+async def main(args):
+    for backend in args.backends:
+        print(json.dumps(await run(backend, args.messages, args.ttl, args.fp_rate, args.shards)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--ttl", type=int, default=60)
+    parser.add_argument("--fp-rate", type=float, default=0.001)
+    parser.add_argument("--shards", type=int, default=8192)
+    parser.add_argument("--backends", nargs="+", default=["key", "hash", "bloom"])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,79 @@
+"""
+飞书转发事件循环延迟基准
+
+对比旧的阻塞 requests.post 与共享 httpx 连接池在并发转发时对事件循环的影响：
+    python -m benchmarks.feishu_forward --requests 200 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import requests
+
+from benchmarks.stubs import StubBehavior, StubServer, feishu_stub_app
+from cores.http import FEISHU_LIMIT, close_http_clients, get_http_client
+
+PAYLOAD = {"msg_type": "text", "content": {"text": "benchmark"}}
+
+
+async def blocking_forward(url: str):
+    requests.post(url=url, json=PAYLOAD)
+
+
+async def pooled_forward(url: str):
+    async with FEISHU_LIMIT:
+        response = await get_http_client().post(url=url, json=PAYLOAD)
+    response.json()
+
+
+async def monitor_loop(lags: list, stop: asyncio.Event, interval: float = 0.005):
+    """记录事件循环的调度延迟"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(mode: str, url: str, total: int) -> dict:
+    forward = blocking_forward if mode == "blocking" else pooled_forward
+    lags, stop = [], asyncio.Event()
+    monitor = asyncio.create_task(monitor_loop(lags, stop))
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(forward(url) for _ in range(total)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await monitor
+    await close_http_clients()
+    lags.sort()
+    return {
+        "mode": mode,
+        "requests": total,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 1),
+        "loop_lag_p50_ms": round(statistics.median(lags) * 1000, 2),
+        "loop_lag_p99_ms": round(lags[int(len(lags) * 0.99)] * 1000, 2),
+        "loop_lag_max_ms": round(lags[-1] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="桩服务响应延迟（秒）")
+    parser.add_argument("--modes", nargs="+", default=["blocking", "pooled"])
+    args = parser.parse_args()
+
+    with StubServer(feishu_stub_app(StubBehavior(latency=args.latency))) as server:
+        url = f"{server.base_url}/open-apis/bot/v2/hook/benchmark"
+        for mode in args.modes:
+            print(json.dumps(asyncio.run(run(mode, url, args.requests))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+飞书请求体处理基准
+
+对比大交互卡片在 /feishu/send 热路径上的旧处理方式（json 解析、递归查找 content、json.dumps 后计算摘要、转发前重新序列化）
+与当前方式（orjson 解析、按 JSON 路径迭代取值、增量计算摘要、原样转发请求体），不访问 Redis 和网络：
+    python -m benchmarks.feishu_payload --elements 200 --iterations 2000
+"""
+
+import argparse
+import hashlib
+import json
+import time
+
+import orjson
+
+from app.sms.views.feishu import CONTENT_PATHS, content_digest, extract_values
+
+
+def build_card(elements: int) -> dict:
+    """构造带多列、多层嵌套的告警交互卡片"""
+    return {
+        "msg_type": "interactive",
+        "card": {
+            "config": {"wide_screen_mode": True},
+            "header": {
+                "template": "red",
+                "title": {"tag": "plain_text", "content": "【P1】订单服务错误率升高"},
+            },
+            "elements": [
+                {
+                    "tag": "column_set",
+                    "columns": [
+                        {
+                            "tag": "column",
+                            "elements": [
+                                {
+                                    "tag": "div",
+                                    "text": {
+                                        "tag": "lark_md",
+                                        "content": f"**指标 {i}**：error_rate = {i * 0.013:.3f}",
+                                    },
+                                },
+                                {
+                                    "tag": "div",
+                                    "text": {
+                                        "tag": "lark_md",
+                                        "content": f"实例 order-{i}.prod 延迟 {i * 7} ms",
+                                    },
+                                },
+                            ],
+                        },
+                        {
+                            "tag": "column",
+                            "elements": [
+                                {
+                                    "tag": "markdown",
+                                    "content": f"[查看详情](https://grafana.example.com/d/{i})",
+                                }
+                            ],
+                        },
+                    ],
+                }
+                for i in range(elements)
+            ]
+            + [
+                {
+                    "tag": "note",
+                    "elements": [{"tag": "plain_text", "content": "告警时间 2024-01-01 00:00:00"}],
+                }
+            ],
+        },
+    }
+
+
+def legacy_search_value(data, key: str):
+    """旧版递归查找（带非字符串判断，否则在非字符串 content 上出错）"""
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k == key and isinstance(v, str) and len(v.strip()) > 0:
+                yield v
+            else:
+                yield from legacy_search_value(v, key)
+    elif isinstance(data, list):
+        for item in data:
+            yield from legacy_search_value(item, key)
+
+
+def legacy(body: bytes):
+    data = json.loads(body)
+    repr(data)  # 旧版日志输出整个 dict
+    contents = [
+        content for content in legacy_search_value(data, "content") if "时间" not in content
+    ]
+    digest = hashlib.md5(json.dumps(contents).encode()).hexdigest()
+    forwarded = json.dumps(data).encode()
+    return digest, forwarded
+
+
+def current(body: bytes):
+    data = orjson.loads(body)
+    body[:1024].decode(errors="replace")  # 日志只记录前 1024 字节
+    contents = [content for content in extract_values(data, CONTENT_PATHS) if "时间" not in content]
+    digest = content_digest(contents)
+    return digest, body
+
+
+def measure(func, body: bytes, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(body)
+    return (time.perf_counter() - start) / iterations
+
+
+def main(args):
+    body = orjson.dumps(build_card(args.elements))
+    # 卡片中的 text 字段都是对象，两种方式取出的内容一致
+    data = json.loads(body)
+    assert list(legacy_search_value(data, "content")) == list(extract_values(data, CONTENT_PATHS))
+
+    results = {
+        name: measure(func, body, args.iterations)
+        for name, func in (("legacy", legacy), ("current", current))
+    }
+    for name, seconds in results.items():
+        print(
+            json.dumps(
+                {
+                    "mode": name,
+                    "elements": args.elements,
+                    "body_bytes": len(body),
+                    "us_per_request": round(seconds * 1e6, 1),
+                }
+            )
+        )
+    print(json.dumps({"speedup": round(results["legacy"] / results["current"], 2)}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--elements", type=int, default=200, help="卡片中的分栏数")
+    parser.add_argument("--iterations", type=int, default=2000)
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+"""
+本地日志写入吞吐基准
+
+在临时目录中对比 Redis 不可用时短信写入本地日志（cores.journal）的两种提交方式，不需要 Redis：
+- fsync：fsync_interval = 0，每次写入单独 fsync
+- group：fsync_interval 内的并发写入共用一次 fsync（组提交）
+每次写入 --batches 条记录（对应一次 /mas/send 的短信数），--concurrency 个并发请求持续写入：
+    python -m benchmarks.journal --sizes 256 1024 --batches 1 100 --concurrency 1 64
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from cores.journal import Journal, list_segments, read_records
+
+
+async def run(size: int, batch: int, concurrency: int, fsync_interval: float, records: int) -> dict:
+    payloads = [os.urandom(size // 2).hex().encode()] * batch
+    writes = max(records // batch, concurrency)
+    latencies = []
+
+    with tempfile.TemporaryDirectory() as root:
+        journal = Journal(
+            root, max_bytes=1 << 40, segment_bytes=16 * 1024 * 1024, fsync_interval=fsync_interval
+        )
+        queue = asyncio.Queue()
+        for _ in range(writes):
+            queue.put_nowait(None)
+
+        async def writer():
+            while not queue.empty():
+                queue.get_nowait()
+                start = time.perf_counter()
+                await journal.append(payloads)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(writer() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+        # 确认全部记录可以读回
+        written = sum(1 for path in list_segments(journal.directory) for _ in read_records(path))
+        journal.close()
+
+    latencies.sort()
+    return {
+        "mode": "fsync" if fsync_interval <= 0 else "group",
+        "size": size,
+        "batch": batch,
+        "concurrency": concurrency,
+        "records": written,
+        "records_per_s": round(written / elapsed, 1),
+        "mb_per_s": round(written * size / elapsed / 1024 / 1024, 2),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+    }
+
+
+async def main(args):
+    for size in args.sizes:
+        for batch in args.batches:
+            for concurrency in args.concurrency:
+                for fsync_interval in (0, args.fsync_interval):
+                    print(
+                        json.dumps(
+                            await run(size, batch, concurrency, fsync_interval, args.records)
+                        )
+                    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[256, 1024], help="每条记录的字节数"
+    )
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 100], help="每次写入的记录数")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 64], help="并发写入数")
+    parser.add_argument("--fsync-interval", type=float, default=0.005, help="组提交间隔（秒）")
+    parser.add_argument("--records", type=int, default=20000, help="每组写入的总记录数")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,313 @@
+"""
+负载测试
+
+按场景文件启动本地飞书、MAS 桩服务和应用（或 MasTask / MasConsumer 消费者），输出吞吐和延迟分位数的 JSON 报告。
+应用和消费者使用 config.ini 中的 Redis，请通过 CONFIG_FILE_PATH 指向单独的 Redis 库：
+    python -m benchmarks.load benchmarks/scenarios/*.json --output report.json
+    python -m benchmarks.load benchmarks/scenarios/*.json --baseline report.json --tolerance 0.2
+
+每个场景在独立的子进程中运行，场景中的 settings 会在导入应用之前覆盖对应的配置项。
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from typing import List
+
+import httpx
+
+from benchmarks.stubs import StubBehavior, StubServer, feishu_stub_app, mas_stub_app
+from cores.config import settings
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    最近秩法分位数
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 0.5)
+    5
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 0.99)
+    10
+    >>> percentile([], 0.5)
+    0.0
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(len(values) * q + 0.999999) - 1))]
+
+
+def summarize(
+    scenario: dict, latencies: List[float], statuses: Counter, elapsed: float, behaviors: dict
+) -> dict:
+    total = sum(statuses.values())
+    return {
+        "scenario": scenario["name"],
+        "target": scenario["target"],
+        "requests": total,
+        "concurrency": scenario.get("concurrency", 1),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(total / elapsed, 1) if elapsed else 0.0,
+        "errors": sum(n for status, n in statuses.items() if status != "200"),
+        "status": dict(statuses),
+        "latency_ms": {
+            name: round(percentile(latencies, q) * 1000, 3)
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))
+        },
+        "stub": {name: dict(behavior.counts) for name, behavior in behaviors.items()},
+    }
+
+
+def build_request(target: str, params: dict):
+    """返回 (方法, 路径, 请求体, 请求头)，每次内容不同，避免命中去重"""
+    marker = uuid.uuid4().hex
+    if target == "mas_send":
+        recipients = params.get("recipients", 1)
+        return (
+            "POST",
+            "/mas/send",
+            {
+                "phone_numbers": [f"139{i:08d}" for i in range(recipients)],
+                "message": f"benchmark {marker}",
+            },
+            {"x-api-key": settings.security.api_key},
+        )
+    if target == "feishu_send":
+        card = {
+            "elements": [
+                {"tag": "div", "text": {"tag": "lark_md", "content": f"benchmark {marker}"}}
+            ]
+        }
+        return (
+            "POST",
+            f"/feishu/send/{params.get('token', 'benchmark')}",
+            {"msg_type": "interactive", "card": card},
+            {},
+        )
+    if target == "message_proxy":
+        return (
+            "POST",
+            "/message_proxy",
+            {"event": "notify_message", "data": {"id": marker}, "room": params.get("room")},
+            {},
+        )
+    if target == "message_proxy_batch":
+        # 同一条通知发往 batch 个房间
+        rooms = params.get("batch", 100)
+        body = [
+            {"event": "notify_message", "data": {"id": marker}, "room": f"benchmark:{i}"}
+            for i in range(rooms)
+        ]
+        return (
+            "POST",
+            f"/message_proxy/batch?coalesce={str(params.get('coalesce', True)).lower()}",
+            body,
+            {},
+        )
+    raise ValueError(f"未知的压测目标: {target}")
+
+
+async def drive_http(scenario: dict, base_url: str):
+    """按并发数持续发送请求，直到达到总请求数"""
+    target, params = scenario["target"], scenario.get("params", {})
+    remaining = scenario.get("requests", 1000)
+    latencies, statuses = [], Counter()
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            method, path, body, headers = build_request(target, params)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body, headers=headers)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+
+    limits = httpx.Limits(max_connections=scenario.get("concurrency", 1))
+    async with httpx.AsyncClient(
+        base_url=f"{base_url}{settings.app.api_version}", limits=limits, timeout=30
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(scenario.get("concurrency", 1))))
+        return latencies, statuses, time.perf_counter() - start
+
+
+async def drive_consumer(scenario: dict):
+    """
+    预先入队短信，再运行消费者直到所有通道清空
+    params.lanes 为各优先级通道的短信数，按给定顺序入队（如先入队大批量群发，再入队验证码），
+    默认 requests 条全部进入默认通道
+    consumer_mode 为 poll 时直接调用 MasTask（跳过 5 秒调度间隔），blocking 时调用 MasConsumer
+    延迟为每次消费调用（取批 + 提交 + 确认）的耗时，lane_drained_s 为各通道从开始消费到清空的时间
+    """
+    from app.sms.views.mas import Message, enqueue_sms
+    from cores.redis import REDIS
+    from cores.sms_queue import SMS_QUEUE_KEY, lane_key
+    from crontabs.task import MasConsumer, MasTask
+
+    lanes = scenario.get("params", {}).get("lanes") or {
+        settings.queue.default_lane: scenario.get("requests", 1000)
+    }
+    marker = uuid.uuid4().hex
+    for lane, count in lanes.items():
+        await enqueue_sms(
+            [
+                Message(
+                    phone_number=f"139{i:08d}", message=f"benchmark {lane} {marker}", priority=lane
+                )
+                for i in range(count)
+            ]
+        )
+
+    latencies, statuses, drained = [], Counter(), {}
+    blocking = settings.queue.consumer_mode == "blocking"
+    consumer = MasConsumer() if blocking else MasTask()
+    if blocking:
+        await consumer.async_init()
+
+    async def backlog() -> dict:
+        if not blocking:
+            return {lane: REDIS.llen(lane_key(SMS_QUEUE_KEY, lane)) for lane in lanes}
+        # 待重试、未确认的短信也算作积压
+        stats = (await consumer.queue.stats())["lanes"]
+        names = ("lag", "pending") if settings.queue.backend == "stream" else ("length", "delayed")
+        return {lane: sum(stats[lane].get(name) or 0 for name in names) for lane in lanes}
+
+    start = time.perf_counter()
+    while True:
+        for lane, remaining in (await backlog()).items():
+            if not remaining and lane not in drained:
+                drained[lane] = round(time.perf_counter() - start, 3)
+        if len(drained) == len(lanes):
+            break
+        call_start = time.perf_counter()
+        if blocking:
+            sent = await consumer()
+            statuses["200" if sent is not None else "error"] += 1
+        else:
+            # MasTask 的异常由 BaseScript 告警后吞掉，失败次数见 MAS 桩服务的 error 计数
+            consumer()
+            statuses["200"] += 1
+        latencies.append(time.perf_counter() - call_start)
+    return latencies, statuses, time.perf_counter() - start, drained
+
+
+def apply_settings(overrides: dict):
+    for section, values in overrides.items():
+        for name, value in values.items():
+            setattr(getattr(settings, section), name, value)
+
+
+def run_scenario(scenario: dict, base_url: str = None) -> dict:
+    apply_settings(scenario.get("settings", {}))
+    behaviors = {
+        "feishu": StubBehavior(**scenario.get("feishu_stub", {})),
+        "mas": StubBehavior(**scenario.get("mas_stub", {})),
+    }
+    with StubServer(feishu_stub_app(behaviors["feishu"])) as feishu, StubServer(
+        mas_stub_app(behaviors["mas"])
+    ) as mas:
+        # 必须在导入应用模块之前替换供应商地址，MasSMS 等单例在导入时读取配置
+        settings.feishu.hook_base_url = f"{feishu.base_url}/open-apis/bot/v2/hook"
+        settings.feishu.webhook_url = f"{settings.feishu.hook_base_url}/alarm"
+        settings.mas.api_url = f"{mas.base_url}/sms/norsubmit"
+
+        drained = None
+        if scenario["target"] == "mas_consumer":
+            latencies, statuses, elapsed, drained = asyncio.run(drive_consumer(scenario))
+        elif base_url:
+            latencies, statuses, elapsed = asyncio.run(drive_http(scenario, base_url))
+        else:
+            from cores.fastapi_app import make_app
+
+            with StubServer(make_app()) as app:
+                latencies, statuses, elapsed = asyncio.run(drive_http(scenario, app.base_url))
+
+    report = summarize(scenario, latencies, statuses, elapsed, behaviors)
+    if scenario["target"] == "mas_consumer":
+        # 消费者场景的吞吐按成功提交的短信数计算，延迟为每批的耗时
+        report["batches"] = report["requests"]
+        report["requests"] = sum(
+            scenario.get("params", {}).get("lanes", {}).values()
+        ) or scenario.get("requests", 1000)
+        report["lane_drained_s"] = drained
+        report["throughput_per_s"] = (
+            round(behaviors["mas"].counts["mobiles"] / elapsed, 1) if elapsed else 0.0
+        )
+    return report
+
+
+def compare(reports: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    """
+    与上一次的报告对比，吞吐下降或 p99 上升超过 tolerance 视为退化
+    >>> compare([{"scenario": "a", "throughput_per_s": 80, "latency_ms": {"p99": 10}}],
+    ...         [{"scenario": "a", "throughput_per_s": 100, "latency_ms": {"p99": 10}}], 0.1)
+    ['a: throughput_per_s 100 -> 80']
+    >>> compare([{"scenario": "a", "throughput_per_s": 95, "latency_ms": {"p99": 10.5}}],
+    ...         [{"scenario": "a", "throughput_per_s": 100, "latency_ms": {"p99": 10}}], 0.1)
+    []
+    """
+    previous = {report["scenario"]: report for report in baseline}
+    regressions = []
+    for report in reports:
+        if not (base := previous.get(report["scenario"])):
+            continue
+        if report["throughput_per_s"] < base["throughput_per_s"] * (1 - tolerance):
+            regressions.append(
+                f"{report['scenario']}: throughput_per_s "
+                f"{base['throughput_per_s']} -> {report['throughput_per_s']}"
+            )
+        if report["latency_ms"]["p99"] > base["latency_ms"]["p99"] * (1 + tolerance):
+            regressions.append(
+                f"{report['scenario']}: latency p99 "
+                f"{base['latency_ms']['p99']} -> {report['latency_ms']['p99']}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("scenarios", nargs="+", help="场景 JSON 文件")
+    parser.add_argument("--base-url", help="压测已部署的服务，而不是在进程内启动应用")
+    parser.add_argument("--output", help="将报告写入 JSON 文件")
+    parser.add_argument("--baseline", help="上一次的报告，用于发现性能退化")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的退化比例")
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        with open(args.scenarios[0]) as f:
+            print(json.dumps(run_scenario(json.load(f), args.base_url)))
+        return
+
+    reports = []
+    for path in args.scenarios:
+        command = [sys.executable, "-m", "benchmarks.load", "--run", path]
+        if args.base_url:
+            command += ["--base-url", args.base_url]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        reports.append(json.loads(output.strip().splitlines()[-1]))
+        print(json.dumps(reports[-1]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if regressions := compare(reports, json.load(f), args.tolerance):
+                print("\n".join(regressions), file=sys.stderr)
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
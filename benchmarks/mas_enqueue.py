@@ -0,0 +1,85 @@
+"""
+/mas/send 入队基准
+
+对比逐条 SET NX + LPUSH 与单次往返的批量脚本入队，在 config.ini 配置的 Redis 上运行，
+使用 benchmark: 前缀的 key，结束后清理队列：
+    python -m benchmarks.mas_enqueue --recipients 1 100 1000 --requests 50
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import statistics
+import time
+import uuid
+
+from cores.dedupe import Deduper
+from cores.redis import ASYNC_REDIS
+from cores.sms_queue import enqueue
+
+QUEUE = "benchmark:sms_queue"
+TTL = 10
+
+
+DEDUPER = Deduper("benchmark:mas:sms", TTL)
+
+
+def build_items(recipients: int):
+    content = uuid.uuid4().hex
+    return [
+        (
+            hashlib.md5(f"{content}:{i}".encode()).hexdigest(),
+            json.dumps({"phone_number": f"138{i:08d}", "message": content}),
+        )
+        for i in range(recipients)
+    ]
+
+
+async def sequential_enqueue(items):
+    """旧实现：每条短信两次往返"""
+    for digest, sms_data in items:
+        if not await ASYNC_REDIS.set(f"{DEDUPER.namespace}:{digest}", "sent", ex=TTL, nx=True):
+            continue
+        await ASYNC_REDIS.lpush(QUEUE, sms_data)
+
+
+async def pipelined_enqueue(items):
+    await enqueue(items, deduper=DEDUPER, backend="list", queue=QUEUE)
+
+
+async def run(mode: str, recipients: int, total: int) -> dict:
+    method = sequential_enqueue if mode == "sequential" else pipelined_enqueue
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(total):
+        items = build_items(recipients)
+        request_start = time.perf_counter()
+        await method(items)
+        latencies.append(time.perf_counter() - request_start)
+    elapsed = time.perf_counter() - start
+    await ASYNC_REDIS.delete(QUEUE)
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "recipients": recipients,
+        "requests": total,
+        "requests_per_s": round(total / elapsed, 1),
+        "latency_p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "latency_p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    }
+
+
+async def main(args):
+    for recipients in args.recipients:
+        for mode in args.modes:
+            print(json.dumps(await run(mode, recipients, args.requests)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--recipients", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--modes", nargs="+", default=["sequential", "pipelined"])
+    asyncio.run(main(parser.parse_args()))
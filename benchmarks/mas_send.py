@@ -0,0 +1,81 @@
+"""
+MAS 提交吞吐基准
+
+对比同步客户端逐批提交（每次新建连接）与异步连接池 send_many 并行提交，使用本地 MAS 桩服务：
+    python -m benchmarks.mas_send --batches 200 --latency 0.05 --concurrency 1 4 8
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.stubs import StubBehavior, StubServer, mas_stub_app
+from cores.config import settings
+from cores.http import close_http_clients
+from cores.sms import AsyncCMCCMasSMS, CMCCMasSMS, SmsBatch
+
+
+def make_batches(total: int):
+    return [SmsBatch(mobiles=[f"138{i:08d}"], content=f"benchmark {i}") for i in range(total)]
+
+
+def run_sync(api_url: str, total: int) -> dict:
+    client = CMCCMasSMS(
+        settings.mas.app_id,
+        settings.mas.secret_key,
+        settings.mas.ec_name,
+        api_url,
+        settings.mas.sign,
+    )
+    start = time.perf_counter()
+    for batch in make_batches(total):
+        client.send_sms(batch.mobiles, batch.content)
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": "sync",
+        "batches": total,
+        "elapsed_s": round(elapsed, 3),
+        "batches_per_s": round(total / elapsed, 1),
+    }
+
+
+async def run_async(api_url: str, total: int, concurrency: int) -> dict:
+    client = AsyncCMCCMasSMS(
+        settings.mas.app_id,
+        settings.mas.secret_key,
+        settings.mas.ec_name,
+        api_url,
+        settings.mas.sign,
+        concurrency=concurrency,
+    )
+    start = time.perf_counter()
+    results = await client.send_many(make_batches(total))
+    elapsed = time.perf_counter() - start
+    await close_http_clients()
+    return {
+        "mode": "async",
+        "concurrency": concurrency,
+        "batches": total,
+        "failed": sum(not result.success for result in results),
+        "elapsed_s": round(elapsed, 3),
+        "batches_per_s": round(total / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="桩服务响应延迟（秒）")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    with StubServer(mas_stub_app(StubBehavior(latency=args.latency))) as server:
+        api_url = f"{server.base_url}/sms/norsubmit"
+        print(json.dumps(run_sync(api_url, args.batches)))
+        for concurrency in args.concurrency:
+            print(json.dumps(asyncio.run(run_async(api_url, args.batches, concurrency))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+多供应商路由基准
+
+在本地启动两个 MAS 桩服务（primary、secondary），对比三种方式，不需要 Redis：
+- single：只使用 primary，与改动前相同
+- routed：两个供应商，按 EWMA 延迟和错误率选择，失败时换下一个，连续失败时熔断
+- hedged：在 routed 的基础上每批都按验证码对冲
+primary 的错误率和长尾延迟可调；--outage-after 秒后 primary 全部返回失败，观察熔断。
+输出成功率、每批耗时的 p50 / p99、各供应商收到的请求数和结束时的熔断状态：
+    python -m benchmarks.routing --batches 2000 --concurrency 16 \
+        --error-rate 0.2 --slow-rate 0.05 --slow-latency 1.0
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import time
+
+from benchmarks.stubs import StubBehavior, StubServer, mas_stub_app
+from cores.config import settings
+from cores.http import close_http_clients
+from cores.providers import ProviderRouter
+from cores.sms import AsyncCMCCMasSMS, CMCCMasSMS, MasProvider, SmsBatch
+
+
+def make_provider(name: str, base_url: str, concurrency: int) -> MasProvider:
+    mas = settings.mas
+    api_url = f"{base_url}/sms/norsubmit"
+    client = AsyncCMCCMasSMS(
+        mas.app_id, mas.secret_key, mas.ec_name, api_url, mas.sign, concurrency=concurrency
+    )
+    return MasProvider(
+        name, client, CMCCMasSMS(mas.app_id, mas.secret_key, mas.ec_name, api_url, mas.sign)
+    )
+
+
+async def run(mode: str, servers: dict, behaviors: dict, args) -> dict:
+    names = ["primary"] if mode == "single" else ["primary", "secondary"]
+    providers = [make_provider(name, servers[name].base_url, args.concurrency) for name in names]
+    config = dataclasses.replace(
+        settings.routing, hedge_delay=args.hedge_delay, breaker_cooldown=args.cooldown
+    )
+    router = ProviderRouter(f"benchmark_{mode}", providers, config)
+
+    behaviors["primary"].error_rate = args.error_rate
+    for behavior in behaviors.values():
+        behavior.counts.clear()
+
+    async def outage():
+        await asyncio.sleep(args.outage_after)
+        behaviors["primary"].error_rate = 1.0
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, succeeded = [], 0
+
+    async def send(i: int):
+        nonlocal succeeded
+        async with semaphore:
+            start = time.perf_counter()
+            result = await router.send(
+                SmsBatch(mobiles=[f"138{i:08d}"], content=f"benchmark {i}"), hedge=mode == "hedged"
+            )
+            latencies.append(time.perf_counter() - start)
+            succeeded += result.success
+
+    outage_task = asyncio.create_task(outage()) if args.outage_after else None
+    start = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(args.batches)))
+    elapsed = time.perf_counter() - start
+    if outage_task:
+        outage_task.cancel()
+    # 对冲后未取用的提交完成后再关闭连接池
+    await asyncio.gather(*router.background, return_exceptions=True)
+    await close_http_clients()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "batches": args.batches,
+        "success_rate": round(succeeded / args.batches, 4),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 1),
+        "elapsed_s": round(elapsed, 3),
+        "requests": {name: behaviors[name].counts["requests"] for name in names},
+        "breaker": {name: router.health[name].state for name in names},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--batches", type=int, default=2000, help="每种方式提交的批次数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.02, help="primary 的响应延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.2, help="primary 返回失败的比例")
+    parser.add_argument("--slow-rate", type=float, default=0.05, help="primary 变慢的请求比例")
+    parser.add_argument(
+        "--slow-latency", type=float, default=1.0, help="primary 变慢时的响应延迟（秒）"
+    )
+    parser.add_argument(
+        "--secondary-latency", type=float, default=0.04, help="secondary 的响应延迟（秒）"
+    )
+    parser.add_argument(
+        "--outage-after",
+        type=float,
+        default=0,
+        help="运行该时间（秒）后 primary 全部失败，0 表示不模拟",
+    )
+    parser.add_argument(
+        "--hedge-delay", type=float, default=0, help="对冲等待时间（秒），0 表示按 EWMA 延迟的 2 倍"
+    )
+    parser.add_argument("--cooldown", type=float, default=5.0, help="熔断时间（秒）")
+    parser.add_argument("--modes", nargs="+", default=["single", "routed", "hedged"])
+    args = parser.parse_args()
+
+    behaviors = {
+        "primary": StubBehavior(
+            latency=args.latency, slow_rate=args.slow_rate, slow_latency=args.slow_latency
+        ),
+        "secondary": StubBehavior(latency=args.secondary_latency),
+    }
+    with StubServer(mas_stub_app(behaviors["primary"])) as primary, StubServer(
+        mas_stub_app(behaviors["secondary"])
+    ) as secondary:
+        servers = {"primary": primary, "secondary": secondary}
+        for mode in args.modes:
+            print(json.dumps(asyncio.run(run(mode, servers, behaviors, args))))
+
+
+if __name__ == "__main__":
+    main()
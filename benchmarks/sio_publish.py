@@ -0,0 +1,100 @@
+"""
+Socket.IO 批量发布基准
+
+对比向 N 个房间推送通知的三种方式，在 config.ini 配置的 Redis 上运行，发布到 benchmark:socketio 频道，不影响线上客户端：
+- emit：每条消息一次 PUBLISH（即每条一次 /message_proxy 请求），按 --concurrency 并发
+- pipelined：/message_proxy/batch?coalesce=false，每条消息一次 PUBLISH，整批一次往返
+- coalesced：/message_proxy/batch，相同事件和数据合并为一次发往房间列表的 PUBLISH
+同时订阅该频道，确认收到的发布数与发送的一致：
+    python -m benchmarks.sio_publish --messages 10000 --payloads 10
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from cores.emitter import Emitter
+from cores.redis import ASYNC_REDIS
+
+CHANNEL = "benchmark:socketio"
+
+
+def build_emits(messages: int, payloads: int):
+    """payloads 种通知，依次发往 messages 个不同房间"""
+    return [
+        (
+            "notify_message",
+            {"title": f"通知 {i % payloads}", "body": "x" * 200},
+            f"benchmark:room:{i}",
+        )
+        for i in range(messages)
+    ]
+
+
+async def emit_each(emitter: Emitter, emits, concurrency: int) -> int:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def emit(event, data, room):
+        async with semaphore:
+            await emitter.emit(event, data, room=room)
+
+    await asyncio.gather(*(emit(*item) for item in emits))
+    return len(emits)
+
+
+async def run(mode: str, emitter: Emitter, emits, concurrency: int) -> dict:
+    received = 0
+    pubsub = ASYNC_REDIS.pubsub()
+    await pubsub.subscribe(CHANNEL)
+
+    async def listen():
+        nonlocal received
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                received += 1
+
+    listener = asyncio.create_task(listen())
+    start = time.perf_counter()
+    if mode == "emit":
+        publishes = await emit_each(emitter, emits, concurrency)
+    else:
+        errors, publishes = await emitter.emit_many(emits, coalesce=mode == "coalesced")
+        assert not any(errors), errors
+    elapsed = time.perf_counter() - start
+
+    # 等待订阅端收完
+    deadline = time.monotonic() + 10
+    while received < publishes and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    listener.cancel()
+    await pubsub.unsubscribe(CHANNEL)
+    await pubsub.aclose()
+    return {
+        "mode": mode,
+        "messages": len(emits),
+        "publishes": publishes,
+        "received": received,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "messages_per_s": round(len(emits) / elapsed, 1),
+    }
+
+
+async def main(args):
+    emitter = Emitter(channel=CHANNEL)
+    emits = build_emits(args.messages, args.payloads)
+    for mode in args.modes:
+        print(json.dumps(await run(mode, emitter, emits, args.concurrency)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--messages", type=int, default=10000, help="消息数（每条发往一个不同的房间）"
+    )
+    parser.add_argument("--payloads", type=int, default=10, help="不同的通知内容数")
+    parser.add_argument("--concurrency", type=int, default=50, help="emit 模式的并发数")
+    parser.add_argument("--modes", nargs="+", default=["emit", "pipelined", "coalesced"])
+    asyncio.run(main(parser.parse_args()))
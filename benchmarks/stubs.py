@@ -0,0 +1,125 @@
+import asyncio
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from dataclasses import dataclass, field
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+@dataclass
+class StubBehavior:
+    """桩服务行为"""
+
+    latency: float = 0.0  # 每个请求的响应延迟（秒）
+    error_rate: float = 0.0  # 返回业务失败的请求比例
+    throttle_rate: float = 0.0  # 随机返回 429 的请求比例
+    max_qps: float = 0.0  # 最近 1 秒请求数超过该值时返回 429，0 表示不限
+    slow_rate: float = 0.0  # 随机变慢的请求比例，模拟长尾延迟
+    slow_latency: float = 0.0  # 变慢的请求的响应延迟（秒）
+    counts: Counter = field(default_factory=Counter)  # requests / ok / error / throttled / mobiles
+    recent: deque = field(default_factory=deque)
+
+    def outcome(self) -> str:
+        """决定本次请求的结果：ok、error 或 throttled"""
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] > 1:
+            self.recent.popleft()
+        self.recent.append(now)
+        self.counts["requests"] += 1
+
+        if (
+            self.max_qps and len(self.recent) > self.max_qps
+        ) or random.random() < self.throttle_rate:
+            result = "throttled"
+        elif random.random() < self.error_rate:
+            result = "error"
+        else:
+            result = "ok"
+        self.counts[result] += 1
+        return result
+
+    def delay(self) -> float:
+        """本次请求的响应延迟"""
+        return self.slow_latency if random.random() < self.slow_rate else self.latency
+
+
+def feishu_stub_app(behavior: StubBehavior) -> Starlette:
+    """飞书自定义机器人 webhook 桩服务，限流时与飞书一致返回 429 和 9499"""
+
+    async def hook(request: Request):
+        await request.body()
+        outcome = behavior.outcome()
+        await asyncio.sleep(behavior.delay())
+        if outcome == "throttled":
+            return JSONResponse(
+                {"code": 9499, "msg": "too many request", "data": {}}, status_code=429
+            )
+        if outcome == "error":
+            return JSONResponse(
+                {
+                    "code": 19001,
+                    "msg": "param invalid: incoming webhook access token invalid",
+                    "data": {},
+                }
+            )
+        return JSONResponse(
+            {"StatusCode": 0, "StatusMessage": "success", "code": 0, "data": {}, "msg": "success"}
+        )
+
+    return Starlette(routes=[Route("/open-apis/bot/v2/hook/{token}", hook, methods=["POST"])])
+
+
+def mas_stub_app(behavior: StubBehavior) -> Starlette:
+    """移动 MAS norsubmit 接口桩服务，请求体为 base64 编码的 JSON 字符串"""
+
+    async def norsubmit(request: Request):
+        payload = json.loads(base64.b64decode(await request.json()))
+        outcome = behavior.outcome()
+        await asyncio.sleep(behavior.delay())
+        if outcome == "throttled":
+            return JSONResponse({}, status_code=429)
+        if outcome == "error":
+            return JSONResponse({"rspcod": "IllegalMac", "msgGroup": "", "success": False})
+        behavior.counts["mobiles"] += len(payload["mobiles"].split(","))
+        return JSONResponse(
+            {
+                "rspcod": "success",
+                "msgGroup": uuid.uuid4().hex,
+                "success": True,
+                "mobiles": payload["mobiles"],
+            }
+        )
+
+    return Starlette(routes=[Route("/sms/norsubmit", norsubmit, methods=["POST"])])
+
+
+class StubServer:
+    """在后台线程中运行的本地桩服务"""
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 0):
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.servers[0].sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
@@ -0,0 +1,24 @@
+"""
+doctest 使用 fakeredis 代替 Redis，不需要启动 Redis 服务：
+    pip install -r requirements-dev.txt
+    CONFIG_FILE_PATH=/path/to/config.ini \\
+        python -m pytest --doctest-modules cores app/sms crontabs -k "not send_sms"
+
+在收集 doctest 之前替换 cores.redis 中的客户端，各模块注册的 Lua 脚本随之使用 fakeredis
+"""
+
+import fakeredis
+import pytest
+
+import cores.redis
+
+FAKE_SERVER = fakeredis.FakeServer()
+cores.redis.REDIS = fakeredis.FakeRedis(server=FAKE_SERVER, decode_responses=True)
+cores.redis.ASYNC_REDIS = fakeredis.FakeAsyncRedis(server=FAKE_SERVER, decode_responses=True)
+
+
+@pytest.fixture(autouse=True)
+def flush_redis():
+    """每个 doctest 从空库开始"""
+    cores.redis.REDIS.flushall()
+    yield
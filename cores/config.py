@@ -1,6 +1,7 @@
 import configparser
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from typing import Dict, Mapping
 
 
 @dataclass
@@ -37,6 +38,17 @@ class SecurityConfig:
 class FeishuConfig:
     webhook_url: str
     secret: str
+    hook_base_url: str = "https://open.feishu.cn/open-apis/bot/v2/hook"
+    forward_concurrency: int = 50  # 同时转发到飞书的最大请求数
+    # 用于过滤和去重的内容的 JSON 路径，逗号分隔，如 card.header.title.content
+    content_paths: str = "**.content"
+    digest_window: float = 0  # 告警合并窗口（秒），窗口内的告警合并为一张汇总卡片，0 表示关闭
+    digest_max_items: int = 10  # 汇总卡片中最多列出的告警条数
+    # sync: 同步转发并返回飞书的结果；queued: 加入出站队列后立即返回，后台按限流速率发送
+    dispatch_mode: str = "sync"
+    dispatch_max_pending: int = 10000  # 每个 webhook 出站队列的最大积压，超过时返回 9499
+    dispatch_max_attempts: int = 5  # 网络错误、5xx 的最大尝试次数，之后移入死信队列
+    dispatch_max_backoff: float = 60.0  # 重试的最大退避时间（秒）
 
 
 @dataclass
@@ -46,6 +58,8 @@ class MasConfig:
     ec_name: str
     api_url: str
     sign: str
+    concurrency: int = 4  # 异步客户端同时提交的最大批次数
+    max_mobiles: int = 5000  # 单次提交最多手机号数
 
 
 @dataclass
@@ -53,6 +67,154 @@ class Rules:
     feishu_same_message_interval: int
     sms_same_message_interval: int
 
+    def __post_init__(self):
+        """
+        去重时间用作 key 的过期时间和 hash、bloom 的分桶长度，必须为正数
+        >>> Rules(feishu_same_message_interval=60, sms_same_message_interval=0)
+        Traceback (most recent call last):
+        ValueError: [rules] sms_same_message_interval must be positive
+        """
+        for name in ("feishu_same_message_interval", "sms_same_message_interval"):
+            if getattr(self, name) <= 0:
+                raise ValueError(f"[rules] {name} must be positive")
+
+
+@dataclass
+class HttpConfig:
+    """共享 HTTP 连接池配置"""
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 3.0
+    read_timeout: float = 5.0
+    write_timeout: float = 5.0
+    pool_timeout: float = 3.0
+
+
+@dataclass
+class QueueConfig:
+    """短信队列消费配置"""
+
+    consumer_mode: str = "poll"  # poll: 每 5 秒轮询；blocking: 阻塞等待，短信到达即发送
+    # list: Redis List；stream: Redis Streams 消费者组（仅 blocking 模式消费）
+    backend: str = "list"
+    batch_size: int = 100  # 单批最多短信数
+    linger: float = 0.2  # 收到第一条短信后继续攒批的时间（秒）
+    block_timeout: int = 5  # 阻塞等待队列的超时时间（秒）
+    min_send_interval: float = 0.0  # 两批之间的最小间隔（秒），供应商有频率限制时使用
+    reliable: bool = False  # 至少一次投递：处理中列表 + 确认 + 重试 + 死信，仅 blocking 模式
+    consumer_id: str = ""  # 消费者标识，默认使用主机名
+    max_attempts: int = 5  # 最大发送次数，超过后进入死信列表
+    retry_base_delay: float = 2.0  # 重试退避基数（秒）
+    retry_max_delay: float = 300.0  # 重试最大间隔（秒）
+    heartbeat_ttl: int = 30  # 消费者心跳过期时间（秒），过期后其处理中短信被放回队列
+    stream_maxlen: int = 1000000  # Streams 近似最大长度，入队时裁剪
+    claim_idle: float = 60.0  # Streams 未确认短信空闲超过该时间（秒）后被其他消费者认领
+    lanes: str = "otp:10,normal:3,bulk:1"  # 优先级通道及权重，顺序即优先级
+    default_lane: str = "normal"  # 未指定 priority 的短信进入该通道，沿用原有的队列 key
+    scheduling: str = "weighted"  # weighted: 按权重分配每批名额；strict: 严格按优先级
+    starvation_limit: float = 30.0  # 通道超过该时间（秒）未被检查时优先分配名额，避免饿死
+    schedule_batch: int = 1000  # 定时短信到期后每个通道单次移入队列的最多条数
+    bulk_chunk_size: int = 1000  # /mas/bulk 每批去重入队的短信数
+    bulk_job_ttl: int = 86400  # /mas/bulk 任务进度的保留时间（秒）
+
+    def __post_init__(self):
+        """
+        poll 模式只轮询 List 队列，stream 后端入队的短信不会被发送，读取配置时拒绝
+        >>> QueueConfig(backend="stream", consumer_mode="poll")
+        Traceback (most recent call last):
+        ValueError: [queue] backend = stream requires consumer_mode = blocking
+        """
+        if self.backend == "stream" and self.consumer_mode != "blocking":
+            raise ValueError("[queue] backend = stream requires consumer_mode = blocking")
+
+
+@dataclass
+class RateLimitConfig:
+    """出站供应商限流（Redis 令牌桶，多副本共享）"""
+
+    enabled: bool = False
+    mas_rate: float = 5.0  # MAS 每秒提交次数
+    mas_burst: int = 5
+    feishu_rate: float = 5.0  # 每个飞书 webhook 每秒请求数
+    feishu_burst: int = 5
+    feishu_max_wait: float = 10.0  # 飞书转发最长排队时间（秒），超过后返回限流错误
+
+    def __post_init__(self):
+        """
+        速率为 0 时令牌桶脚本中除以 0，每次获取令牌都会失败
+        >>> RateLimitConfig(mas_rate=0)
+        Traceback (most recent call last):
+        ValueError: [ratelimit] mas_rate must be positive
+        """
+        for name in ("mas_rate", "mas_burst", "feishu_rate", "feishu_burst"):
+            if getattr(self, name) <= 0:
+                raise ValueError(f"[ratelimit] {name} must be positive")
+
+
+@dataclass
+class DedupeConfig:
+    """重复消息过滤的存储方式"""
+
+    backend: str = "key"  # key: 每条消息一个 key；hash: 分桶分片的小 hash；bloom: 轮换的布隆过滤器
+    capacity: int = 1000000  # 每个去重时间内预计的消息数，用于计算 bloom 大小和 hash 字段长度
+    fp_rate: float = 0.001  # 允许的误判率（把新消息当作重复）
+    # hash 模式下每个桶的分片数，capacity / shards 不超过 128（hash-max-listpack-entries）时内存最省
+    shards: int = 8192
+    local_cache_size: int = 10000  # 飞书转发在每个 worker 内缓存的最近消息摘要数，0 表示关闭
+
+
+@dataclass
+class MetricsConfig:
+    """Prometheus 指标"""
+
+    enabled: bool = True
+    flush_interval: float = 5.0  # 进程内指标写入 Redis 汇总的间隔（秒）
+    worker_port: int = 0  # task 进程的指标端口，0 表示不开启
+
+
+@dataclass
+class StatusConfig:
+    """短信状态跟踪"""
+
+    enabled: bool = True
+    ttl: int = 259200  # 状态记录的保留时间（秒），需覆盖 MAS 状态报告的最长延迟
+    report_token: str = ""  # MAS 状态报告回调地址中的 token，为空时不接收状态报告
+
+
+@dataclass
+class JournalConfig:
+    """Redis 不可用时短信写入本地追加日志，恢复后回放到队列"""
+
+    enabled: bool = False
+    dir: str = "data/journal"  # 日志目录，相对路径按项目根目录解析，容器中需挂载为持久卷
+    max_bytes: int = 268435456  # 每个进程的日志最多占用的磁盘空间，超过时拒绝写入（返回 503）
+    segment_bytes: int = 16777216  # 单个分段文件大小，写满后切换，回放完的分段即删除
+    # 组提交间隔（秒），期间的写入合并为一次 fsync，0 表示每次写入都 fsync
+    fsync_interval: float = 0.005
+    replay_interval: float = 1.0  # 回放检查间隔（秒）
+    replay_batch: int = 500  # 回放时每次往返入队的短信数
+
+
+@dataclass
+class RoutingConfig:
+    """出站供应商路由，各进程按本进程观察到的延迟和错误率选择供应商"""
+
+    # 短信供应商及权重，逗号分隔，如 mas:3,backup:1；mas 为 [mas] 段，其他为 [provider.{name}] 段
+    sms_providers: str = "mas"
+    feishu_providers: str = "feishu"  # 告警 webhook 及权重，feishu 为 [feishu] 段
+    ewma_alpha: float = 0.2  # 延迟和错误率的指数加权系数，越大越偏向最近的结果
+    # 错误率对得分的惩罚：得分 = 权重 / (延迟 × (1 + error_penalty × 错误率))
+    error_penalty: float = 4.0
+    failover: bool = True  # 提交失败时依次换下一个供应商
+    breaker_failures: int = 5  # 连续失败该次数后熔断
+    breaker_error_rate: float = 0.5  # 至少 breaker_failures 次提交后错误率超过该值时熔断
+    breaker_cooldown: float = 30.0  # 熔断时间（秒），之后放行一次试探，成功则恢复
+    hedge_lanes: str = ""  # 对冲的短信通道，逗号分隔（如 otp），默认为空即关闭
+    # 首选供应商超过该时间（秒）未返回时同时提交到备用供应商，0 表示按其 EWMA 延迟的 2 倍
+    hedge_delay: float = 0.0
+
 
 @dataclass
 class Settings:
@@ -62,6 +224,15 @@ class Settings:
     feishu: FeishuConfig
     mas: MasConfig
     rules: Rules
+    http: HttpConfig
+    queue: QueueConfig
+    ratelimit: RateLimitConfig
+    metrics: MetricsConfig
+    dedupe: DedupeConfig
+    status: StatusConfig
+    journal: JournalConfig
+    routing: RoutingConfig
+    providers: Dict[str, Dict[str, str]]  # [provider.{name}] 段的原始配置，由对应类型的供应商解析
 
 
 def get_config_path() -> str:
@@ -73,6 +244,35 @@ def get_config_path() -> str:
     return config_file_path
 
 
+def parse_fields(options: Mapping[str, str], cls):
+    """
+    按 dataclass 字段类型转换配置项，忽略多余的项，缺省时使用默认值
+    >>> parse_fields({"enabled": "yes", "ttl": "60", "type": "x"}, StatusConfig)
+    StatusConfig(enabled=True, ttl=60, report_token='')
+    """
+    values = {}
+    for field in fields(cls):
+        if field.name not in options:
+            continue
+        value = options[field.name]
+        if field.type is bool:
+            if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ValueError(f"Not a boolean: {value}")
+            values[field.name] = configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        elif field.type is int:
+            values[field.name] = int(value)
+        elif field.type is float:
+            values[field.name] = float(value)
+        else:
+            values[field.name] = value
+    return cls(**values)
+
+
+def read_section(config: configparser.ConfigParser, section: str, cls):
+    """读取可选配置段，按 dataclass 字段类型转换，缺省时使用默认值"""
+    return parse_fields(config[section] if config.has_section(section) else {}, cls)
+
+
 def read_config() -> Settings:
     """读取配置文件并返回配置设置"""
     file_path = get_config_path()
@@ -92,11 +292,25 @@ def read_config() -> Settings:
     security_config = SecurityConfig(**config["security"])
     security_config.token_expire_days = config.getint("security", "token_expire_days")
 
-    feishu_config = FeishuConfig(**config["feishu"])
+    feishu_config = read_section(config, "feishu", FeishuConfig)
+
+    mas_config = parse_fields(config["mas"], MasConfig)
 
-    mas_config = MasConfig(**config["mas"])
+    rules = parse_fields(config["rules"], Rules)
 
-    rules = Rules(**config["rules"])
+    http_config = read_section(config, "http", HttpConfig)
+    queue_config = read_section(config, "queue", QueueConfig)
+    ratelimit_config = read_section(config, "ratelimit", RateLimitConfig)
+    metrics_config = read_section(config, "metrics", MetricsConfig)
+    dedupe_config = read_section(config, "dedupe", DedupeConfig)
+    status_config = read_section(config, "status", StatusConfig)
+    journal_config = read_section(config, "journal", JournalConfig)
+    routing_config = read_section(config, "routing", RoutingConfig)
+    providers = {
+        section.partition(".")[2]: dict(config[section])
+        for section in config.sections()
+        if section.startswith("provider.")
+    }
 
     return Settings(
         app=app_config,
@@ -104,7 +318,16 @@ def read_config() -> Settings:
         security=security_config,
         feishu=feishu_config,
         mas=mas_config,
-        rules=rules
+        rules=rules,
+        http=http_config,
+        queue=queue_config,
+        ratelimit=ratelimit_config,
+        metrics=metrics_config,
+        dedupe=dedupe_config,
+        status=status_config,
+        journal=journal_config,
+        routing=routing_config,
+        providers=providers,
     )
 
 
@@ -21,3 +21,4 @@ class SioEvent(Enum):
     # 后端发送
     SYSTEM_NOTIFY = "system_notify"  # 系统通知、浏览器通知
     NOTIFY_MESSAGE = "notify_message"  # 系统内部通知
+    SMS_STATUS = "sms_status"  # 短信状态变化
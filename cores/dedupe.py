@@ -0,0 +1,238 @@
+"""
+重复消息过滤
+
+- key：每条消息一个带过期时间的 key（SET NX EX），精确，但广播时会产生大量 key
+- hash：按去重时间分桶，每个桶再按摘要前缀拆分为多个小 hash（保持 listpack 编码），
+  字段为截断后的摘要、值为首次出现的时间，窗口精确，每条约 20 字节
+- bloom：每个去重时间一个布隆过滤器，检查当前和上一个过滤器，按 capacity 和 fp_rate 计算大小，
+  每条约 1.8 字节（fp_rate = 0.001），窗口为 1 到 2 倍去重时间
+
+检查和写入在 Lua 中完成，入队脚本通过 DEDUPE_LUA 复用同一段逻辑
+飞书转发在 Redis 前还有一层进程内缓存（LocalDedupeCache）
+"""
+
+import math
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from cores.config import DedupeConfig, settings
+from cores.metrics import COLLECTORS, DEDUPE_LOCAL_TOTAL, format_labels
+from cores.redis import ASYNC_REDIS
+
+# is_new(mode, 当前 key, 上一个 key, 成员, 去重时间, 当前时间) 返回 (是否首次出现并记录, 仍判为重复的剩余秒数)
+DEDUPE_LUA = """
+local function is_new(mode, cur, prev, member, ttl, now)
+    ttl, now = tonumber(ttl), tonumber(now)
+    if mode == 'key' then
+        if redis.call('SET', cur, 'sent', 'EX', ttl, 'NX') then
+            return true, ttl
+        end
+        return false, math.max(0, redis.call('TTL', cur))
+    elseif mode == 'hash' then
+        local seen = redis.call('HGET', cur, member) or redis.call('HGET', prev, member)
+        if seen and now - tonumber(seen) < ttl then
+            return false, tonumber(seen) + ttl - now
+        end
+        redis.call('HSET', cur, member, now)
+        redis.call('EXPIRE', cur, ttl * 2)
+        return true, ttl
+    end
+    local offsets = {}
+    for offset in string.gmatch(member, '%d+') do
+        offsets[#offsets + 1] = offset
+    end
+    local in_cur, in_prev = true, true
+    for _, offset in ipairs(offsets) do
+        in_cur = in_cur and redis.call('GETBIT', cur, offset) == 1
+        in_prev = in_prev and redis.call('GETBIT', prev, offset) == 1
+        if not in_cur and not in_prev then
+            break
+        end
+    end
+    -- 在当前过滤器中的消息到下一个窗口结束前都判为重复，只在上一个过滤器中的到本窗口结束
+    local window_end = (math.floor(now / ttl) + 1) * ttl
+    if in_cur then
+        return false, window_end + ttl - now
+    elseif in_prev then
+        return false, window_end - now
+    end
+    for _, offset in ipairs(offsets) do
+        redis.call('SETBIT', cur, offset, 1)
+    end
+    redis.call('EXPIRE', cur, ttl * 2)
+    return true, ttl
+end
+"""
+
+# 单条检查：KEYS[1] 当前 key，KEYS[2] 上一个 key；ARGV 为 mode、成员、去重时间、当前时间
+# 返回 {是否首次出现, 仍判为重复的剩余秒数}
+DEDUPE_SCRIPT = ASYNC_REDIS.register_script(
+    DEDUPE_LUA
+    + """
+local new, remaining = is_new(ARGV[1], KEYS[1], KEYS[2], ARGV[2], ARGV[3], ARGV[4])
+return {new and 1 or 0, remaining}
+"""
+)
+
+
+def bloom_size(capacity: int, fp_rate: float) -> Tuple[int, int]:
+    """
+    布隆过滤器的位数和哈希函数个数
+    >>> bloom_size(1000000, 0.001)
+    (14377588, 10)
+    """
+    bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+    return bits, max(1, round(bits / capacity * math.log(2)))
+
+
+def member_length(capacity: int, fp_rate: float, shards: int) -> int:
+    """
+    hash 模式下字段保留的摘要十六进制位数，使同一分片内的误判率不超过 fp_rate
+    >>> member_length(1000000, 0.001, 1024)
+    5
+    """
+    return min(24, max(4, math.ceil(math.log2(capacity / shards / fp_rate) / 4)))
+
+
+class Deduper:
+    """按命名空间（mas:sms、feishu）和去重时间过滤重复消息"""
+
+    def __init__(self, namespace: str, ttl: int, config: Optional[DedupeConfig] = None):
+        self.namespace = namespace
+        self.ttl = int(ttl)
+        self.config = config or settings.dedupe
+        self.mode = self.config.backend
+        self.bloom_bits, self.bloom_hashes = bloom_size(self.config.capacity, self.config.fp_rate)
+        self.member_length = member_length(
+            self.config.capacity, self.config.fp_rate, self.config.shards
+        )
+
+    def keys(self, digest: str, now: int) -> Tuple[str, str, str]:
+        """
+        :param digest: 消息的十六进制摘要（md5）
+        :param now: 当前时间（秒）
+        :return: (当前 key, 上一个 key, 成员)
+        """
+        if self.mode == "key":
+            key = f"{self.namespace}:{digest}"
+            return key, key, ""
+
+        bucket = now // self.ttl
+        if self.mode == "hash":
+            shard = int(digest[:8], 16) % self.config.shards
+            return (
+                f"dedupe:{self.namespace}:{bucket}:{shard}",
+                f"dedupe:{self.namespace}:{bucket - 1}:{shard}",
+                digest[8 : 8 + self.member_length],
+            )
+
+        # 双重哈希生成 k 个位置
+        h1, h2 = int(digest[:16], 16), int(digest[16:32], 16) | 1
+        offsets = ",".join(str((h1 + i * h2) % self.bloom_bits) for i in range(self.bloom_hashes))
+        return f"dedupe:{self.namespace}:{bucket}", f"dedupe:{self.namespace}:{bucket - 1}", offsets
+
+    def script_args(self, digest: str, now: int) -> Tuple[list, str]:
+        """入队脚本使用：返回 ([当前 key, 上一个 key], 成员)"""
+        cur, prev, member = self.keys(digest, now)
+        return [cur, prev], member
+
+    async def is_new(self, digest: str, client=None, now: Optional[int] = None):
+        """
+        检查并记录，可传入 pipeline 与其他命令在同一次往返中执行
+        :return: [是否首次出现（1/0）, Redis 仍判为重复的剩余秒数]
+
+        >>> import asyncio, hashlib
+        >>> def check(backend, times, ttl=60):
+        ...     deduper = Deduper("doctest", ttl, DedupeConfig(backend=backend, capacity=1000))
+        ...     digest = hashlib.md5(b"hello").hexdigest()
+        ...     async def run():
+        ...         return [await deduper.is_new(digest, now=now) for now in times]
+        ...     return asyncio.run(run())
+
+        key：首次出现时写入带过期时间的 key，之后返回 key 的剩余时间：
+
+        >>> check("key", [1000, 1010])
+        [[1, 60], [0, 60]]
+
+        hash：记录首次出现的时间，窗口精确，跨桶时仍检查上一个桶：
+
+        >>> check("hash", [1000, 1010, 1059, 1060, 1070])
+        [[1, 60], [0, 50], [0, 1], [1, 60], [0, 50]]
+
+        bloom：当前过滤器中的消息到下一个窗口结束前都判为重复，只在上一个过滤器中的到本窗口结束：
+
+        >>> check("bloom", [1000, 1010, 1070, 1079, 1080])
+        [[1, 60], [0, 70], [0, 10], [0, 1], [1, 60]]
+        """
+        now = int(time.time()) if now is None else now
+        cur, prev, member = self.keys(digest, now)
+        return await DEDUPE_SCRIPT(
+            keys=[cur, prev], args=[self.mode, member, self.ttl, now], client=client
+        )
+
+
+class LocalDedupeCache:
+    """
+    进程内的去重缓存，放在 Redis 前面，告警风暴时重复消息不再访问 Redis
+    - 只缓存 Redis 已确认的结果，过期时间不超过 Redis 仍判为重复的剩余时间，不会多过滤
+    - 未命中时仍由 Redis 判断，多个 worker 之间的去重结果一致
+    - 按 LRU 淘汰，条数不超过 max_size
+
+    >>> cache = LocalDedupeCache("doctest", max_size=2)
+    >>> cache.remember("a", 60); cache.remember("b", 60); cache.seen("a")
+    True
+    >>> cache.remember("c", 60); cache.seen("b"), cache.seen("a"), cache.seen("c")
+    (False, True, True)
+    >>> cache.remember("d", 0); cache.seen("d")
+    False
+    """
+
+    def __init__(self, namespace: str, max_size: int):
+        self.namespace = namespace
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()  # 摘要 -> 过期时间（monotonic）
+        LOCAL_CACHES.append(self)
+
+    def seen(self, digest: str) -> bool:
+        """是否为最近确认过的重复消息"""
+        expires_at = self.entries.get(digest)
+        if expires_at is not None and expires_at > time.monotonic():
+            self.entries.move_to_end(digest)
+            DEDUPE_LOCAL_TOTAL.inc(namespace=self.namespace, result="hit")
+            return True
+        if expires_at is not None:
+            del self.entries[digest]
+        DEDUPE_LOCAL_TOTAL.inc(namespace=self.namespace, result="miss")
+        return False
+
+    def remember(self, digest: str, remaining: float):
+        """
+        :param digest:
+        :param remaining: Redis 仍判为重复的剩余秒数
+        """
+        if self.max_size <= 0 or remaining <= 0:
+            return
+        self.entries[digest] = time.monotonic() + remaining
+        self.entries.move_to_end(digest)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+LOCAL_CACHES = []
+
+
+async def local_cache_metrics():
+    """抓取 /metrics 时采集本进程缓存的条数"""
+    samples = {
+        format_labels(("namespace",), (cache.namespace,)): len(cache.entries)
+        for cache in LOCAL_CACHES
+    }
+    return [("dedupe_local_entries", "本进程去重缓存条数（仅为输出指标的进程）", samples)]
+
+
+COLLECTORS.append(local_cache_metrics)
+
+SMS_DEDUPER = Deduper("mas:sms", settings.rules.sms_same_message_interval)
+FEISHU_DEDUPER = Deduper("feishu", settings.rules.feishu_same_message_interval)
+FEISHU_LOCAL_CACHE = LocalDedupeCache("feishu", settings.dedupe.local_cache_size)
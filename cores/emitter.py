@@ -0,0 +1,182 @@
+"""
+只写的 Socket.IO 发布器
+
+API 和 task 进程都通过它向客户端推送：不创建 Socket.IO 服务端和订阅连接，直接按 AsyncRedisManager 的消息格式
+PUBLISH 到 Redis 频道，复用 ASYNC_REDIS / REDIS 的连接池，首次发布时才连接；
+API 的各 worker 订阅该频道后推送给各自的客户端（发布使用独立的 host_id，本进程的 worker 同样通过订阅收到）
+- emit：立即发布一条
+- emit_many / emit_many_sync：一次往返发布多条
+- emit_nowait：放入缓冲区立即返回，后台每 FLUSH_INTERVAL 秒或攒满 MAX_BUFFER 条时批量发布
+"""
+
+import asyncio
+import contextlib
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import orjson
+
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS, REDIS
+
+# 与 AsyncRedisManager 的默认频道一致
+CHANNEL = "socketio"
+
+FLUSH_INTERVAL = 0.05  # 缓冲区发布间隔（秒）
+MAX_BUFFER = 1000  # 缓冲区最多条数，攒满时立即发布，超过时丢弃最早的消息
+
+# (事件, 数据, 房间)，房间为 None 时广播
+Emit = Tuple[str, Any, Optional[str]]
+
+
+def pubsub_message(event: str, data: Any, room, host_id: str) -> bytes:
+    """
+    与 AsyncRedisManager.emit 发布到 Redis 的消息格式一致，room 可以是房间列表
+    >>> orjson.loads(pubsub_message("notify", {"a": 1}, ["r1", "r2"], "h"))["room"]
+    ['r1', 'r2']
+    """
+    return orjson.dumps(
+        {
+            "method": "emit",
+            "event": event,
+            "data": [data],
+            "binary": False,
+            "namespace": "/",
+            "room": room,
+            "skip_sid": None,
+            "callback": None,
+            "host_id": host_id,
+        }
+    )
+
+
+def coalesce_emits(emits: Sequence[Emit]) -> List[Tuple[str, Any, Any, List[int]]]:
+    """
+    事件和数据相同、发往不同房间的消息合并为一条发往房间列表的消息，按每组首次出现的顺序排列；广播不合并
+    :return: [(事件, 数据, 房间或房间列表, 对应的消息下标)]
+    >>> emits = [("a", {"x": 1}, "r1"), ("b", {"x": 1}, "r1"), ("a", {"x": 1}, "r2")]
+    >>> emits += [("a", {"x": 1}, None), ("a", {"x": 1}, "r1")]
+    >>> [(event, room, indexes) for event, _, room, indexes in coalesce_emits(emits)]
+    [('a', ['r1', 'r2'], [0, 2, 4]), ('b', 'r1', [1]), ('a', None, [3])]
+    """
+    groups: Dict[tuple, Tuple[str, Any, Dict[str, None], List[int]]] = {}
+    coalesced = []
+    for index, (event, data, room) in enumerate(emits):
+        if room is None:
+            coalesced.append((event, data, None, [index]))
+            continue
+        key = (event, orjson.dumps(data, option=orjson.OPT_SORT_KEYS))
+        if (group := groups.get(key)) is None:
+            group = groups[key] = (event, data, {}, [])
+            coalesced.append(group)
+        group[2][room] = None
+        group[3].append(index)
+    return [
+        (
+            event,
+            data,
+            rooms if rooms is None else (list(rooms) if len(rooms) > 1 else next(iter(rooms))),
+            indexes,
+        )
+        for event, data, rooms, indexes in coalesced
+    ]
+
+
+class Emitter:
+    """只写的发布器，进程内共享 EMITTER 单例"""
+
+    def __init__(self, channel: str = CHANNEL):
+        self.channel = channel
+        self.host_id = f"emitter-{uuid.uuid4().hex}"
+        self.buffer: List[Emit] = []
+        self.flusher: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Event] = None
+
+    def group(self, emits: Sequence[Emit], coalesce: bool) -> List[Tuple[str, Any, Any, List[int]]]:
+        if coalesce:
+            return coalesce_emits(emits)
+        return [(event, data, room, [i]) for i, (event, data, room) in enumerate(emits)]
+
+    async def emit(self, event: str, data: Any, room: Optional[str] = None):
+        await ASYNC_REDIS.publish(self.channel, pubsub_message(event, data, room, self.host_id))
+
+    async def emit_many(
+        self, emits: Sequence[Emit], coalesce: bool = True
+    ) -> Tuple[List[str], int]:
+        """
+        一次 Redis 往返发布多条消息
+        :param emits: 待发布的消息
+        :param coalesce: 是否合并发往不同房间的相同消息，同一客户端在多个房间中只收到一次
+        :return: (与 emits 一一对应的错误信息，成功为空字符串, 发布次数)
+        """
+        groups = self.group(emits, coalesce)
+        errors = [""] * len(emits)
+        if not groups:
+            return errors, 0
+        async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+            for event, data, room, _ in groups:
+                pipe.publish(self.channel, pubsub_message(event, data, room, self.host_id))
+            results = await pipe.execute(raise_on_error=False)
+        for (_, _, _, indexes), result in zip(groups, results):
+            if isinstance(result, Exception):
+                for index in indexes:
+                    errors[index] = str(result)
+        return errors, len(groups)
+
+    def emit_many_sync(self, emits: Sequence[Emit], coalesce: bool = True) -> int:
+        """同步进程（poll 模式的定时任务）使用，一次往返发布多条消息，返回发布次数"""
+        groups = self.group(emits, coalesce)
+        if groups:
+            with REDIS.pipeline(transaction=False) as pipe:
+                for event, data, room, _ in groups:
+                    pipe.publish(self.channel, pubsub_message(event, data, room, self.host_id))
+                pipe.execute()
+        return len(groups)
+
+    def emit_nowait(self, event: str, data: Any, room: Optional[str] = None):
+        """放入缓冲区立即返回，首次调用时启动后台发布任务"""
+        if len(self.buffer) >= MAX_BUFFER:
+            LOG.warning(f"Socket.IO 发布缓冲区已满，丢弃最早的消息: {self.buffer[0][0]}")
+            del self.buffer[0]
+        self.buffer.append((event, data, room))
+        if self.flusher is None or self.flusher.done():
+            self.wakeup = asyncio.Event()
+            self.flusher = asyncio.create_task(self.run_flusher())
+        if len(self.buffer) >= MAX_BUFFER:
+            self.wakeup.set()
+
+    async def flush(self):
+        buffer, self.buffer = self.buffer, []
+        if buffer:
+            errors, _ = await self.emit_many(buffer, coalesce=False)
+            if failed := sum(1 for error in errors if error):
+                LOG.warning(
+                    f"Socket.IO 发布失败 {failed} 条: {next(error for error in errors if error)}"
+                )
+
+    async def run_flusher(self):
+        """缓冲区发布完后退出，下次 emit_nowait 时重新启动，空闲时不占用任务"""
+        try:
+            while self.buffer:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.wakeup.wait(), FLUSH_INTERVAL)
+                self.wakeup.clear()
+                try:
+                    await self.flush()
+                except Exception as e:
+                    LOG.warning(f"Socket.IO 发布失败: {e}")
+        finally:
+            with contextlib.suppress(Exception):
+                await self.flush()
+
+    async def close(self):
+        """停止后台发布任务，发布缓冲区中剩余的消息"""
+        if self.flusher is not None:
+            self.flusher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.flusher
+            self.flusher = None
+        await self.flush()
+
+
+EMITTER = Emitter()
@@ -1,3 +1,4 @@
+import asyncio
 import contextlib
 import importlib
 import pkgutil
@@ -8,7 +9,10 @@ from ghkit.log import setup_logging
 from starlette.middleware.cors import CORSMiddleware
 
 from cores.config import settings
+from cores.emitter import EMITTER
+from cores.http import close_http_clients, get_http_client
 from cores.log import LOG
+from cores.metrics import run_flusher
 from cores.sio import attach_socketio
 
 
@@ -30,15 +34,47 @@ def register_routes(_app: FastAPI):
     LOG.info("All routes registered.")
 
 
-def check_redis():
+def check_redis() -> bool:
+    """Redis 不可用时，开启了本地日志则降级启动，否则拒绝启动"""
     LOG.info("Checking Redis connection...")
     try:
         from cores.redis import REDIS
+
         REDIS.ping()
     except Exception as e:
         LOG.error(f"Redis connection failed: {e}")
-        raise e
+        if not settings.journal.enabled:
+            raise e
+        from cores.sms_journal import Degraded
+
+        Degraded.enter(e)
+        return False
     LOG.info("Redis connection OK.")
+    return True
+
+
+async def migrate_rules():
+    from app.sms.rules import migrate_legacy_rules
+
+    await migrate_legacy_rules()
+
+
+def start_digest_flusher():
+    from app.sms.views.feishu import run_digest_flusher
+
+    return asyncio.create_task(run_digest_flusher())
+
+
+def start_feishu_dispatcher():
+    from app.sms.outbound import run_dispatcher
+
+    return asyncio.create_task(run_dispatcher())
+
+
+def start_journal_replayer():
+    from cores.sms_journal import run_replayer
+
+    return asyncio.create_task(run_replayer())
 
 
 @contextlib.asynccontextmanager
@@ -49,15 +85,41 @@ async def lifespan(_app: FastAPI) -> AsyncIterator[None]:
     # 注册路由
     register_routes(_app)
 
-    # 检查 Redis
-    check_redis()
+    # 检查 Redis，降级启动时跳过迁移，下次启动时再执行
+    if check_redis():
+        # 迁移旧版过滤规则
+        await migrate_rules()
 
     # 注册 Socket.IO
     attach_socketio(_app)
 
+    # 创建共享 HTTP 连接池
+    get_http_client()
+
+    # 定期将本进程的指标写入 Redis 汇总
+    flusher = asyncio.create_task(run_flusher()) if settings.metrics.enabled else None
+
+    # 定期发送到期的飞书告警汇总
+    digests = start_digest_flusher() if settings.feishu.digest_window > 0 else None
+
+    # 发送飞书出站队列
+    dispatcher = start_feishu_dispatcher() if settings.feishu.dispatch_mode == "queued" else None
+
+    # Redis 恢复后回放本地日志中的短信
+    replayer = start_journal_replayer() if settings.journal.enabled else None
+
     # 通过 yield 将控制权交给 FastAPI
     yield
 
+    # 应用关闭时停止后台任务、写入剩余指标、发布缓冲区中的推送并释放连接池
+    for task in (replayer, dispatcher, digests, flusher):
+        if task:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+    await EMITTER.close()
+    await close_http_clients()
+
 
 def make_app():
     setup_logging()  # 启用 loguru 作为全局日志系统
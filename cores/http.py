@@ -0,0 +1,54 @@
+import asyncio
+from typing import Dict, Optional
+
+import httpx
+
+from cores.config import settings
+from cores.log import LOG
+
+# 进程内共享的 keep-alive 异步 HTTP 客户端，按名称区分（不同的 TLS 校验等配置）
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+# 飞书转发并发上限，防止告警风暴时占满连接池
+FEISHU_LIMIT = asyncio.Semaphore(settings.feishu.forward_concurrency)
+
+
+def make_http_client(**kwargs) -> httpx.AsyncClient:
+    """按配置创建带连接池的异步 HTTP 客户端"""
+    config = settings.http
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+            keepalive_expiry=config.keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            connect=config.connect_timeout,
+            read=config.read_timeout,
+            write=config.write_timeout,
+            pool=config.pool_timeout,
+        ),
+        **kwargs,
+    )
+
+
+def get_http_client(name: str = "default", **kwargs) -> httpx.AsyncClient:
+    """
+    获取共享客户端，不存在时按需创建
+    :param name: 客户端名称
+    :param kwargs: 首次创建时传给 httpx.AsyncClient 的额外参数，例如 verify=False
+    :return:
+    """
+    client: Optional[httpx.AsyncClient] = _clients.get(name)
+    if client is None or client.is_closed:
+        client = _clients[name] = make_http_client(**kwargs)
+        LOG.info(f"HTTP client {name} created")
+    return client
+
+
+async def close_http_clients():
+    """关闭所有共享客户端，释放连接池"""
+    for name, client in list(_clients.items()):
+        await client.aclose()
+        LOG.info(f"HTTP client {name} closed")
+    _clients.clear()
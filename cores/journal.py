@@ -0,0 +1,338 @@
+"""
+本地追加日志
+
+Redis 不可用时先把数据写入本地文件，恢复后再回放：
+- 每个进程一个目录 {root}/{owner}，持有目录下 lock 文件的 flock；进程退出后锁自动释放，其他进程据此认领并回放遗留的日志
+- 目录下为按序号命名的分段文件 {seq:012d}.log，写满 segment_bytes 后切换到下一个，回放完即删除
+- 每条记录为 4 字节长度 + 4 字节 CRC32（大端）+ 内容，进程崩溃时末尾未写完的记录在读取时忽略
+- 组提交：写入进入页缓存后等待下一次 fsync，fsync_interval 内的写入共用一次 fsync，fsync 在线程中执行，不阻塞事件循环
+- 已回放的位置记录在 {seq:012d}.pos，回放中断后从该位置继续；本进程的日志最多占用 max_bytes，超过时拒绝写入
+"""
+
+import asyncio
+import contextlib
+import fcntl
+import os
+import shutil
+import struct
+import uuid
+import zlib
+from typing import Awaitable, Callable, Iterator, List, Optional, Tuple
+
+from cores.log import LOG
+
+HEADER = struct.Struct(">II")
+MAX_RECORD_BYTES = 64 * 1024 * 1024  # 长度超过该值的记录视为损坏
+SEGMENT_SUFFIX = ".log"
+POSITION_SUFFIX = ".pos"
+LOCK_FILE = "lock"
+
+
+class JournalFull(Exception):
+    """日志占用的磁盘空间已达到 max_bytes"""
+
+
+def encode_record(payload: bytes) -> bytes:
+    """
+    >>> encode_record(b"ab")
+    b'\\x00\\x00\\x00\\x02\\x9e\\x83Hmab'
+    """
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: str, offset: int = 0) -> Iterator[Tuple[int, bytes]]:
+    """
+    从 offset 开始读取记录，返回 (下一条记录的位置, 内容)；遇到不完整或校验失败的记录时停止
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile(suffix=SEGMENT_SUFFIX) as file:
+    ...     _ = file.write(encode_record(b"a") + encode_record(b"bc") + encode_record(b"def")[:-1])
+    ...     file.flush()
+    ...     list(read_records(file.name)), list(read_records(file.name, 9))
+    ([(9, b'a'), (19, b'bc')], [(19, b'bc')])
+
+    校验失败的记录及之后的内容都被忽略：
+
+    >>> with tempfile.NamedTemporaryFile(suffix=SEGMENT_SUFFIX) as file:
+    ...     corrupted = encode_record(b"bc")[:-1] + b"x"
+    ...     _ = file.write(encode_record(b"a") + corrupted + encode_record(b"d"))
+    ...     file.flush()
+    ...     list(read_records(file.name))
+    [(9, b'a')]
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        file.seek(offset)
+        while offset < size:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            length, crc = HEADER.unpack(header)
+            if length > MAX_RECORD_BYTES:
+                break
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            offset += HEADER.size + length
+            yield offset, payload
+    if offset < size:
+        LOG.warning(f"日志 {path} 在 {offset} 处有 {size - offset} 字节不完整或已损坏，已跳过")
+
+
+def segment_path(directory: str, seq: int) -> str:
+    return os.path.join(directory, f"{seq:012d}{SEGMENT_SUFFIX}")
+
+
+def list_segments(directory: str) -> List[str]:
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(SEGMENT_SUFFIX)
+    )
+
+
+def read_position(path: str) -> int:
+    try:
+        with open(path[: -len(SEGMENT_SUFFIX)] + POSITION_SUFFIX) as file:
+            return int(file.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_position(path: str, offset: int):
+    """先写临时文件再替换，崩溃时不会留下不完整的位置"""
+    position = path[: -len(SEGMENT_SUFFIX)] + POSITION_SUFFIX
+    with open(f"{position}.tmp", "w") as file:
+        file.write(str(offset))
+    os.replace(f"{position}.tmp", position)
+
+
+def lock_orphan(directory: str) -> Optional[int]:
+    """获取目录的锁，返回锁文件的 fd；目录的进程仍在运行或已被其他进程回放删除时返回 None"""
+    try:
+        fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    # 获取锁之前目录可能刚被回放删除
+    if not os.path.exists(directory):
+        os.close(fd)
+        return None
+    return fd
+
+
+class Journal:
+    """本进程的追加日志，首次写入时才创建目录和文件"""
+
+    def __init__(self, root: str, max_bytes: int, segment_bytes: int, fsync_interval: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.directory: Optional[str] = None
+        self.lock_fd: Optional[int] = None
+        self.fd: Optional[int] = None
+        self.seq = 0
+        self.active_size = 0  # 当前分段已写入的字节数
+        self.used = 0  # 本进程未回放的日志字节数
+        self.sync_lock: Optional[asyncio.Lock] = None
+        self.sync_waiter: Optional[asyncio.Future] = None
+        self.sync_task: Optional[asyncio.Task] = None
+
+    def open(self):
+        # 在临时目录中加锁后再改名，避免加锁前被其他进程当作遗留目录认领
+        owner = uuid.uuid4().hex
+        staging = os.path.join(self.root, f".{owner}")
+        os.makedirs(staging)
+        self.lock_fd = os.open(os.path.join(staging, LOCK_FILE), os.O_CREAT | os.O_RDWR, 0o600)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.directory = os.path.join(self.root, owner)
+        os.rename(staging, self.directory)
+        self.sync_lock = asyncio.Lock()
+        self.open_segment(1)
+        LOG.warning(f"创建本地日志 {self.directory}")
+
+    def open_segment(self, seq: int):
+        self.seq = seq
+        self.fd = os.open(
+            segment_path(self.directory, seq), os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o600
+        )
+        self.active_size = 0
+
+    async def append(self, payloads: List[bytes]):
+        """写入多条记录，fsync 完成后返回"""
+        data = b"".join(encode_record(payload) for payload in payloads)
+        if self.used + len(data) > self.max_bytes:
+            raise JournalFull(f"本地日志已占用 {self.used} 字节，超过上限 {self.max_bytes}")
+        if self.fd is None:
+            self.open()
+        elif self.active_size and self.active_size + len(data) > self.segment_bytes:
+            await self.rotate()
+
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view) :]
+        self.active_size += len(data)
+        self.used += len(data)
+        await self.commit()
+
+    async def commit(self):
+        """组提交：等待下一次 fsync，同一间隔内的写入共用一次"""
+        if self.fsync_interval <= 0:
+            async with self.sync_lock:
+                await asyncio.to_thread(os.fsync, self.fd)
+            return
+        if self.sync_waiter is None:
+            self.sync_waiter = asyncio.get_running_loop().create_future()
+            self.sync_task = asyncio.create_task(self.sync())
+        await asyncio.shield(self.sync_waiter)
+
+    async def sync(self):
+        await asyncio.sleep(self.fsync_interval)
+        async with self.sync_lock:
+            # 之后的写入等待下一次 fsync
+            waiter, self.sync_waiter = self.sync_waiter, None
+            try:
+                await asyncio.to_thread(os.fsync, self.fd)
+            except OSError as e:
+                waiter.set_exception(e)
+            else:
+                waiter.set_result(None)
+
+    async def rotate(self):
+        """封存当前分段，之后的写入进入下一个分段"""
+        async with self.sync_lock:
+            if self.fd is None or self.active_size == 0:
+                return
+            previous = self.fd
+            self.open_segment(self.seq + 1)
+            await asyncio.to_thread(os.fsync, previous)
+            os.close(previous)
+
+    def claim_orphans(self) -> Iterator[str]:
+        """
+        认领已退出的进程遗留的目录，处理期间持有其锁，其他进程不会重复认领
+        >>> import tempfile
+        >>> root = tempfile.mkdtemp()
+        >>> alive, exited = Journal(root, 1024, 1024, 0), Journal(root, 1024, 1024, 0)
+        >>> for journal in (alive, exited):
+        ...     asyncio.run(journal.append([b"x"]))
+        >>> os.close(exited.fd), os.close(exited.lock_fd)
+        (None, None)
+        >>> orphans = Journal(root, 1024, 1024, 0).claim_orphans()
+        >>> next(orphans) == exited.directory, list(Journal(root, 1024, 1024, 0).claim_orphans())
+        (True, [])
+        >>> list(orphans), [directory == exited.directory for directory in alive.claim_orphans()]
+        ([], [True])
+        >>> shutil.rmtree(root)
+        """
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            directory = os.path.join(self.root, name)
+            if name.startswith(".") or directory == self.directory or not os.path.isdir(directory):
+                continue
+            if (fd := lock_orphan(directory)) is None:
+                continue
+            try:
+                yield directory
+            finally:
+                os.close(fd)
+
+    async def replay(self, handler: Callable[[List[bytes]], Awaitable[None]], batch: int) -> int:
+        """
+        按写入顺序回放本进程已写入的记录和已退出进程遗留的日志
+        :param handler: 处理一批记录，抛出异常时保留回放位置，下次从该位置继续
+        :param batch: 每批记录数
+        :return: 回放的记录数
+
+        >>> import tempfile
+        >>> root = tempfile.mkdtemp()
+        >>> exited, journal = Journal(root, 1024, 1024, 0), Journal(root, 1024, 20, 0)
+        >>> async def write():
+        ...     await exited.append([b"a", b"b"])
+        ...     for payload in (b"c", b"d", b"e"):
+        ...         await journal.append([payload])
+        >>> asyncio.run(write())
+        >>> exited.close()
+        >>> replayed = []
+        >>> async def handler(payloads):
+        ...     replayed.extend(payloads)
+        >>> asyncio.run(journal.replay(handler, 10)), replayed, journal.used
+        (5, [b'a', b'b', b'c', b'd', b'e'], 0)
+        >>> sorted(os.listdir(root)) == [os.path.basename(journal.directory)]
+        True
+        >>> journal.close(), os.listdir(root)
+        (None, [])
+        """
+        replayed = 0
+        for directory in self.claim_orphans():
+            for path in list_segments(directory):
+                replayed += await self.replay_segment(path, handler, batch)
+            shutil.rmtree(directory, ignore_errors=True)
+
+        if self.directory and self.used:
+            await self.rotate()
+            for path in list_segments(self.directory):
+                if path != segment_path(self.directory, self.seq):
+                    size = os.path.getsize(path)
+                    replayed += await self.replay_segment(path, handler, batch)
+                    self.used -= size
+        return replayed
+
+    @staticmethod
+    async def replay_segment(
+        path: str, handler: Callable[[List[bytes]], Awaitable[None]], batch: int
+    ) -> int:
+        """
+        回放一个分段，每批处理成功后记录位置，处理失败后下次从该位置继续；全部回放后删除分段
+        >>> import tempfile
+        >>> path = segment_path(tempfile.mkdtemp(), 1)
+        >>> with open(path, "wb") as file:
+        ...     _ = file.write(b"".join(encode_record(payload) for payload in (b"a", b"b", b"c")))
+        >>> replayed, failures = [], [b"b"]
+        >>> async def handler(payloads):
+        ...     if payloads[0] in failures:
+        ...         failures.remove(payloads[0])
+        ...         raise ConnectionError("Redis 不可用")
+        ...     replayed.extend(payloads)
+        >>> asyncio.run(Journal.replay_segment(path, handler, 1))
+        Traceback (most recent call last):
+        ...
+        ConnectionError: Redis 不可用
+        >>> replayed, read_position(path)
+        ([b'a'], 9)
+        >>> asyncio.run(Journal.replay_segment(path, handler, 1)), replayed, os.path.exists(path)
+        (2, [b'a', b'b', b'c'], False)
+        """
+        replayed, payloads, offset = 0, [], 0
+        for offset, payload in read_records(path, read_position(path)):
+            payloads.append(payload)
+            if len(payloads) >= batch:
+                await handler(payloads)
+                write_position(path, offset)
+                replayed, payloads = replayed + len(payloads), []
+        if payloads:
+            await handler(payloads)
+            replayed += len(payloads)
+        os.remove(path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path[: -len(SEGMENT_SUFFIX)] + POSITION_SUFFIX)
+        return replayed
+
+    def close(self):
+        """进程退出时调用：全部回放完时删除目录，否则留给下次启动的进程回放"""
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        if self.directory and not self.used:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
@@ -1,34 +1,98 @@
-from ghkit.messenger.feishu import FeishuMessageType
+import time
+
+from ghkit.messenger.feishu import FeishuBotType, FeishuMessageType
 from ghkit.messenger.feishu.custom_bot import FeishuCustomBotMessageSender
+from ghkit.messenger.feishu.message import build_message
 
-from cores.config import settings
+from cores.config import FeishuConfig, parse_fields, settings
+from cores.http import FEISHU_LIMIT, get_http_client
 from cores.log import LOG
+from cores.providers import Provider, SendResult, build_router, register_provider_type
+
+
+class FeishuSendError(Exception):
+    """所有告警 webhook 都发送失败"""
+
+
+@register_provider_type("feishu")
+class FeishuProvider(Provider):
+    """飞书自定义机器人 webhook，[provider.{name}] 段需要 webhook_url、secret；消息为 (内容, 消息类型)"""
+
+    kind = "feishu"
+
+    def __init__(self, name: str, sender: FeishuCustomBotMessageSender, weight: float = 1.0):
+        super().__init__(name, weight)
+        self.sender = sender
+
+    @classmethod
+    def from_options(cls, name, options):
+        config = parse_fields(options, FeishuConfig)
+        return cls(
+            name, FeishuCustomBotMessageSender(webhook_url=config.webhook_url, secret=config.secret)
+        )
+
+    async def send(self, message) -> SendResult:
+        """通过共享连接池异步发送，不再为每条消息新建客户端"""
+        text, message_type = message
+        start = time.perf_counter()
+        try:
+            msg = build_message(text, message_type, FeishuBotType.CUSTOM)
+            msg.handle_secret(self.sender.secret)
+            async with FEISHU_LIMIT:
+                response = await get_http_client().post(
+                    url=self.sender.webhook_url, json=msg.msg_data
+                )
+            msg.handler_response(response)
+        except Exception as e:
+            LOG.warning(f"飞书 {self.name} 发送失败: {e}")
+            return SendResult(success=False, error=repr(e), elapsed=time.perf_counter() - start)
+        LOG.info(f"Message sent: {msg}")
+        return SendResult(success=True, elapsed=time.perf_counter() - start)
+
+    def send_sync(self, message) -> SendResult:
+        text, message_type = message
+        start = time.perf_counter()
+        try:
+            self.sender.send(message=text, message_type=message_type)
+        except Exception as e:
+            LOG.warning(f"飞书 {self.name} 发送失败: {e}")
+            return SendResult(success=False, error=repr(e), elapsed=time.perf_counter() - start)
+        return SendResult(success=True, elapsed=time.perf_counter() - start)
 
 
 class MessageSenderFactory:
-    """消息发送工厂"""
+    """消息发送工厂，经路由发送到 [routing] feishu_providers 中的 webhook，失败时换下一个"""
 
     def __init__(self):
         self.default_message_sender = FeishuCustomBotMessageSender(
             webhook_url=settings.feishu.webhook_url, secret=settings.feishu.secret
         )
+        self.router = build_router(
+            "feishu",
+            settings.routing.feishu_providers,
+            {"feishu": lambda: FeishuProvider("feishu", self.default_message_sender)},
+        )
+
+    @staticmethod
+    def check(result: SendResult):
+        if not result.success:
+            raise FeishuSendError(f"飞书消息发送失败: {result.error}")
 
     def send(
         self,
         text: str,
     ):
-        self.default_message_sender.send(message=text)
+        self.check(self.router.send_sync((text, FeishuMessageType.TEXT)))
 
     async def async_send(
         self,
         text: str,
+        message_type: FeishuMessageType = FeishuMessageType.TEXT,
     ):
-        await self.default_message_sender.async_send(message=text)
+        self.check(await self.router.send((text, message_type)))
 
     def send_alarm(self, message):
-        self.default_message_sender.send(
-            message=message, message_type=FeishuMessageType.INTERACTIVE
-        )
+        self.check(self.router.send_sync((message, FeishuMessageType.INTERACTIVE)))
 
 
 MESSAGE_FACTORY = MessageSenderFactory()
@@ -0,0 +1,389 @@
+"""
+Prometheus 文本格式的指标
+
+- 请求路径上只做进程内的字典累加，不加锁、不访问 Redis
+- 后台任务定期把增量 HINCRBYFLOAT 到 Redis，多个 uvicorn worker 和 task 进程的指标在 Redis 中汇总
+- 抓取时从 Redis 读取汇总值，并实时采集队列长度等指标
+"""
+
+import abc
+import asyncio
+import bisect
+import contextlib
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+from cores.config import settings
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS, REDIS
+
+METRICS_KEY = "metrics:{name}"
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def escape_label(value: str) -> str:
+    """
+    >>> escape_label('a"b\\nc')
+    'a\\\\"b\\\\nc'
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple) -> str:
+    return ",".join(
+        f'{name}="{escape_label(str(value))}"' for name, value in zip(labelnames, labelvalues)
+    )
+
+
+class Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        REGISTRY.append(self)
+
+    def label_key(self, labels: dict) -> str:
+        return format_labels(
+            self.labelnames, tuple(labels.get(name, "") for name in self.labelnames)
+        )
+
+    @abc.abstractmethod
+    def drain(self) -> Dict[str, float]:
+        """取出自上次以来的增量，返回 {Redis 字段: 增量}"""
+
+    @abc.abstractmethod
+    def restore(self, deltas: Dict[str, float]):
+        """写入 Redis 失败时放回 drain 取出的增量"""
+
+    @abc.abstractmethod
+    def render(self, fields: Dict[str, str]) -> List[str]:
+        """将 Redis 中的汇总值转换为 Prometheus 文本行"""
+
+
+class Counter(Metric):
+    """
+    >>> sent = Counter("doctest_sent_total", "发送数", ("status",))
+    >>> sent.inc(status="ok"), sent.inc(2, status="error")
+    (None, None)
+    >>> dict(sent.drain()), dict(sent.values)
+    ({'status="ok"': 1.0, 'status="error"': 2.0}, {})
+    >>> sent.render({'status="ok"': "3", 'status="error"': "2"})
+    ['doctest_sent_total{status="error"} 2', 'doctest_sent_total{status="ok"} 3']
+    >>> REGISTRY.remove(sent)
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[str, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[self.label_key(labels)] += amount
+
+    def drain(self) -> Dict[str, float]:
+        values, self.values = self.values, defaultdict(float)
+        return values
+
+    def restore(self, deltas: Dict[str, float]):
+        for labels, delta in deltas.items():
+            self.values[labels] += delta
+
+    def render(self, fields: Dict[str, str]) -> List[str]:
+        return [
+            f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}"
+            for labels, value in sorted(fields.items())
+        ]
+
+
+class Histogram(Metric):
+    """
+    Redis 字段为 "{标签}|{桶序号}" 和 "{标签}|sum"，只记录非累积的桶计数，输出时再累加
+    >>> latency = Histogram("doctest_latency_seconds", "耗时", buckets=(0.1, 1.0))
+    >>> for value in (0.05, 0.5, 0.5, 5):
+    ...     latency.observe(value)
+    >>> deltas = latency.drain()
+    >>> deltas
+    {'|0': 1, '|1': 2, '|2': 1, '|sum': 6.05}
+    >>> for line in latency.render({field: str(delta) for field, delta in deltas.items()}):
+    ...     print(line)
+    doctest_latency_seconds_bucket{le="0.1"} 1.0
+    doctest_latency_seconds_bucket{le="1.0"} 3.0
+    doctest_latency_seconds_bucket{le="+Inf"} 4.0
+    doctest_latency_seconds_sum 6.05
+    doctest_latency_seconds_count 4.0
+    >>> latency.restore(deltas)
+    >>> latency.drain() == deltas
+    True
+    >>> REGISTRY.remove(latency)
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        self.values: Dict[str, list] = {}  # labels -> [各桶计数..., +Inf 桶计数, 总和]
+
+    def state(self, labels: str) -> list:
+        if (state := self.values.get(labels)) is None:
+            state = self.values[labels] = [0] * (len(self.buckets) + 2)
+        return state
+
+    def observe(self, value: float, **labels):
+        state = self.state(self.label_key(labels))
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def drain(self) -> Dict[str, float]:
+        values, self.values = self.values, {}
+        deltas = {}
+        for labels, state in values.items():
+            for i, count in enumerate(state[:-1]):
+                if count:
+                    deltas[f"{labels}|{i}"] = count
+            deltas[f"{labels}|sum"] = state[-1]
+        return deltas
+
+    def restore(self, deltas: Dict[str, float]):
+        for field, delta in deltas.items():
+            labels, _, part = field.rpartition("|")
+            self.state(labels)[-1 if part == "sum" else int(part)] += delta
+
+    def render(self, fields: Dict[str, str]) -> List[str]:
+        series: Dict[str, dict] = defaultdict(dict)
+        for field, value in fields.items():
+            labels, _, part = field.rpartition("|")
+            series[labels][part] = float(value)
+
+        lines = []
+        bounds = [str(bucket) for bucket in self.buckets] + ["+Inf"]
+        for labels, parts in sorted(series.items()):
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0.0
+            for i, bound in enumerate(bounds):
+                cumulative += parts.get(str(i), 0)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {parts.get('sum', 0)}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+# 抓取时实时采集的指标：返回 [(名称, 说明, {标签字符串: 值})]
+COLLECTORS: List[Callable] = []
+
+SMS_ENQUEUE_SECONDS = Histogram("sms_enqueue_seconds", "/mas/send 去重入队耗时")
+SMS_ENQUEUE_MESSAGES = Histogram(
+    "sms_enqueue_messages", "/mas/send 每次请求的短信数", buckets=SIZE_BUCKETS
+)
+DEDUPE_TOTAL = Counter(
+    "dedupe_total", "重复消息过滤命中（hit）与未命中（miss）次数", ("namespace", "result")
+)
+DEDUPE_LOCAL_TOTAL = Counter(
+    "dedupe_local_total", "进程内去重缓存命中（hit）与未命中（miss）次数", ("namespace", "result")
+)
+FEISHU_FILTER_SECONDS = Histogram("feishu_filter_seconds", "apply_filter_rule 耗时")
+FEISHU_FILTER_TOTAL = Counter("feishu_filter_total", "飞书消息过滤结果", ("result",))
+FEISHU_DIGEST_TOTAL = Counter(
+    "feishu_digest_total",
+    "开启合并窗口时通过过滤的飞书消息：立即转发（forwarded）、记入汇总（coalesced）、发送的汇总卡片（digest）",
+    ("result",),
+)
+FEISHU_DISPATCH_TOTAL = Counter(
+    "feishu_dispatch_total",
+    "出站队列发送结果：sent、failed（业务错误）、throttled、retry、dead",
+    ("result",),
+)
+FEISHU_FORWARD_SECONDS = Histogram("feishu_forward_seconds", "转发到飞书的往返耗时", ("status",))
+MAS_SEND_SECONDS = Histogram("mas_send_seconds", "MAS 提交的往返耗时", ("result",))
+MAS_BATCH_MOBILES = Histogram("mas_batch_mobiles", "每次 MAS 提交的手机号数", buckets=SIZE_BUCKETS)
+CONSUMER_BATCH_SIZE = Histogram(
+    "sms_consumer_batch_size", "消费者每批取出的短信数", buckets=SIZE_BUCKETS
+)
+SMS_JOURNAL_TOTAL = Counter(
+    "sms_journal_total",
+    "Redis 不可用时的本地日志：spilled（写入）、rejected（写入失败）、replayed（回放入队）、duplicate（回放时重复）",
+    ("result",),
+)
+SMS_REPORT_TOTAL = Counter(
+    "sms_report_total",
+    "MAS 状态报告：delivered、undelivered、unmatched（找不到对应短信）",
+    ("result",),
+)
+PROVIDER_SEND_TOTAL = Counter(
+    "provider_send_total", "各出站供应商的提交结果：success、failure", ("provider", "result")
+)
+PROVIDER_ROUTE_TOTAL = Counter(
+    "provider_route_total",
+    "路由：failover（换下一个供应商）、hedge（对冲提交到备用供应商）、hedge_won（备用供应商先成功）",
+    ("router", "result"),
+)
+
+
+def queue_deltas(pipe) -> List[Tuple[Metric, Dict[str, float]]]:
+    drained = [(metric, metric.drain()) for metric in REGISTRY]
+    for metric, deltas in drained:
+        for field, delta in deltas.items():
+            pipe.hincrbyfloat(METRICS_KEY.format(name=metric.name), field, delta)
+    return drained
+
+
+def restore_deltas(drained: List[Tuple[Metric, Dict[str, float]]]):
+    for metric, deltas in drained:
+        metric.restore(deltas)
+
+
+async def flush():
+    """
+    将本进程的指标增量写入 Redis，写入失败时放回增量，下次一并写入
+    >>> from unittest import mock
+    >>> sent = Counter("doctest_flushed_total", "发送数")
+    >>> sent.inc(3)
+    >>> with mock.patch("redis.asyncio.client.Pipeline.execute", side_effect=ConnectionError):
+    ...     asyncio.run(flush())
+    Traceback (most recent call last):
+    ConnectionError
+    >>> dict(sent.values)
+    {'': 3.0}
+    >>> sent.inc(2)
+    >>> text = asyncio.run(render())
+    >>> for line in text.splitlines():
+    ...     if "doctest_flushed_total" in line:
+    ...         print(line)
+    # HELP doctest_flushed_total 发送数
+    # TYPE doctest_flushed_total counter
+    doctest_flushed_total 5
+    >>> REGISTRY.remove(sent)
+    """
+    async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+        drained = queue_deltas(pipe)
+        if pipe.command_stack:
+            try:
+                await pipe.execute()
+            except Exception:
+                restore_deltas(drained)
+                raise
+
+
+def flush_sync():
+    """
+    同步版本，供 poll 模式的定时任务使用
+    >>> from unittest import mock
+    >>> sent = Counter("doctest_flushed_sync_total", "发送数")
+    >>> sent.inc(3)
+    >>> with mock.patch("redis.client.Pipeline.execute", side_effect=ConnectionError):
+    ...     flush_sync()
+    Traceback (most recent call last):
+    ConnectionError
+    >>> flush_sync()
+    >>> REDIS.hgetall(METRICS_KEY.format(name=sent.name)), dict(sent.values)
+    ({'': '3'}, {})
+    >>> REGISTRY.remove(sent)
+    """
+    with REDIS.pipeline(transaction=False) as pipe:
+        drained = queue_deltas(pipe)
+        if pipe.command_stack:
+            try:
+                pipe.execute()
+            except Exception:
+                restore_deltas(drained)
+                raise
+
+
+async def run_flusher():
+    """后台定期写入，应用关闭时取消"""
+    try:
+        while True:
+            await asyncio.sleep(settings.metrics.flush_interval)
+            try:
+                await flush()
+            except Exception as e:
+                LOG.warning(f"写入指标失败: {e}")
+    finally:
+        with contextlib.suppress(Exception):
+            await flush()
+
+
+async def render() -> str:
+    """生成 Prometheus 文本格式"""
+    await flush()
+    async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+        for metric in REGISTRY:
+            pipe.hgetall(METRICS_KEY.format(name=metric.name))
+        all_fields = await pipe.execute()
+
+    lines = []
+    for metric, fields in zip(REGISTRY, all_fields):
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render(fields))
+
+    for collector in COLLECTORS:
+        for name, documentation, samples in await collector():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(
+                f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+                for labels, value in samples.items()
+            )
+    return "\n".join(lines) + "\n"
+
+
+async def start_exporter(port: int):
+    """task 等非 Web 进程的指标端口，任意路径都返回指标"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = (await render()).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except Exception as e:
+            LOG.warning(f"指标请求处理失败: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host="0.0.0.0", port=port)
+    LOG.info(f"Metrics exporter listening on {port}")
+    return server
@@ -0,0 +1,397 @@
+"""
+出站供应商注册与路由
+
+- 供应商类型通过 register_provider_type 注册，[mas]、[feishu] 为内置供应商，其他供应商在 [provider.{name}] 段中配置 type 和该类型的参数
+- [routing] 的 sms_providers / feishu_providers 列出参与路由的供应商及权重
+- 每个进程记录各供应商的 EWMA 延迟和错误率，按 权重 / (延迟 × (1 + error_penalty × 错误率)) 加权随机选择首选供应商，其余按得分从高到低作为备用
+- 熔断：连续失败 breaker_failures 次，或错误率超过 breaker_error_rate 时熔断，breaker_cooldown 秒内不再选择，之后放行一次试探，成功则恢复；
+  全部熔断时按熔断先后仍然尝试，不会直接丢弃
+- 提交失败时依次换下一个供应商；对冲的消息（如验证码）在首选供应商 hedge_delay 秒内未返回时同时提交到备用供应商，取先成功的结果，
+  另一个提交不取消（可能已被供应商接收），完成后仍计入其延迟和错误率
+"""
+
+import abc
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Mapping, Optional, Set, Type
+
+from cores.config import RoutingConfig, settings
+from cores.metrics import COLLECTORS, PROVIDER_ROUTE_TOTAL, PROVIDER_SEND_TOTAL, format_labels
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# 首选供应商还没有延迟数据时的对冲等待时间（秒）
+DEFAULT_HEDGE_DELAY = 1.0
+# 按 EWMA 延迟计算的对冲等待时间的倍数和下限（秒）
+HEDGE_LATENCY_FACTOR = 2.0
+MIN_HEDGE_DELAY = 0.05
+# 所有供应商都还没有延迟数据时用于计算得分的延迟（秒）
+DEFAULT_LATENCY = 1.0
+
+
+@dataclass
+class SendResult:
+    """一次提交的结果，供应商的结果类型至少包含这些字段"""
+
+    success: bool
+    error: str = ""
+    elapsed: float = 0.0
+    provider: str = ""
+
+
+class Provider(abc.ABC):
+    """
+    出站供应商，子类需实现 from_options、send、send_sync，缺少时实例化即报错
+    send / send_sync 返回带有 success、error、elapsed、provider 字段的结果，失败时不抛出异常
+    >>> class Incomplete(Provider):
+    ...     async def send(self, message):
+    ...         return SendResult(success=True)
+    >>> Incomplete("x")  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    TypeError: Can't instantiate abstract class Incomplete ...
+    """
+
+    kind = ""  # sms、feishu，只能加入同类的路由
+
+    def __init__(self, name: str, weight: float = 1.0):
+        self.name = name
+        self.weight = weight
+
+    @classmethod
+    @abc.abstractmethod
+    def from_options(cls, name: str, options: Mapping[str, str]) -> "Provider":
+        """由 [provider.{name}] 段创建"""
+
+    @abc.abstractmethod
+    async def send(self, message):
+        """异步提交"""
+
+    @abc.abstractmethod
+    def send_sync(self, message):
+        """同步提交，供 poll 模式和同步脚本使用"""
+
+
+PROVIDER_TYPES: Dict[str, Type[Provider]] = {}
+
+
+def register_provider_type(type_name: str) -> Callable[[Type[Provider]], Type[Provider]]:
+    """注册供应商类型，[provider.{name}] 段中 type = type_name 的供应商由该类的 from_options 创建"""
+
+    def decorator(cls: Type[Provider]) -> Type[Provider]:
+        PROVIDER_TYPES[type_name] = cls
+        return cls
+
+    return decorator
+
+
+def parse_weights(providers: str) -> Dict[str, float]:
+    """
+    解析供应商及权重，顺序即没有延迟数据时的优先顺序
+    >>> parse_weights("mas:3, backup:0.5, other")
+    {'mas': 3.0, 'backup': 0.5, 'other': 1.0}
+    """
+    result = {}
+    for item in providers.split(","):
+        name, _, weight = item.strip().partition(":")
+        if name.strip():
+            result[name.strip()] = float(weight) if weight else 1.0
+    return result
+
+
+class ProviderHealth:
+    """
+    单个供应商在本进程内的 EWMA 延迟、错误率和熔断状态
+    >>> config = RoutingConfig(breaker_failures=2, breaker_cooldown=10)
+    >>> health = ProviderHealth(config)
+    >>> health.observe(0.1, True, now=0); health.observe(0.2, True, now=0)
+    >>> round(health.latency, 3), health.error_rate, health.state
+    (0.12, 0.0, 'closed')
+    >>> health.observe(1.0, False, now=1); health.observe(1.0, False, now=2)
+    >>> health.state, health.available(now=5), health.available(now=12)
+    ('open', False, True)
+    >>> health.acquire(now=12); health.state, health.available(now=12)
+    ('half_open', False)
+    >>> health.observe(0.1, True, now=13); health.state, health.error_rate
+    ('closed', 0.0)
+    """
+
+    def __init__(self, config: RoutingConfig):
+        self.config = config
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples = 0  # 上次恢复以来的提交数
+        self.failures = 0  # 连续失败次数
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+
+    def available(self, now: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return now - self.opened_at >= self.config.breaker_cooldown
+        return not self.probing
+
+    def acquire(self, now: float):
+        """选中后调用，熔断冷却结束时转为半开，只放行这一次试探"""
+        if self.state == OPEN and now - self.opened_at >= self.config.breaker_cooldown:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            self.probing = True
+
+    def observe(self, elapsed: float, success: bool, now: float):
+        alpha = self.config.ewma_alpha
+        self.latency = (
+            elapsed if self.latency is None else alpha * elapsed + (1 - alpha) * self.latency
+        )
+        self.error_rate = alpha * (not success) + (1 - alpha) * self.error_rate
+        self.samples += 1
+        self.failures = 0 if success else self.failures + 1
+
+        if self.state == HALF_OPEN:
+            self.probing = False
+            if success:
+                # 重新开始统计错误率，避免熔断前的错误率立即再次触发熔断
+                self.state, self.error_rate, self.samples = CLOSED, 0.0, 0
+            else:
+                self.trip(now)
+        elif self.state == CLOSED and not success:
+            if self.failures >= self.config.breaker_failures or (
+                self.samples >= self.config.breaker_failures
+                and self.error_rate >= self.config.breaker_error_rate
+            ):
+                self.trip(now)
+
+    def trip(self, now: float):
+        self.state, self.opened_at = OPEN, now
+
+
+class ProviderRouter:
+    """
+    按延迟和错误率在多个供应商之间选择，失败时换下一个，需要时对冲
+    >>> class Stub(Provider):
+    ...     kind = "sms"
+    ...     def __init__(self, name, weight, outcomes, delay=0.0):
+    ...         super().__init__(name, weight)
+    ...         self.outcomes, self.delay = outcomes, delay
+    ...     @classmethod
+    ...     def from_options(cls, name, options):
+    ...         return cls(name, float(options.get("weight", 1)), [])
+    ...     async def send(self, message):
+    ...         await asyncio.sleep(self.delay)
+    ...         return SendResult(success=self.outcomes.pop(0), elapsed=self.delay)
+    ...     def send_sync(self, message):
+    ...         return SendResult(success=self.outcomes.pop(0))
+
+    首选供应商失败时换下一个，连续失败后熔断，不再被选中：
+
+    >>> providers = [Stub("a", 1e6, [False]), Stub("b", 1, [True])]
+    >>> router = ProviderRouter("doctest", providers, RoutingConfig(breaker_failures=1))
+    >>> result = asyncio.run(router.send("hi"))
+    >>> result.success, result.provider, router.health["a"].state
+    (True, 'b', 'open')
+    >>> [provider.name for provider in router.rank()]
+    ['b']
+
+    对冲：首选供应商 hedge_delay 内未返回时同时提交到备用供应商，取先成功的结果：
+
+    >>> providers = [Stub("slow", 1e6, [True], delay=0.2), Stub("fast", 1, [True])]
+    >>> router = ProviderRouter("doctest", providers, RoutingConfig(hedge_delay=0.01))
+    >>> asyncio.run(router.send("otp", hedge=True)).provider
+    'fast'
+    """
+
+    def __init__(
+        self,
+        name: str,
+        providers: List[Provider],
+        config: RoutingConfig,
+        rng: Optional[random.Random] = None,
+    ):
+        self.name = name
+        self.providers = providers
+        self.config = config
+        self.health = {provider.name: ProviderHealth(config) for provider in providers}
+        self.rng = rng or random.Random()
+        # 对冲后未取用结果的提交，保留引用直到完成
+        self.background: Set[asyncio.Future] = set()
+
+    def score(self, provider: Provider, default_latency: float) -> float:
+        health = self.health[provider.name]
+        latency = health.latency if health.latency is not None else default_latency
+        return provider.weight / (
+            max(latency, 0.001) * (1 + self.config.error_penalty * health.error_rate)
+        )
+
+    def rank(self, now: Optional[float] = None) -> List[Provider]:
+        """
+        按得分加权随机选出首选供应商，其余可用的按得分从高到低；
+        全部熔断时按熔断先后返回，仍然尝试
+        """
+        now = time.monotonic() if now is None else now
+        available = [
+            provider for provider in self.providers if self.health[provider.name].available(now)
+        ]
+        if not available:
+            return sorted(self.providers, key=lambda provider: self.health[provider.name].opened_at)
+
+        # 没有延迟数据的供应商按已观察到的平均延迟计算，保证分到流量
+        observed = [self.health[provider.name].latency for provider in available]
+        observed = [latency for latency in observed if latency is not None]
+        default_latency = sum(observed) / len(observed) if observed else DEFAULT_LATENCY
+        scores = {provider.name: self.score(provider, default_latency) for provider in available}
+
+        primary = self.rng.choices(
+            available, weights=[scores[provider.name] for provider in available]
+        )[0]
+        rest = sorted(
+            (provider for provider in available if provider is not primary),
+            key=lambda provider: scores[provider.name],
+            reverse=True,
+        )
+        return [primary, *rest]
+
+    def hedge_delay(self, provider: Provider) -> float:
+        if self.config.hedge_delay > 0:
+            return self.config.hedge_delay
+        latency = self.health[provider.name].latency
+        if latency is None:
+            return DEFAULT_HEDGE_DELAY
+        return max(latency * HEDGE_LATENCY_FACTOR, MIN_HEDGE_DELAY)
+
+    def record(self, provider: Provider, result, elapsed: float):
+        result.provider = provider.name
+        self.health[provider.name].observe(
+            result.elapsed or elapsed, result.success, time.monotonic()
+        )
+        PROVIDER_SEND_TOTAL.inc(
+            provider=provider.name, result="success" if result.success else "failure"
+        )
+
+    async def attempt(self, provider: Provider, message):
+        self.health[provider.name].acquire(time.monotonic())
+        start = time.perf_counter()
+        try:
+            result = await provider.send(message)
+        except BaseException:
+            # 供应商不应抛出异常，这里保证半开状态的试探不会一直占用
+            self.health[provider.name].observe(time.perf_counter() - start, False, time.monotonic())
+            raise
+        self.record(provider, result, time.perf_counter() - start)
+        return result
+
+    def attempt_sync(self, provider: Provider, message):
+        self.health[provider.name].acquire(time.monotonic())
+        start = time.perf_counter()
+        try:
+            result = provider.send_sync(message)
+        except BaseException:
+            self.health[provider.name].observe(time.perf_counter() - start, False, time.monotonic())
+            raise
+        self.record(provider, result, time.perf_counter() - start)
+        return result
+
+    async def send(self, message, hedge: bool = False):
+        """
+        提交到首选供应商，失败时依次换下一个
+        :param message: 供应商的 send 接受的消息
+        :param hedge: 首选供应商 hedge_delay 秒内未返回时同时提交到备用供应商
+        :return: 成功的结果，全部失败时为最后一个结果
+        """
+        ranked = self.rank()
+        if hedge and len(ranked) > 1:
+            result, tried = await self.hedged(message, ranked[0], ranked[1])
+        else:
+            result, tried = await self.attempt(ranked[0], message), 1
+        if not self.config.failover:
+            return result
+        for provider in ranked[tried:]:
+            if result.success:
+                break
+            PROVIDER_ROUTE_TOTAL.inc(router=self.name, result="failover")
+            result = await self.attempt(provider, message)
+        return result
+
+    async def hedged(self, message, primary: Provider, secondary: Provider):
+        """:return: (结果, 已尝试的供应商数)"""
+        first = asyncio.ensure_future(self.attempt(primary, message))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay(primary))
+        if done:
+            return first.result(), 1
+
+        PROVIDER_ROUTE_TOTAL.inc(router=self.name, result="hedge")
+        second = asyncio.ensure_future(self.attempt(secondary, message))
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result().success:
+                    if task is second:
+                        PROVIDER_ROUTE_TOTAL.inc(router=self.name, result="hedge_won")
+                    for other in pending:
+                        self.background.add(other)
+                        other.add_done_callback(self.background.discard)
+                    return task.result(), 2
+        return second.result(), 2
+
+    def send_sync(self, message):
+        """同步版本，供 poll 模式的定时任务和告警使用，只失败转移，不对冲"""
+        ranked = self.rank()
+        result = self.attempt_sync(ranked[0], message)
+        if not self.config.failover:
+            return result
+        for provider in ranked[1:]:
+            if result.success:
+                break
+            PROVIDER_ROUTE_TOTAL.inc(router=self.name, result="failover")
+            result = self.attempt_sync(provider, message)
+        return result
+
+    async def collect(self):
+        """抓取 /metrics 时采集本进程观察到的供应商状态"""
+        latency, errors, breaker = {}, {}, {}
+        for provider in self.providers:
+            health = self.health[provider.name]
+            labels = format_labels(("router", "provider"), (self.name, provider.name))
+            latency[labels] = health.latency or 0
+            errors[labels] = health.error_rate
+            breaker[labels] = int(health.state != CLOSED)
+        return [
+            ("provider_latency_ewma_seconds", "本进程观察到的供应商 EWMA 延迟", latency),
+            ("provider_error_rate", "本进程观察到的供应商 EWMA 错误率", errors),
+            ("provider_breaker_open", "供应商是否处于熔断（含半开试探）状态", breaker),
+        ]
+
+
+def build_router(
+    name: str, providers: str, builtins: Mapping[str, Callable[[], Provider]]
+) -> ProviderRouter:
+    """
+    按配置创建路由，并注册指标采集
+    :param name: 路由名称，同时为供应商的 kind
+    :param providers: 供应商及权重，如 mas:3,backup:1
+    :param builtins: 内置供应商名称 -> 创建函数，其他名称从 [provider.{name}] 段创建
+    """
+    created = []
+    for provider_name, weight in parse_weights(providers).items():
+        if provider_name in builtins:
+            provider = builtins[provider_name]()
+        else:
+            if provider_name not in settings.providers:
+                raise ValueError(f"未配置供应商 [provider.{provider_name}]")
+            options = settings.providers[provider_name]
+            if (cls := PROVIDER_TYPES.get(options.get("type", ""))) is None:
+                raise ValueError(f"[provider.{provider_name}] 的 type 未知: {options.get('type')}")
+            provider = cls.from_options(provider_name, options)
+        if provider.kind != name:
+            raise ValueError(f"供应商 {provider_name} 的类型为 {provider.kind}，不能用于 {name}")
+        provider.weight = weight
+        created.append(provider)
+    if not created:
+        raise ValueError(f"没有配置 {name} 供应商")
+
+    router = ProviderRouter(name, created, settings.routing)
+    COLLECTORS.append(router.collect)
+    return router
@@ -0,0 +1,109 @@
+import asyncio
+
+from cores.config import settings
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS
+
+# 令牌桶：KEYS[1] 为桶；ARGV[1] 每秒补充令牌数，ARGV[2] 桶容量，ARGV[3] 本次需要的令牌数
+# 使用 Redis 服务器时间，多个副本之间不受本地时钟偏差影响
+# 返回 {是否获得令牌, 还需等待的秒数}
+TOKEN_BUCKET_SCRIPT = ASYNC_REDIS.register_script(
+    """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = math.min(tonumber(ARGV[3]), burst)
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(wait)}
+"""
+)
+
+
+class RateLimiter:
+    """
+    集群共享的令牌桶限流器，多个进程、多个副本共用同一个桶
+    >>> limiter = RateLimiter("doctest", rate=1, burst=3)
+    >>> async def drain():
+    ...     return [round(await limiter.acquire(), 1) for _ in range(4)]
+
+    桶满时可以连续获取 burst 个令牌，之后返回还需等待的秒数：
+
+    >>> asyncio.run(drain())
+    [0.0, 0.0, 0.0, 1.0]
+
+    按 rate 补充令牌（将上次时间回拨 2 秒模拟经过的时间），补充后不超过 burst：
+
+    >>> async def refill(seconds):
+    ...     ts = float(await ASYNC_REDIS.hget(limiter.key, "ts"))
+    ...     await ASYNC_REDIS.hset(limiter.key, "ts", ts - seconds)
+    >>> asyncio.run(refill(2)); asyncio.run(drain())
+    [0.0, 0.0, 1.0, 1.0]
+    >>> asyncio.run(refill(60)); asyncio.run(drain())
+    [0.0, 0.0, 0.0, 1.0]
+
+    一次请求多个令牌时按缺少的令牌数计算等待时间，超过 max_wait 时放弃：
+
+    >>> round(asyncio.run(limiter.acquire(2)), 1)
+    2.0
+    >>> asyncio.run(limiter.wait(2, max_wait=0.5))
+    False
+    """
+
+    def __init__(self, name: str, rate: float, burst: int):
+        self.key = f"ratelimit:{name}"
+        self.rate = rate
+        self.burst = burst
+
+    async def acquire(self, tokens: int = 1) -> float:
+        """
+        尝试获取令牌
+        :param tokens:
+        :return: 0 表示已获得，否则为建议等待的秒数
+        """
+        allowed, wait = await TOKEN_BUCKET_SCRIPT(
+            keys=[self.key], args=[self.rate, self.burst, tokens]
+        )
+        return 0.0 if allowed else float(wait)
+
+    async def wait(self, tokens: int = 1, max_wait: float = None) -> bool:
+        """
+        等待直到获得令牌
+        :param tokens:
+        :param max_wait: 最长等待时间（秒），None 表示一直等待
+        :return: 是否获得令牌
+        """
+        waited = 0.0
+        while wait := await self.acquire(tokens):
+            if max_wait is not None and waited + wait > max_wait:
+                LOG.warning(f"限流等待超时 {self.key} {waited = }")
+                return False
+            await asyncio.sleep(wait)
+            waited += wait
+        return True
+
+
+def mas_rate_limiter() -> RateLimiter:
+    return RateLimiter("mas", settings.ratelimit.mas_rate, settings.ratelimit.mas_burst)
+
+
+def feishu_rate_limiter(token: str) -> RateLimiter:
+    """每个飞书 webhook 单独一个桶"""
+    return RateLimiter(
+        f"feishu:{token}", settings.ratelimit.feishu_rate, settings.ratelimit.feishu_burst
+    )
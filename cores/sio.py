@@ -4,10 +4,11 @@ import socketio
 from fastapi_socketio import SocketManager
 
 from cores.config import settings
+from cores.emitter import CHANNEL
 from cores.log import LOG
 
-# 使用 Redis 作为消息传递的后端
-redis_manager = socketio.AsyncRedisManager(settings.redis.db_url)
+# 使用 Redis 作为消息传递的后端，只在 API 进程附加 Socket.IO 时创建；推送消息使用 cores.emitter
+redis_manager: Optional[socketio.AsyncRedisManager] = None
 
 # 定义 Socket.IO 实例
 sio: Optional[SocketManager] = None
@@ -16,7 +17,8 @@ sio: Optional[SocketManager] = None
 # 将 Socket.IO 附加到 FastAPI 应用的函数
 def attach_socketio(app):
     LOG.info("Attaching Socket.IO...")
-    global sio
+    global redis_manager, sio
+    redis_manager = socketio.AsyncRedisManager(settings.redis.db_url, channel=CHANNEL)
     sio = SocketManager(app=app, client_manager=redis_manager)
     LOG.info("Socket.IO attached.")
 
@@ -1,12 +1,88 @@
+import asyncio
 import base64
 import hashlib
 import json
-from typing import Dict, List, Union
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
 
+import httpx
 import requests
 
-from cores.config import settings
+from cores.config import MasConfig, parse_fields, settings
+from cores.http import get_http_client
 from cores.log import LOG
+from cores.metrics import MAS_BATCH_MOBILES, MAS_SEND_SECONDS
+from cores.providers import Provider, build_router, register_provider_type
+from cores.ratelimit import RateLimiter, mas_rate_limiter
+
+
+class SmsSendError(Exception):
+    """短信发送失败"""
+
+
+@dataclass
+class SmsBatch:
+    """一次 MAS 提交：相同内容发送给多个手机号"""
+
+    mobiles: List[str]
+    content: str
+    add_serial: str = ""
+    sign: str = ""  # 为空时使用配置中的签名
+    items: list = field(default_factory=list)  # 本次提交覆盖的队列短信
+
+
+def group_messages(sms_list: List[dict], max_mobiles: int) -> List[SmsBatch]:
+    """
+    按 (内容, 签名, 扩展码) 分组，合并为尽量少的 MAS 提交
+    同一手机号在一次提交中只出现一次，重复的短信放入下一次提交，不会丢失
+    >>> sms_list = [
+    ...     {"phone_number": "1", "message": "a"},
+    ...     {"phone_number": "2", "message": "a"},
+    ...     {"phone_number": "1", "message": "a"},
+    ...     {"phone_number": "3", "message": "b"},
+    ...     {"phone_number": "4", "message": "a"},
+    ... ]
+    >>> [(batch.mobiles, batch.content) for batch in group_messages(sms_list, max_mobiles=2)]
+    [(['1', '2'], 'a'), (['1', '4'], 'a'), (['3'], 'b')]
+
+    :param sms_list: 队列中的短信
+    :param max_mobiles: 单次提交最多手机号数
+    :return:
+    """
+    groups: Dict[tuple, List[tuple]] = {}
+    batches = []
+    for sms in sms_list:
+        key = (sms["message"], sms.get("sign") or "", sms.get("add_serial") or "")
+        phone_number = sms["phone_number"]
+        chunks = groups.setdefault(key, [])
+        for batch, mobiles in chunks:
+            if phone_number not in mobiles and len(batch.mobiles) < max_mobiles:
+                break
+        else:
+            batch, mobiles = (
+                SmsBatch(mobiles=[], content=key[0], sign=key[1], add_serial=key[2]),
+                set(),
+            )
+            chunks.append((batch, mobiles))
+            batches.append(batch)
+        batch.mobiles.append(phone_number)
+        batch.items.append(sms)
+        mobiles.add(phone_number)
+    return batches
+
+
+@dataclass
+class SmsSendResult:
+    """一次 MAS 提交的结果"""
+
+    batch: SmsBatch
+    success: bool
+    msg_group: str = ""  # MAS 返回的批次号，用于关联状态报告
+    error: str = ""
+    response: dict = field(default_factory=dict)
+    elapsed: float = 0.0
+    provider: str = ""  # 经路由提交时为供应商名称
 
 
 class CMCCMasSMS:
@@ -26,39 +102,66 @@ class CMCCMasSMS:
         生成签名 将ecName、apId、secretKey、mobiles、content、sign、addSerial按序拼接（无间隔符），通过MD5（32位小写）计算得出值。
         """
         raw_string = (
-            f"{self.ec_name}{self.app_id}{self.secret_key}{data['mobiles']}{data['content']}{data['sign']}{data['addSerial']}"
+            f"{self.ec_name}{self.app_id}{self.secret_key}"
+            f"{data['mobiles']}{data['content']}{data['sign']}{data['addSerial']}"
         )
         return hashlib.md5(raw_string.encode("utf-8")).hexdigest()
 
-    def send_sms(self, phone_numbers: Union[List[str], str], message: Union[Dict, str], add_serial: str = ""):
-        """
-        发送短信
-        :param phone_numbers: 接收短信的手机号（支持多个，用逗号分隔）
-        :param message: 短信内容
-        :param add_serial: 扩展码，可选
-        :return: 请求响应
-        >>> MasSMS.send_sms("15259616715", "您的验证码是123456")
-        {'message': 'NOT_WHITE_IP', 'success': False}
-        """
+    def build_payload(
+        self,
+        phone_numbers: Union[List[str], str],
+        message: Union[Dict, str],
+        add_serial: str = "",
+        sign: str = "",
+    ) -> str:
+        """生成签名后的请求体（base64 编码的 JSON）"""
         payload = {
             "ecName": self.ec_name,
             "apId": self.app_id,
             "mobiles": phone_numbers if isinstance(phone_numbers, str) else ",".join(phone_numbers),
-            "content": message if isinstance(message, str) else json.dumps({"content": message}, ensure_ascii=False),
-            "sign": self.sign,
+            "content": (
+                message
+                if isinstance(message, str)
+                else json.dumps({"content": message}, ensure_ascii=False)
+            ),
+            "sign": sign or self.sign,
             "addSerial": add_serial,
         }
         signature = self.generate_signature(payload)
         payload["mac"] = signature
         LOG.info(json.dumps(payload, ensure_ascii=False))
-        encode = base64.b64encode(json.dumps(payload, ensure_ascii=False).encode("utf-8")).decode("utf-8")
+        return base64.b64encode(json.dumps(payload, ensure_ascii=False).encode("utf-8")).decode(
+            "utf-8"
+        )
+
+    def send_sms(
+        self,
+        phone_numbers: Union[List[str], str],
+        message: Union[Dict, str],
+        add_serial: str = "",
+        sign: str = "",
+    ):
+        """
+        发送短信
+        :param phone_numbers: 接收短信的手机号（支持多个，用逗号分隔）
+        :param message: 短信内容
+        :param add_serial: 扩展码，可选
+        :param sign: 签名，默认使用配置中的签名
+        :return: 请求响应
+        >>> MasSMS.send_sms("15259616715", "您的验证码是123456")
+        {'message': 'NOT_WHITE_IP', 'success': False}
+        """
+        encode = self.build_payload(phone_numbers, message, add_serial, sign)
+        start, result = time.perf_counter(), "failure"
         try:
             response = requests.post(f"{self.api_url}", json=encode, verify=False, timeout=5)
             response_data = response.json() if response.status_code == 200 else {}
             if not response_data.get("success", False):
                 raise Exception(f"短信发送失败: {response_data}")
             else:
+                result = "success"
                 LOG.info(f"短信发送成功: {response_data}")
+                return response_data
 
         except requests.RequestException as e:
             LOG.exception(f"发送短信时发生网络异常: {e}")
@@ -66,6 +169,107 @@ class CMCCMasSMS:
         except Exception as e:
             LOG.exception(f"发送短信时发生未知异常: {e}")
             raise e
+        finally:
+            MAS_SEND_SECONDS.observe(time.perf_counter() - start, result=result)
+            MAS_BATCH_MOBILES.observe(
+                len(phone_numbers.split(",") if isinstance(phone_numbers, str) else phone_numbers)
+            )
+
+
+class AsyncCMCCMasSMS(CMCCMasSMS):
+    """
+    异步的 MAS 客户端
+    - 复用 keep-alive 连接池，避免每批短信一次 TLS 握手
+    - send_many 在并发上限内并行提交多批短信
+    - 返回结构化的每批结果，不抛出异常
+
+    业务失败记录 MAS 返回的错误码，HTTP 错误和网络异常同样作为失败返回，结果与提交一一对应：
+
+    >>> import httpx
+    >>> from cores.http import _clients
+    >>> def mas(request):
+    ...     content = json.loads(base64.b64decode(json.loads(request.content)))["content"]
+    ...     if content == "down":
+    ...         raise httpx.ConnectError("connection refused")
+    ...     if content == "busy":
+    ...         return httpx.Response(502)
+    ...     ok = content == "ok"
+    ...     reply = {"success": ok, "rspcod": "success" if ok else "IllegalMac"}
+    ...     return httpx.Response(200, json={**reply, "msgGroup": "g1" if ok else ""})
+    >>> _clients["mas"] = httpx.AsyncClient(transport=httpx.MockTransport(mas))
+    >>> client = AsyncCMCCMasSMS("app", "key", "ec", "http://mas.invalid/sms", "sign")
+    >>> batches = [SmsBatch(mobiles=["138"], content=c) for c in ("ok", "bad", "busy", "down")]
+    >>> for result in asyncio.run(client.send_many(batches)):
+    ...     print((result.batch.content, result.success, result.msg_group, result.error))
+    ('ok', True, 'g1', '')
+    ('bad', False, '', 'IllegalMac')
+    ('busy', False, '', 'HTTP 502')
+    ('down', False, '', "ConnectError('connection refused')")
+    >>> del _clients["mas"]
+    """
+
+    def __init__(
+        self,
+        app_id,
+        secret_key,
+        ec_name,
+        api_url,
+        sign,
+        concurrency: int = 4,
+        rate_limiter: Optional[RateLimiter] = None,
+    ):
+        super().__init__(app_id, secret_key, ec_name, api_url, sign)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate_limiter = rate_limiter
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return get_http_client("mas", verify=False)
+
+    async def async_send_sms(self, batch: SmsBatch) -> SmsSendResult:
+        """提交一批短信，并记录耗时指标"""
+        result = await self.submit(batch)
+        MAS_SEND_SECONDS.observe(result.elapsed, result="success" if result.success else "failure")
+        MAS_BATCH_MOBILES.observe(len(batch.mobiles))
+        return result
+
+    async def submit(self, batch: SmsBatch) -> SmsSendResult:
+        encode = self.build_payload(batch.mobiles, batch.content, batch.add_serial, batch.sign)
+        if self.rate_limiter:
+            await self.rate_limiter.wait()
+        start = time.perf_counter()
+        async with self.semaphore:
+            try:
+                response = await self.client.post(self.api_url, json=encode)
+                response_data = response.json() if response.status_code == 200 else {}
+            except (httpx.HTTPError, ValueError) as e:
+                LOG.exception(f"发送短信时发生网络异常: {e}")
+                return SmsSendResult(
+                    batch=batch, success=False, error=repr(e), elapsed=time.perf_counter() - start
+                )
+
+        elapsed = time.perf_counter() - start
+        if not response_data.get("success", False):
+            LOG.error(f"短信发送失败: {response.status_code} {response_data}")
+            return SmsSendResult(
+                batch=batch,
+                success=False,
+                error=response_data.get("rspcod") or f"HTTP {response.status_code}",
+                response=response_data,
+                elapsed=elapsed,
+            )
+        LOG.info(f"短信发送成功: {response_data}")
+        return SmsSendResult(
+            batch=batch,
+            success=True,
+            msg_group=response_data.get("msgGroup", ""),
+            response=response_data,
+            elapsed=elapsed,
+        )
+
+    async def send_many(self, batches: List[SmsBatch]) -> List[SmsSendResult]:
+        """并行提交多批短信，并发数受 concurrency 限制，结果与 batches 一一对应"""
+        return list(await asyncio.gather(*(self.async_send_sms(batch) for batch in batches)))
 
 
 MasSMS = CMCCMasSMS(
@@ -73,5 +277,106 @@ MasSMS = CMCCMasSMS(
     secret_key=settings.mas.secret_key,
     ec_name=settings.mas.ec_name,
     api_url=settings.mas.api_url,
-    sign=settings.mas.sign
+    sign=settings.mas.sign,
 )
+
+AsyncMasSMS = AsyncCMCCMasSMS(
+    app_id=settings.mas.app_id,
+    secret_key=settings.mas.secret_key,
+    ec_name=settings.mas.ec_name,
+    api_url=settings.mas.api_url,
+    sign=settings.mas.sign,
+    concurrency=settings.mas.concurrency,
+    rate_limiter=mas_rate_limiter() if settings.ratelimit.enabled else None,
+)
+
+
+@register_provider_type("mas")
+class MasProvider(Provider):
+    """移动 MAS 短信供应商，[provider.{name}] 段的参数与 [mas] 相同，每个供应商单独一个限流桶"""
+
+    kind = "sms"
+
+    def __init__(
+        self, name: str, client: AsyncCMCCMasSMS, sync_client: CMCCMasSMS, weight: float = 1.0
+    ):
+        super().__init__(name, weight)
+        self.client = client
+        self.sync_client = sync_client
+
+    @classmethod
+    def from_options(cls, name, options):
+        config = parse_fields(options, MasConfig)
+        client = AsyncCMCCMasSMS(
+            app_id=config.app_id,
+            secret_key=config.secret_key,
+            ec_name=config.ec_name,
+            api_url=config.api_url,
+            sign=config.sign,
+            concurrency=config.concurrency,
+            rate_limiter=(
+                RateLimiter(
+                    f"mas:{name}", settings.ratelimit.mas_rate, settings.ratelimit.mas_burst
+                )
+                if settings.ratelimit.enabled
+                else None
+            ),
+        )
+        return cls(
+            name,
+            client,
+            CMCCMasSMS(
+                config.app_id, config.secret_key, config.ec_name, config.api_url, config.sign
+            ),
+        )
+
+    async def send(self, batch: SmsBatch) -> SmsSendResult:
+        return await self.client.async_send_sms(batch)
+
+    def send_sync(self, batch: SmsBatch) -> SmsSendResult:
+        start = time.perf_counter()
+        try:
+            response = self.sync_client.send_sms(
+                batch.mobiles, batch.content, batch.add_serial, batch.sign
+            )
+        except Exception as e:
+            return SmsSendResult(
+                batch=batch, success=False, error=repr(e), elapsed=time.perf_counter() - start
+            )
+        return SmsSendResult(
+            batch=batch,
+            success=True,
+            msg_group=response.get("msgGroup", ""),
+            response=response,
+            elapsed=time.perf_counter() - start,
+        )
+
+
+SMS_ROUTER = build_router(
+    "sms", settings.routing.sms_providers, {"mas": lambda: MasProvider("mas", AsyncMasSMS, MasSMS)}
+)
+
+HEDGE_LANES = {lane.strip() for lane in settings.routing.hedge_lanes.split(",") if lane.strip()}
+
+
+def is_hedged(batch: SmsBatch) -> bool:
+    """
+    批次中有对冲通道的短信（如验证码）时对冲，默认 hedge_lanes 为空不对冲
+    >>> batch = SmsBatch(mobiles=["1"], content="a", items=[{"priority": "otp"}])
+    >>> is_hedged(batch)
+    False
+    >>> HEDGE_LANES.add("otp")
+    >>> is_hedged(batch), is_hedged(SmsBatch(mobiles=["1"], content="a", items=[{}]))
+    (True, False)
+    >>> HEDGE_LANES.discard("otp")
+    """
+    return any(
+        (sms.get("priority") or settings.queue.default_lane) in HEDGE_LANES for sms in batch.items
+    )
+
+
+async def send_batches(batches: List[SmsBatch]) -> List[SmsSendResult]:
+    """经路由并行提交多批短信，结果与 batches 一一对应"""
+    return list(
+        await asyncio.gather(*(SMS_ROUTER.send(batch, hedge=is_hedged(batch)) for batch in batches))
+    )
@@ -0,0 +1,185 @@
+"""
+Redis 不可用时的短信入队降级（[journal] enabled）
+
+- enqueue_sms 遇到 Redis 连接错误或超时时，短信写入本地追加日志（cores.journal）后返回已接收，并进入降级状态；
+  降级期间后续请求直接写日志，不再等待 Redis 超时
+- 后台回放任务每 replay_interval 秒检查一次：Redis 恢复后退出降级，按 replay_batch 条一批去重入队（每批一次往返），
+  并补写 queued / scheduled 状态；日志中的短信入队前未经去重，回放时按原摘要去重
+- Redis 超时时短信可能已经入队又写入了日志，回放时在去重时间内会被过滤，超过去重时间则可能重复发送（至少一次）
+"""
+
+import asyncio
+import os
+import time
+from itertools import groupby
+from typing import List, Optional, Tuple
+
+import orjson
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+
+from cores.config import settings
+from cores.journal import Journal, JournalFull
+from cores.log import LOG
+from cores.metrics import COLLECTORS, SMS_JOURNAL_TOTAL
+from cores.redis import ASYNC_REDIS
+from cores.sms_queue import enqueue, schedule
+from cores.sms_status import record_accepted
+
+# 视为 Redis 不可用、需要写入日志的错误
+REDIS_UNAVAILABLE = (RedisConnectionError, RedisTimeoutError)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def journal_dir(path: str) -> str:
+    """相对路径按项目根目录解析"""
+    return path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+
+
+SMS_JOURNAL = Journal(
+    journal_dir(settings.journal.dir),
+    max_bytes=settings.journal.max_bytes,
+    segment_bytes=settings.journal.segment_bytes,
+    fsync_interval=settings.journal.fsync_interval,
+)
+
+
+class Degraded:
+    """Redis 不可用的状态，由回放任务确认恢复后清除"""
+
+    since: Optional[float] = None
+
+    @classmethod
+    def enter(cls, reason):
+        if cls.since is None:
+            cls.since = time.time()
+            LOG.error(f"Redis 不可用，短信写入本地日志: {reason}")
+
+    @classmethod
+    def leave(cls):
+        if cls.since is not None:
+            LOG.warning(f"Redis 已恢复，降级持续 {time.time() - cls.since:.1f} 秒")
+            cls.since = None
+
+
+def encode(items: List[Tuple[str, str]], lanes: List[str], send_at: Optional[float]) -> List[bytes]:
+    return [
+        orjson.dumps({"digest": digest, "payload": payload, "lane": lane, "send_at": send_at})
+        for (digest, payload), lane in zip(items, lanes)
+    ]
+
+
+async def spill(items: List[Tuple[str, str]], lanes: List[str], send_at: Optional[float]):
+    """写入本地日志，fsync 后返回；超过 max_bytes 时抛出 JournalFull"""
+    try:
+        await SMS_JOURNAL.append(encode(items, lanes, send_at))
+    except JournalFull as e:
+        SMS_JOURNAL_TOTAL.inc(len(items), result="rejected")
+        LOG.error(f"Redis 不可用且本地日志已满: {e}")
+        raise
+    except Exception:
+        SMS_JOURNAL_TOTAL.inc(len(items), result="rejected")
+        raise
+    SMS_JOURNAL_TOTAL.inc(len(items), result="spilled")
+    # Redis 恢复后回放时去重入队并记录状态
+    LOG.warning(f"Redis 不可用，{len(items)} 条短信已写入本地日志")
+
+
+async def enqueue_or_spill(
+    items: List[Tuple[str, str]], lanes: List[str], send_at: Optional[float] = None
+) -> Optional[List[bool]]:
+    """
+    去重入队，定时短信放入定时集合；开启日志且 Redis 不可用时写入本地日志，日志已满时抛出 JournalFull
+    :return: 与 items 一一对应的入队结果，写入日志时为 None
+    """
+    if settings.journal.enabled and Degraded.since is not None:
+        await spill(items, lanes, send_at)
+        return None
+    try:
+        if send_at is not None:
+            return await schedule(items, send_at=send_at, lanes=lanes)
+        return await enqueue(items, lanes=lanes)
+    except REDIS_UNAVAILABLE as e:
+        if not settings.journal.enabled:
+            raise
+        Degraded.enter(e)
+        await spill(items, lanes, send_at)
+        return None
+
+
+async def replay_records(payloads: List[bytes]):
+    """
+    回放一批记录：按定时时间分组入队，并补写状态；去重时间内重复的短信只入队一次
+    >>> import asyncio
+    >>> from cores.sms_status import lookup
+    >>> def item(n):
+    ...     return f"d{n}", orjson.dumps({"id": f"id{n}", "phone_number": "138"}).decode()
+    >>> payloads = encode([item(0), item(0), item(1)], ["", "", "otp"], None)
+    >>> payloads += encode([item(2)], [""], 4102444800.0)
+    >>> async def replay():
+    ...     await replay_records(payloads)
+    ...     statuses = await lookup(["id0", "id1", "id2"])
+    ...     print(await ASYNC_REDIS.llen("sms_queue"), await ASYNC_REDIS.llen("sms_queue:lane:otp"))
+    ...     print({sms_id: status["status"] for sms_id, status in statuses.items()})
+    >>> asyncio.run(replay())
+    1 1
+    {'id0': 'queued', 'id1': 'queued', 'id2': 'scheduled'}
+    """
+    records = [orjson.loads(payload) for payload in payloads]
+    for send_at, group in groupby(records, key=lambda record: record["send_at"]):
+        group = list(group)
+        items = [(record["digest"], record["payload"]) for record in group]
+        lanes = [record["lane"] for record in group]
+        if send_at is not None:
+            results = await schedule(items, send_at=send_at, lanes=lanes)
+        else:
+            results = await enqueue(items, lanes=lanes)
+
+        accepted = [orjson.loads(record["payload"]) for record, ok in zip(group, results) if ok]
+        SMS_JOURNAL_TOTAL.inc(len(accepted), result="replayed")
+        SMS_JOURNAL_TOTAL.inc(len(group) - len(accepted), result="duplicate")
+        await record_accepted(
+            [
+                (sms["id"], sms["phone_number"], sms.get("room", ""))
+                for sms in accepted
+                if sms.get("id")
+            ],
+            send_at=send_at,
+        )
+
+
+async def run_replayer():
+    """后台回放，各 worker 都运行，已退出进程遗留的日志只会被一个进程认领"""
+    try:
+        while True:
+            await asyncio.sleep(settings.journal.replay_interval)
+            try:
+                if Degraded.since is not None:
+                    await ASYNC_REDIS.ping()
+                    Degraded.leave()
+                if replayed := await SMS_JOURNAL.replay(
+                    replay_records, settings.journal.replay_batch
+                ):
+                    LOG.warning(f"已从本地日志回放短信 {replayed} 条")
+            except REDIS_UNAVAILABLE as e:
+                Degraded.enter(e)
+            except Exception as e:
+                LOG.warning(f"回放本地日志失败: {e}")
+    finally:
+        SMS_JOURNAL.close()
+
+
+async def journal_metrics():
+    """抓取 /metrics 时采集本进程的日志积压和降级状态"""
+    return [
+        ("sms_journal_bytes", "本进程本地日志中未回放的字节数", {"": SMS_JOURNAL.used}),
+        (
+            "sms_journal_degraded",
+            "本进程是否处于 Redis 不可用的降级状态",
+            {"": int(Degraded.since is not None)},
+        ),
+    ]
+
+
+COLLECTORS.append(journal_metrics)
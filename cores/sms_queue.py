@@ -0,0 +1,1010 @@
+import json
+import os
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+from redis.exceptions import ResponseError
+
+from cores.config import QueueConfig, settings
+from cores.dedupe import DEDUPE_LUA, SMS_DEDUPER, Deduper
+from cores.log import LOG
+from cores.metrics import COLLECTORS, format_labels
+from cores.redis import ASYNC_REDIS, REDIS
+
+SMS_QUEUE_KEY = "sms_queue"
+SMS_STREAM_KEY = "sms_stream"
+SMS_STREAM_GROUP = "sms_consumers"
+SMS_SCHEDULED_KEY = "sms_scheduled"
+
+# 单次脚本调用处理的短信数，避免大批量时长时间占用 Redis
+ENQUEUE_CHUNK_SIZE = 500
+
+# 批量去重并入队：KEYS 依次为 (队列, 去重当前 key, 去重上一个 key)；
+# ARGV[1] 为 list、stream 或 zset（定时集合），ARGV[2] 为去重方式，ARGV[3] 为去重时间，ARGV[4] 为当前时间，
+# ARGV[5] 为 Streams MAXLEN 近似上限，ARGV[6..] 依次为 (去重成员, 定时发送时间, 短信内容)
+# 返回每条短信是否入队（1 入队，0 重复）
+ENQUEUE_SCRIPT = ASYNC_REDIS.register_script(
+    DEDUPE_LUA
+    + """
+local results = {}
+for i = 1, #KEYS / 3 do
+    local queue, arg = KEYS[i * 3 - 2], i * 3 + 3
+    if is_new(ARGV[2], KEYS[i * 3 - 1], KEYS[i * 3], ARGV[arg], ARGV[3], ARGV[4]) then
+        if ARGV[1] == 'stream' then
+            redis.call('XADD', queue, 'MAXLEN', '~', ARGV[5], '*', 'data', ARGV[arg + 2])
+        elseif ARGV[1] == 'zset' then
+            redis.call('ZADD', queue, ARGV[arg + 1], ARGV[arg + 2])
+        else
+            redis.call('LPUSH', queue, ARGV[arg + 2])
+        end
+        results[#results + 1] = 1
+    else
+        results[#results + 1] = 0
+    end
+end
+return results
+"""
+)
+
+# 将到期的定时短信移入队列：KEYS 依次为 (定时集合, 队列) 对；
+# ARGV[1] 为当前时间，ARGV[2] 为每个集合单次最多移动条数，ARGV[3] 为 list 或 stream，ARGV[4] 为 MAXLEN 近似上限
+# 每条短信的代价为 O(log n)，不扫描未到期的短信
+# 返回 {移动数量, 是否还有到期未移动的短信, 下一条到期时间}
+PROMOTE_SCHEDULED_SOURCE = """
+local moved = 0
+local more = 0
+local next_due = false
+for i = 1, #KEYS / 2 do
+    local zset, queue = KEYS[i * 2 - 1], KEYS[i * 2]
+    local due = redis.call('ZRANGEBYSCORE', zset, '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, item in ipairs(due) do
+        if ARGV[3] == 'stream' then
+            redis.call('XADD', queue, 'MAXLEN', '~', ARGV[4], '*', 'data', item)
+        else
+            redis.call('LPUSH', queue, item)
+        end
+    end
+    if #due > 0 then
+        redis.call('ZREM', zset, unpack(due))
+        moved = moved + #due
+    end
+    if #due >= tonumber(ARGV[2]) then
+        more = 1
+    end
+    local head = redis.call('ZRANGE', zset, 0, 0, 'WITHSCORES')
+    if head[2] and (not next_due or tonumber(head[2]) < tonumber(next_due)) then
+        next_due = head[2]
+    end
+end
+return {moved, more, next_due}
+"""
+PROMOTE_SCHEDULED_SCRIPT = ASYNC_REDIS.register_script(PROMOTE_SCHEDULED_SOURCE)
+# poll 模式的 MasTask 是同步的
+PROMOTE_SCHEDULED_SYNC_SCRIPT = REDIS.register_script(PROMOTE_SCHEDULED_SOURCE)
+
+
+def parse_lanes(lanes: str) -> Dict[str, int]:
+    """
+    解析优先级通道配置，顺序即优先级
+    >>> parse_lanes("otp:10, normal:3, bulk")
+    {'otp': 10, 'normal': 3, 'bulk': 1}
+    """
+    result = {}
+    for item in lanes.split(","):
+        name, _, weight = item.strip().partition(":")
+        result[name.strip()] = int(weight) if weight else 1
+    return result
+
+
+def lane_key(base: str, lane: str = "") -> str:
+    """
+    通道对应的 Redis key，默认通道沿用原有的 sms_queue / sms_stream
+    >>> lane_key(SMS_QUEUE_KEY, "otp")
+    'sms_queue:lane:otp'
+    >>> lane_key(SMS_QUEUE_KEY, "normal")
+    'sms_queue'
+    """
+    if not lane or lane == settings.queue.default_lane:
+        return base
+    return f"{base}:lane:{lane}"
+
+
+async def run_enqueue(
+    items: List[Tuple[str, str]],
+    deduper: Deduper,
+    target: str,
+    queues: List[str],
+    send_at: float = 0,
+) -> List[bool]:
+    """分块执行入队脚本，所有分块在一个 pipeline 中一次往返完成"""
+    now = int(time.time())
+    async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+        for start in range(0, len(items), ENQUEUE_CHUNK_SIZE):
+            keys, args = [], [target, deduper.mode, deduper.ttl, now, settings.queue.stream_maxlen]
+            for (digest, payload), queue in zip(
+                items[start : start + ENQUEUE_CHUNK_SIZE], queues[start:]
+            ):
+                dedupe_keys, member = deduper.script_args(digest, now)
+                keys += [queue, *dedupe_keys]
+                args += [member, send_at, payload]
+            await ENQUEUE_SCRIPT(keys=keys, args=args, client=pipe)
+        chunk_results = await pipe.execute()
+
+    return [bool(result) for results in chunk_results for result in results]
+
+
+async def enqueue(
+    items: List[Tuple[str, str]],
+    deduper: Deduper = SMS_DEDUPER,
+    backend: str = None,
+    queue: str = None,
+    lanes: List[str] = None,
+) -> List[bool]:
+    """
+    一次往返完成批量去重和入队
+    :param items: [(消息摘要, 短信内容), ...]
+    :param deduper: 去重方式和去重时间
+    :param backend: list 或 stream，默认取配置
+    :param queue: 队列名，默认按后端和通道取 sms_queue 或 sms_stream
+    :param lanes: 与 items 一一对应的优先级通道，默认全部进入默认通道
+    :return: 与 items 一一对应，True 为已入队，False 为重复
+    """
+    if not items:
+        return []
+
+    backend = backend or settings.queue.backend
+    base = SMS_STREAM_KEY if backend == "stream" else SMS_QUEUE_KEY
+    queues = [queue or lane_key(base, lane) for lane in (lanes or [""] * len(items))]
+    return await run_enqueue(items, deduper, backend, queues)
+
+
+async def schedule(
+    items: List[Tuple[str, str]],
+    send_at: float,
+    deduper: Deduper = SMS_DEDUPER,
+    lanes: List[str] = None,
+) -> List[bool]:
+    """
+    去重后放入定时集合，到期后由消费者移入队列
+    :param items: [(消息摘要, 短信内容), ...]
+    :param send_at: 发送时间（时间戳）
+    :param deduper: 去重方式和去重时间
+    :param lanes: 与 items 一一对应的优先级通道
+    :return: 与 items 一一对应，True 为已接收，False 为重复
+
+    定时短信到期前不在队列中，到期后由 promote_scheduled 移入对应通道的队列：
+
+    >>> import asyncio
+    >>> from dataclasses import replace
+    >>> send_at = float(int(time.time()) + 60)
+    >>> async def scheduled(backend):
+    ...     config = replace(settings.queue, backend=backend, consumer_mode="blocking")
+    ...     queue = lane_key(SMS_STREAM_KEY if backend == "stream" else SMS_QUEUE_KEY, "otp")
+    ...     async def queued():
+    ...         if backend == "stream":
+    ...             return [fields["data"] for _, fields in await ASYNC_REDIS.xrange(queue)]
+    ...         return await ASYNC_REDIS.lrange(queue, 0, -1)
+    ...     items = [("a" * 32, '{"id": "1"}'), ("a" * 32, '{"id": "2"}')]
+    ...     print(await schedule(items, send_at, Deduper(f"doctest:{backend}", 60), ["otp"] * 2))
+    ...     print(await promote_scheduled(config, now=send_at - 1) == (0, send_at), await queued())
+    ...     print(await promote_scheduled(config, now=send_at), await queued())
+    >>> asyncio.run(scheduled("list"))
+    [True, False]
+    True []
+    (1, 0.0) ['{"id": "1"}']
+    >>> asyncio.run(scheduled("stream"))
+    [True, False]
+    True []
+    (1, 0.0) ['{"id": "1"}']
+    """
+    if not items:
+        return []
+
+    zsets = [lane_key(SMS_SCHEDULED_KEY, lane) for lane in (lanes or [""] * len(items))]
+    return await run_enqueue(items, deduper, "zset", zsets, send_at)
+
+
+def scheduled_keys(config: QueueConfig) -> List[str]:
+    base = SMS_STREAM_KEY if config.backend == "stream" else SMS_QUEUE_KEY
+    return [
+        key
+        for lane in parse_lanes(config.lanes)
+        for key in (lane_key(SMS_SCHEDULED_KEY, lane), lane_key(base, lane))
+    ]
+
+
+async def promote_scheduled(
+    config: QueueConfig = None, now: Optional[float] = None
+) -> Tuple[int, float]:
+    """
+    将所有通道到期的定时短信分批移入队列
+    :param config:
+    :param now: 当前时间（时间戳），默认取本地时间
+    :return: (移动数量, 下一条到期时间，没有定时短信时为 0)
+    """
+    config = config or settings.queue
+    keys, total = scheduled_keys(config), 0
+    while True:
+        moved, more, next_due = await PROMOTE_SCHEDULED_SCRIPT(
+            keys=keys,
+            args=[
+                time.time() if now is None else now,
+                config.schedule_batch,
+                config.backend,
+                config.stream_maxlen,
+            ],
+        )
+        total += moved
+        if not more:
+            return total, float(next_due) if next_due else 0.0
+
+
+def promote_scheduled_sync(config: QueueConfig = None, now: Optional[float] = None) -> int:
+    """
+    同步版本，供 poll 模式的 MasTask 使用
+    >>> import asyncio
+    >>> send_at = time.time() + 60
+    >>> asyncio.run(schedule([("b" * 32, '{"id": "3"}')], send_at, Deduper("doctest", 60)))
+    [True]
+    >>> promote_scheduled_sync(now=send_at - 1), REDIS.lrange(SMS_QUEUE_KEY, 0, -1)
+    (0, [])
+    >>> promote_scheduled_sync(now=send_at), REDIS.lrange(SMS_QUEUE_KEY, 0, -1)
+    (1, ['{"id": "3"}'])
+    """
+    config = config or settings.queue
+    keys, total = scheduled_keys(config), 0
+    while True:
+        moved, more, _ = PROMOTE_SCHEDULED_SYNC_SCRIPT(
+            keys=keys,
+            args=[
+                time.time() if now is None else now,
+                config.schedule_batch,
+                config.backend,
+                config.stream_maxlen,
+            ],
+        )
+        total += moved
+        if not more:
+            return total
+
+
+# 从队列尾部原子地移动最多 ARGV[1] 条到处理中列表
+MOVE_BATCH_SCRIPT = ASYNC_REDIS.register_script(
+    """
+local items = {}
+for i = 1, tonumber(ARGV[1]) do
+    local item = redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'LEFT')
+    if not item then
+        break
+    end
+    items[#items + 1] = item
+end
+return items
+"""
+)
+
+# 可靠队列有多个通道时，阻塞等待最高优先级通道的最长时间（秒），之后检查其他通道
+LANE_POLL_TIMEOUT = 1.0
+
+# 将处理中列表整体放回队列尾部（最先被消费），保持原有顺序
+REQUEUE_SCRIPT = ASYNC_REDIS.register_script(
+    """
+local n = 0
+while redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT') do
+    n = n + 1
+end
+return n
+"""
+)
+
+# 将到期的重试短信移回队列尾部，返回移动数量和下一条到期时间
+PROMOTE_SCRIPT = ASYNC_REDIS.register_script(
+    """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(due) do
+    redis.call('RPUSH', KEYS[2], item)
+end
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+local next_due = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return {#due, next_due[2] or false}
+"""
+)
+
+
+class ListQueue:
+    """普通列表队列：取出即删除，发送失败不重试"""
+
+    def __init__(self, config: QueueConfig, consumer_id: str, queue: str = SMS_QUEUE_KEY):
+        self.config = config
+        self.consumer_id = consumer_id
+        self.queue = queue
+
+    async def recover(self) -> int:
+        """启动时恢复本消费者上次未确认的短信，返回恢复数量"""
+        return 0
+
+    async def maintain(self):
+        """每次取短信前的维护工作"""
+
+    async def take(self, count: int) -> List[str]:
+        """非阻塞地取出最多 count 条，按入队顺序排列"""
+        return await ASYNC_REDIS.rpop(self.queue, count) or []
+
+    @classmethod
+    async def wait_any(
+        cls, queues: List["ListQueue"], timeout: float
+    ) -> List[Tuple["ListQueue", str]]:
+        """
+        阻塞等待任意一个通道的短信，同时到达时按 queues 的顺序（优先级）取
+        :return: [(所属通道, 短信内容), ...]，超时返回空列表
+        """
+        if not (
+            item := await ASYNC_REDIS.brpop([queue.queue for queue in queues], timeout=timeout)
+        ):
+            return []
+        return [(next(queue for queue in queues if queue.queue == item[0]), item[1])]
+
+    def block_timeout(self) -> float:
+        return self.config.block_timeout
+
+    async def ack(self, batch: List[str]):
+        """发送成功"""
+
+    async def fail(self, batch: List[str]) -> Dict[str, int]:
+        """
+        发送失败
+        :return: 短信 -> 已尝试次数，次数未达到 max_attempts 的将重试；未列出的短信不再重试（丢弃）
+        """
+        return {}
+
+    async def stats(self) -> dict:
+        return {"backend": "list", "length": await ASYNC_REDIS.llen(self.queue)}
+
+    async def oldest_age(self) -> Optional[float]:
+        """队列中最早一条短信已等待的秒数，队列为空或短信没有入队时间时返回 None"""
+        if not (sms_data := await ASYNC_REDIS.lindex(self.queue, -1)):
+            return None
+        ts = json.loads(sms_data).get("ts")
+        return max(0.0, time.time() - ts) if ts else None
+
+
+class ReliableQueue(ListQueue):
+    """
+    至少一次投递的短信队列
+    - 取出时移动到本消费者的处理中列表，供应商发送成功后显式确认
+    - 失败按指数退避加抖动放入延迟集合，超过最大次数进入死信列表
+    - 消费者心跳过期后，由其他消费者将其处理中列表放回队列
+
+    失败的短信进入延迟集合，到期后回到队列，第 max_attempts 次失败后进入死信列表：
+
+    >>> import asyncio
+    >>> from dataclasses import replace
+    >>> config = replace(settings.queue, max_attempts=2, retry_base_delay=0, retry_max_delay=0)
+    >>> queue = ReliableQueue(config, "c1", "doctest_queue")
+    >>> async def fail_twice():
+    ...     await ASYNC_REDIS.lpush(queue.queue, '{"id": "1"}')
+    ...     batch = await queue.take(10)
+    ...     print(batch, await ASYNC_REDIS.llen(queue.processing_key))
+    ...     print(await queue.fail(batch), await ASYNC_REDIS.zcard(queue.delayed_key))
+    ...     print(await queue.promote_due(), batch := await queue.take(10))
+    ...     print(await queue.fail(batch), await ASYNC_REDIS.lrange(queue.dead_key, 0, -1))
+    ...     print(await ASYNC_REDIS.llen(queue.processing_key), await queue.take(10))
+    >>> asyncio.run(fail_twice())
+    ['{"id": "1"}'] 1
+    {'{"id": "1"}': 1} 1
+    1 ['{"id": "1", "attempts": 1}']
+    {'{"id": "1", "attempts": 1}': 2} ['{"id": "1", "attempts": 2}']
+    0 []
+
+    心跳过期的消费者处理中的短信被放回队列：
+
+    >>> async def reap():
+    ...     crashed = ReliableQueue(config, "c2", "doctest_queue")
+    ...     await crashed.heartbeat()
+    ...     await ASYNC_REDIS.lpush(queue.queue, '{"id": "2"}')
+    ...     await crashed.take(10)
+    ...     print(await queue.reap())
+    ...     await ASYNC_REDIS.delete(crashed.heartbeat_key("c2"))
+    ...     print(await queue.reap(), await queue.take(10))
+    ...     print(await ASYNC_REDIS.smembers(queue.consumers_key))
+    >>> asyncio.run(reap())
+    0
+    1 ['{"id": "2"}']
+    set()
+    """
+
+    def __init__(self, config: QueueConfig, consumer_id: str, queue: str = SMS_QUEUE_KEY):
+        super().__init__(config, consumer_id, queue)
+        self.processing_key = self.get_processing_key(consumer_id)
+        self.delayed_key = f"{queue}:delayed"
+        self.dead_key = f"{queue}:dead"
+        self.consumers_key = f"{queue}:consumers"
+        self.next_due = 0.0
+        self.last_reaped_at = 0.0
+
+    def get_processing_key(self, consumer_id: str) -> str:
+        return f"{self.queue}:processing:{consumer_id}"
+
+    def heartbeat_key(self, consumer_id: str) -> str:
+        return f"{self.queue}:consumer:{consumer_id}"
+
+    async def heartbeat(self):
+        async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+            pipe.set(
+                self.heartbeat_key(self.consumer_id), time.time(), ex=self.config.heartbeat_ttl
+            )
+            pipe.sadd(self.consumers_key, self.consumer_id)
+            await pipe.execute()
+
+    async def recover(self) -> int:
+        """启动时将本消费者上次未确认的短信放回队列"""
+        return await REQUEUE_SCRIPT(keys=[self.processing_key, self.queue])
+
+    async def reap(self) -> int:
+        """将心跳过期的消费者的处理中短信放回队列"""
+        requeued = 0
+        for consumer_id in await ASYNC_REDIS.smembers(self.consumers_key):
+            if consumer_id == self.consumer_id or await ASYNC_REDIS.exists(
+                self.heartbeat_key(consumer_id)
+            ):
+                continue
+            requeued += await REQUEUE_SCRIPT(
+                keys=[self.get_processing_key(consumer_id), self.queue]
+            )
+            await ASYNC_REDIS.srem(self.consumers_key, consumer_id)
+        return requeued
+
+    async def promote_due(self, limit: int = 1000) -> int:
+        """将到期的重试短信移回队列"""
+        moved, next_due = await PROMOTE_SCRIPT(
+            keys=[self.delayed_key, self.queue], args=[time.time(), limit]
+        )
+        self.next_due = float(next_due) if next_due else 0.0
+        return moved
+
+    async def maintain(self):
+        """心跳、到期重试、回收失联消费者的短信"""
+        await self.heartbeat()
+        await self.promote_due()
+        if time.monotonic() - self.last_reaped_at >= self.config.heartbeat_ttl:
+            self.last_reaped_at = time.monotonic()
+            if requeued := await self.reap():
+                LOG.warning(f"回收失联消费者短信 {requeued} 条")
+
+    def block_timeout(self) -> float:
+        """有待重试的短信时缩短阻塞时间，保证按时重试"""
+        if self.next_due:
+            return max(0.1, min(self.config.block_timeout, self.next_due - time.time()))
+        return self.config.block_timeout
+
+    async def take(self, count: int) -> List[str]:
+        """与 ListQueue 相同，但短信移动到处理中列表而不是直接删除"""
+        return await MOVE_BATCH_SCRIPT(keys=[self.queue, self.processing_key], args=[count])
+
+    @classmethod
+    async def wait_any(
+        cls, queues: List["ReliableQueue"], timeout: float
+    ) -> List[Tuple["ReliableQueue", str]]:
+        """
+        BLMOVE 只能等待一个列表：阻塞在最高优先级通道上，每隔 LANE_POLL_TIMEOUT 秒检查一次其他通道
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            for queue in queues[1:]:
+                if items := await queue.take(1):
+                    return [(queue, items[0])]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            top = queues[0]
+            wait = min(remaining, LANE_POLL_TIMEOUT) if len(queues) > 1 else remaining
+            if item := await ASYNC_REDIS.blmove(
+                top.queue, top.processing_key, wait, "RIGHT", "LEFT"
+            ):
+                return [(top, item)]
+
+    async def ack(self, batch: List[str]):
+        """发送成功后从处理中列表移除"""
+        async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+            for sms_data in batch:
+                pipe.lrem(self.processing_key, 1, sms_data)
+            await pipe.execute()
+
+    async def fail(self, batch: List[str]) -> Dict[str, int]:
+        """发送失败后按指数退避放入延迟集合，超过最大次数放入死信列表"""
+        config = self.config
+        attempted = {}
+        now = time.time()
+        async with ASYNC_REDIS.pipeline(transaction=True) as pipe:
+            for sms_data in batch:
+                pipe.lrem(self.processing_key, 1, sms_data)
+                sms = json.loads(sms_data)
+                sms["attempts"] = attempted[sms_data] = attempts = sms.get("attempts", 0) + 1
+                if attempts >= config.max_attempts:
+                    pipe.lpush(self.dead_key, json.dumps(sms))
+                else:
+                    delay = min(
+                        config.retry_max_delay, config.retry_base_delay * 2 ** (attempts - 1)
+                    )
+                    pipe.zadd(
+                        self.delayed_key, {json.dumps(sms): now + delay * random.uniform(0.5, 1)}
+                    )
+            await pipe.execute()
+        return attempted
+
+    async def stats(self) -> dict:
+        consumers = sorted(await ASYNC_REDIS.smembers(self.consumers_key))
+        async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+            pipe.llen(self.queue)
+            pipe.zcard(self.delayed_key)
+            pipe.llen(self.dead_key)
+            for consumer_id in consumers:
+                pipe.llen(self.get_processing_key(consumer_id))
+            length, delayed, dead, *processing = await pipe.execute()
+        return {
+            "backend": "reliable",
+            "length": length,
+            "delayed": delayed,
+            "dead": dead,
+            "consumers": {
+                consumer_id: {"pending": n} for consumer_id, n in zip(consumers, processing)
+            },
+        }
+
+
+class StreamQueue(ListQueue):
+    """
+    基于 Redis Streams 消费者组的短信队列，可多进程、多节点横向扩展
+    - 每个消费者通过 XREADGROUP 读取，未确认的短信留在自己的待处理列表（PEL）中
+    - 发送成功后 XACK；失败不确认，空闲超过 claim_idle 后由任意消费者 XAUTOCLAIM 重新处理
+    - 投递次数超过 max_attempts 的短信进入死信列表
+    - 入队时按 stream_maxlen 近似裁剪长度
+
+    未确认的短信空闲超过 claim_idle 后被其他消费者认领，投递次数超过 max_attempts 后进入死信列表：
+
+    >>> import asyncio
+    >>> from dataclasses import replace
+    >>> config = replace(settings.queue, claim_idle=0, max_attempts=2, batch_size=10)
+    >>> def consumer(consumer_id):
+    ...     return StreamQueue(config, consumer_id, "doctest_stream", "doctest_stream:dead")
+    >>> async def claim():
+    ...     a, b = consumer("a"), consumer("b")
+    ...     await a.recover()
+    ...     for sms_id in "123":
+    ...         await ASYNC_REDIS.xadd(a.queue, {"data": sms_id})
+    ...     print(await a.fail(await a.take(10)))
+    ...     await b.maintain()
+    ...     print(batch := await b.take(10))
+    ...     await b.ack(batch[:1])
+    ...     print(await b.fail(batch[1:]))
+    ...     await a.maintain()
+    ...     print(await a.take(10), await ASYNC_REDIS.lrange(a.dead_key, 0, -1))
+    ...     print((await ASYNC_REDIS.xpending(a.queue, a.group))["pending"])
+    >>> asyncio.run(claim())
+    {'1': 1, '2': 1, '3': 1}
+    ['1', '2', '3']
+    {'2': 2, '3': 2}
+    [] ['3', '2']
+    0
+    """
+
+    def __init__(
+        self,
+        config: QueueConfig,
+        consumer_id: str,
+        stream: str = SMS_STREAM_KEY,
+        dead_key: str = SMS_QUEUE_KEY + ":dead",
+    ):
+        super().__init__(config, consumer_id, stream)
+        self.group = SMS_STREAM_GROUP
+        self.dead_key = dead_key
+        self.entry_ids: Dict[str, str] = {}  # 当前批次 短信内容 -> 消息 ID
+        self.claim_cursor = "0-0"
+        self.last_claimed_at = 0.0
+        self.claimed: List[str] = []
+
+    async def ensure_group(self):
+        try:
+            await ASYNC_REDIS.xgroup_create(self.queue, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def recover(self) -> int:
+        """创建消费者组，并重新处理本消费者上次未确认的短信"""
+        await self.ensure_group()
+        entries = await ASYNC_REDIS.xreadgroup(
+            self.group, self.consumer_id, {self.queue: "0"}, count=self.config.batch_size
+        )
+        self.claimed = self.remember(entries[0][1] if entries else [])
+        return len(self.claimed)
+
+    def remember(self, entries) -> List[str]:
+        batch = []
+        for entry_id, fields in entries:
+            if fields:  # 已被裁剪的消息 fields 为空
+                self.entry_ids[fields["data"]] = entry_id
+                batch.append(fields["data"])
+        return batch
+
+    async def maintain(self):
+        """定期认领其他消费者空闲过久的短信"""
+        if time.monotonic() - self.last_claimed_at < min(
+            self.config.claim_idle, self.config.block_timeout
+        ):
+            return
+        self.last_claimed_at = time.monotonic()
+        result = await ASYNC_REDIS.xautoclaim(
+            self.queue,
+            self.group,
+            self.consumer_id,
+            min_idle_time=int(self.config.claim_idle * 1000),
+            start_id=self.claim_cursor,
+            count=self.config.batch_size,
+        )
+        # Redis 7 起额外返回已被裁剪的消息 ID
+        self.claim_cursor, entries = result[0], result[1]
+        if deleted := (result[2] if len(result) > 2 else []):
+            await ASYNC_REDIS.xack(self.queue, self.group, *deleted)
+        if entries and (entries := await self.drop_dead(entries)):
+            self.claimed.extend(self.remember(entries))
+            LOG.warning(f"认领空闲短信 {len(entries)} 条")
+
+    async def deliveries(self, entry_ids: List[str]) -> Dict[str, int]:
+        """待处理消息的投递次数，已确认或已被裁剪的不在结果中"""
+        # 逐条查询：按 ID 区间查询时，区间内其他消费者的待处理消息会挤占 count 名额
+        async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+            for entry_id in entry_ids:
+                pipe.xpending_range(self.queue, self.group, min=entry_id, max=entry_id, count=1)
+            pending = await pipe.execute()
+        return {item["message_id"]: item["times_delivered"] for items in pending for item in items}
+
+    async def drop_dead(self, entries):
+        """投递次数超过上限的短信放入死信列表并确认"""
+        deliveries = await self.deliveries([entry_id for entry_id, _ in entries])
+        dead = [
+            (entry_id, fields)
+            for entry_id, fields in entries
+            if fields and deliveries.get(entry_id, 0) > self.config.max_attempts
+        ]
+        if dead:
+            async with ASYNC_REDIS.pipeline(transaction=True) as pipe:
+                for entry_id, fields in dead:
+                    pipe.lpush(self.dead_key, fields["data"])
+                pipe.xack(self.queue, self.group, *(entry_id for entry_id, _ in dead))
+                await pipe.execute()
+            LOG.warning(f"短信超过最大投递次数，进入死信 {len(dead)} 条")
+        dead_ids = {entry_id for entry_id, _ in dead}
+        return [entry for entry in entries if entry[0] not in dead_ids]
+
+    async def take(self, count: int) -> List[str]:
+        # 优先处理恢复或认领到的短信
+        if self.claimed:
+            batch, self.claimed = self.claimed[:count], self.claimed[count:]
+            return batch
+        entries = await ASYNC_REDIS.xreadgroup(
+            self.group, self.consumer_id, {self.queue: ">"}, count=count
+        )
+        return self.remember(entries[0][1]) if entries else []
+
+    @classmethod
+    async def wait_any(
+        cls, queues: List["StreamQueue"], timeout: float
+    ) -> List[Tuple["StreamQueue", str]]:
+        """XREADGROUP 同时阻塞等待所有通道的 stream"""
+        by_stream = {queue.queue: queue for queue in queues}
+        head = queues[0]
+        entries = await ASYNC_REDIS.xreadgroup(
+            head.group,
+            head.consumer_id,
+            {stream: ">" for stream in by_stream},
+            count=head.config.batch_size,
+            block=max(1, int(timeout * 1000)),
+        )
+        return [
+            (by_stream[stream], sms_data)
+            for stream, stream_entries in entries or []
+            for sms_data in by_stream[stream].remember(stream_entries)
+        ]
+
+    async def ack(self, batch: List[str]):
+        if entry_ids := [
+            self.entry_ids.pop(sms_data) for sms_data in batch if sms_data in self.entry_ids
+        ]:
+            await ASYNC_REDIS.xack(self.queue, self.group, *entry_ids)
+
+    async def fail(self, batch: List[str]) -> Dict[str, int]:
+        """不确认，留在待处理列表中，空闲超过 claim_idle 后被重新认领；投递次数已达上限的在认领时进入死信"""
+        entry_ids = {
+            sms_data: self.entry_ids.pop(sms_data)
+            for sms_data in batch
+            if sms_data in self.entry_ids
+        }
+        deliveries = await self.deliveries(list(entry_ids.values()))
+        return {
+            sms_data: deliveries[entry_id]
+            for sms_data, entry_id in entry_ids.items()
+            if entry_id in deliveries
+        }
+
+    async def stats(self) -> dict:
+        await self.ensure_group()
+        groups = {group["name"]: group for group in await ASYNC_REDIS.xinfo_groups(self.queue)}
+        group = groups.get(self.group, {})
+        consumers = await ASYNC_REDIS.xinfo_consumers(self.queue, self.group)
+        return {
+            "backend": "stream",
+            "length": await ASYNC_REDIS.xlen(self.queue),
+            "lag": group.get("lag"),
+            "pending": group.get("pending"),
+            "dead": await ASYNC_REDIS.llen(self.dead_key),
+            "consumers": {
+                consumer["name"]: {"pending": consumer["pending"], "idle_ms": consumer["idle"]}
+                for consumer in consumers
+            },
+        }
+
+    async def oldest_age(self) -> Optional[float]:
+        """消费者组尚未读取的第一条消息的等待时间，由消息 ID 中的毫秒时间戳得出"""
+        await self.ensure_group()
+        groups = {group["name"]: group for group in await ASYNC_REDIS.xinfo_groups(self.queue)}
+        last_delivered = groups.get(self.group, {}).get("last-delivered-id", "0-0")
+        if not (entries := await ASYNC_REDIS.xrange(self.queue, min=f"({last_delivered}", count=1)):
+            return None
+        return max(0.0, time.time() - int(entries[0][0].split("-")[0]) / 1000)
+
+
+class LaneScheduler:
+    """
+    决定每批从各优先级通道取多少条
+    - weighted：每批先按权重给每个通道分配名额，剩余名额再按优先级补齐，通道空闲时名额不会浪费
+    - strict：严格按优先级，高优先级通道取空后才取下一个通道
+    - 超过 starvation_limit 秒未被检查的通道先获得其权重份额，避免在持续高负载下饿死
+
+    >>> scheduler = LaneScheduler({"otp": 10, "normal": 3, "bulk": 1}, "weighted", 30)
+    >>> scheduler.plan(100)
+    [('otp', 71), ('normal', 21), ('bulk', 7), ('otp', None), ('normal', None), ('bulk', None)]
+    >>> scheduler = LaneScheduler({"otp": 10, "normal": 3, "bulk": 1}, "strict", 30)
+    >>> scheduler.plan(100)
+    [('otp', None), ('normal', None), ('bulk', None)]
+    >>> scheduler.last_visited["bulk"] -= 60
+    >>> scheduler.plan(100)
+    [('bulk', 7), ('otp', None), ('normal', None), ('bulk', None)]
+    """
+
+    def __init__(
+        self, weights: Dict[str, int], scheduling: str = "weighted", starvation_limit: float = 30.0
+    ):
+        self.weights = weights
+        self.scheduling = scheduling
+        self.starvation_limit = starvation_limit
+        self.last_visited = {lane: time.monotonic() for lane in weights}
+
+    @classmethod
+    def from_config(cls, config: QueueConfig) -> "LaneScheduler":
+        return cls(parse_lanes(config.lanes), config.scheduling, config.starvation_limit)
+
+    def plan(self, capacity: int) -> List[Tuple[str, Optional[int]]]:
+        """
+        :param capacity: 本批最多短信数
+        :return: 按顺序执行的 [(通道, 最多取出条数)]，None 表示取满剩余名额
+        """
+        total = sum(self.weights.values()) or 1
+        now = time.monotonic()
+        reserved = [
+            (lane, max(1, capacity * weight // total))
+            for lane, weight in self.weights.items()
+            if (self.scheduling == "weighted" and weight > 0)
+            or now - self.last_visited[lane] > self.starvation_limit
+        ]
+        return reserved + [(lane, None) for lane in self.weights]
+
+    def visited(self, lane: str):
+        self.last_visited[lane] = time.monotonic()
+
+
+class LaneQueue:
+    """
+    按优先级通道拆分的短信队列，每个通道是一个 ListQueue / ReliableQueue / StreamQueue
+    验证码等高优先级短信不会排在大批量群发之后
+
+    积压的短信按调度计划取满一批，验证码通道权重高，先取：
+
+    >>> import asyncio
+    >>> from dataclasses import replace
+    >>> config = replace(
+    ...     settings.queue, consumer_mode="blocking", reliable=True, batch_size=3, linger=0.2,
+    ...     retry_base_delay=60, retry_max_delay=60,
+    ... )
+    >>> queue = make_queue(config, "c1")
+    >>> async def push(lane, *ids):
+    ...     items = [json.dumps({"id": i}) for i in ids]
+    ...     await ASYNC_REDIS.lpush(lane_key(SMS_QUEUE_KEY, lane), *items)
+    >>> async def backlog():
+    ...     await push("normal", "n1", "n2")
+    ...     await push("otp", "o1", "o2")
+    ...     return await queue.pop_batch()
+    >>> first = asyncio.run(backlog())
+    >>> first
+    ['{"id": "o1"}', '{"id": "o2"}', '{"id": "n1"}']
+
+    确认和失败按每条短信所属的通道处理：
+
+    >>> async def settle():
+    ...     await queue.ack(first[:2])
+    ...     print(await queue.fail(first[2:]))
+    ...     for lane, lane_queue in queue.lanes.items():
+    ...         processing = await ASYNC_REDIS.llen(lane_queue.processing_key)
+    ...         print(lane, processing, await ASYNC_REDIS.zrange(lane_queue.delayed_key, 0, -1))
+    >>> asyncio.run(settle())
+    {'{"id": "n1"}': 1}
+    otp 0 []
+    normal 0 ['{"id": "n1", "attempts": 1}']
+    bulk 0 []
+
+    不足一批时在 linger 时间内继续攒批，期间到达的短信进入同一批：
+
+    >>> list_queue = make_queue(replace(config, reliable=False), "c1")
+    >>> async def linger():
+    ...     async def later():
+    ...         await asyncio.sleep(0.05)
+    ...         await push("otp", "o3")
+    ...     batch, _ = await asyncio.gather(list_queue.pop_batch(), later())
+    ...     return batch
+    >>> asyncio.run(linger())
+    ['{"id": "n2"}', '{"id": "o3"}']
+    """
+
+    def __init__(self, config: QueueConfig, lanes: Dict[str, ListQueue]):
+        self.config = config
+        self.lanes = lanes
+        self.scheduler = LaneScheduler.from_config(config)
+        self.owners: Dict[str, ListQueue] = {}  # 当前批次 短信内容 -> 所属通道
+        self.next_scheduled = 0.0
+
+    async def recover(self) -> int:
+        return sum([await queue.recover() for queue in self.lanes.values()])
+
+    async def maintain(self):
+        """各通道的维护工作，并将到期的定时短信移入队列"""
+        for queue in self.lanes.values():
+            await queue.maintain()
+        moved, self.next_scheduled = await promote_scheduled(self.config)
+        if moved:
+            LOG.info(f"定时短信到期入队 {moved} 条")
+
+    def block_timeout(self) -> float:
+        """有定时短信时缩短阻塞时间，保证按时发送"""
+        block_timeout = min(queue.block_timeout() for queue in self.lanes.values())
+        if self.next_scheduled:
+            block_timeout = max(0.1, min(block_timeout, self.next_scheduled - time.time()))
+        return block_timeout
+
+    async def take(self, capacity: int) -> List[str]:
+        """按调度计划非阻塞地从各通道取短信"""
+        batch = []
+        for lane, quota in self.scheduler.plan(capacity):
+            count = capacity - len(batch) if quota is None else min(quota, capacity - len(batch))
+            if count <= 0:
+                continue
+            items = await self.lanes[lane].take(count)
+            self.scheduler.visited(lane)
+            self.owners.update((sms_data, self.lanes[lane]) for sms_data in items)
+            batch.extend(items)
+        return batch
+
+    async def wait(self, timeout: float) -> List[str]:
+        queues = list(self.lanes.values())
+        items = await type(queues[0]).wait_any(queues, timeout)
+        self.owners.update((sms_data, queue) for queue, sms_data in items)
+        return [sms_data for _, sms_data in items]
+
+    async def pop_batch(self) -> List[str]:
+        """
+        先按调度计划取已积压的短信；队列为空时阻塞等待第一条，之后在 linger 时间内继续攒批
+        :return: 短信内容，阻塞超时返回空列表
+        """
+        batch_size = self.config.batch_size
+        if not (batch := await self.take(batch_size)):
+            if not (batch := await self.wait(self.block_timeout())):
+                return []
+
+        deadline = time.monotonic() + self.config.linger
+        while len(batch) < batch_size:
+            if items := await self.take(batch_size - len(batch)):
+                batch.extend(items)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not (items := await self.wait(remaining)):
+                break
+            batch.extend(items)
+        return batch
+
+    def group_by_lane(self, batch: List[str]) -> Dict[ListQueue, List[str]]:
+        groups = {}
+        for sms_data in batch:
+            groups.setdefault(
+                self.owners.pop(sms_data, self.lanes[self.config.default_lane]), []
+            ).append(sms_data)
+        return groups
+
+    async def ack(self, batch: List[str]):
+        for queue, items in self.group_by_lane(batch).items():
+            await queue.ack(items)
+
+    async def fail(self, batch: List[str]) -> Dict[str, int]:
+        attempted = {}
+        for queue, items in self.group_by_lane(batch).items():
+            attempted.update(await queue.fail(items))
+        return attempted
+
+    async def stats(self) -> dict:
+        lanes = {lane: await queue.stats() for lane, queue in self.lanes.items()}
+        async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+            for lane in lanes:
+                pipe.zcard(lane_key(SMS_SCHEDULED_KEY, lane))
+            for lane_stats, scheduled in zip(lanes.values(), await pipe.execute()):
+                lane_stats["scheduled"] = scheduled
+        stats = {
+            "backend": next(iter(lanes.values()))["backend"],
+            "scheduling": self.config.scheduling,
+        }
+        for name in ("length", "scheduled", "delayed", "dead", "pending", "lag"):
+            values = [
+                lane_stats[name]
+                for lane_stats in lanes.values()
+                if lane_stats.get(name) is not None
+            ]
+            if values:
+                stats[name] = sum(values)
+        stats["lanes"] = lanes
+        return stats
+
+
+def make_queue(config: QueueConfig = None, consumer_id: str = "") -> LaneQueue:
+    """按配置创建消费端队列，每个优先级通道一个"""
+    config = config or settings.queue
+    consumer_id = consumer_id or config.consumer_id or os.uname().nodename
+    lanes = {}
+    for lane in parse_lanes(config.lanes):
+        if config.backend == "stream":
+            lanes[lane] = StreamQueue(
+                config,
+                consumer_id,
+                lane_key(SMS_STREAM_KEY, lane),
+                lane_key(SMS_QUEUE_KEY, lane) + ":dead",
+            )
+        elif config.reliable:
+            lanes[lane] = ReliableQueue(config, consumer_id, lane_key(SMS_QUEUE_KEY, lane))
+        else:
+            lanes[lane] = ListQueue(config, consumer_id, lane_key(SMS_QUEUE_KEY, lane))
+    return LaneQueue(config, lanes)
+
+
+async def queue_metrics():
+    """抓取 /metrics 时采集各通道的积压情况"""
+    queue = make_queue()
+    stats = await queue.stats()
+    metrics = {
+        "sms_queue_length": ("短信队列长度", {}),
+        "sms_queue_oldest_age_seconds": ("队列中最早一条待发送短信的等待时间", {}),
+    }
+    for lane, lane_queue in queue.lanes.items():
+        labels = format_labels(("lane",), (lane,))
+        lane_stats = stats["lanes"][lane]
+        metrics["sms_queue_length"][1][labels] = lane_stats["length"]
+        metrics["sms_queue_oldest_age_seconds"][1][labels] = await lane_queue.oldest_age() or 0
+        for name in ("scheduled", "delayed", "dead", "pending", "lag"):
+            if lane_stats.get(name) is not None:
+                metrics.setdefault(f"sms_queue_{name}", (f"短信队列 {name} 数量", {}))[1][
+                    labels
+                ] = lane_stats[name]
+    return [(name, documentation, samples) for name, (documentation, samples) in metrics.items()]
+
+
+COLLECTORS.append(queue_metrics)
@@ -0,0 +1,270 @@
+"""
+短信状态
+
+每条已接收的短信一个 hash sms_status:{id}，保留 [status] ttl 秒：
+- status：queued（已入队）/ scheduled（定时）/ sent（MAS 已接收）/ retrying（提交失败，等待重试）/
+  failed（提交失败且不再重试）/ delivered / undelivered（状态报告）
+- phone、room、msg_group、error、attempts（已尝试次数），以及每个状态的时间 {status}_at
+提交成功后记录 sms_receipt:{msg_group}（手机号 -> id），MAS 状态报告按 msgGroup + 手机号关联到短信
+短信带有 room 时，状态变化通过 Socket.IO 推送到该房间（sms_status 事件）
+"""
+
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from cores.config import settings
+from cores.constant.socket import SioEvent
+from cores.emitter import EMITTER, Emit
+from cores.log import LOG
+from cores.metrics import SMS_REPORT_TOTAL
+from cores.redis import ASYNC_REDIS, REDIS
+
+STATUS_KEY = "sms_status:{id}"
+RECEIPT_KEY = "sms_receipt:{msg_group}"
+
+QUEUED = "queued"
+SCHEDULED = "scheduled"
+SENT = "sent"
+RETRYING = "retrying"
+FAILED = "failed"
+DELIVERED = "delivered"
+UNDELIVERED = "undelivered"
+
+# MAS 状态报告中表示成功送达的状态码
+DELIVERED_CODES = {"DELIVRD", "CM:0000"}
+
+# (短信 id, 状态, 其他字段, 推送房间)
+StatusUpdate = Tuple[str, str, dict, str]
+
+
+def status_mapping(status: str, fields: dict, now: float) -> dict:
+    """
+    >>> status_mapping("sent", {"msg_group": "g", "error": ""}, 1.5)
+    {'status': 'sent', 'sent_at': 1.5, 'msg_group': 'g'}
+    """
+    return {
+        "status": status,
+        f"{status}_at": now,
+        **{name: value for name, value in fields.items() if value},
+    }
+
+
+def queue_updates(pipe, updates: Iterable[StatusUpdate], now: float):
+    ttl = settings.status.ttl
+    for message_id, status, fields, _ in updates:
+        key = STATUS_KEY.format(id=message_id)
+        pipe.hset(key, mapping=status_mapping(status, fields, now))
+        pipe.expire(key, ttl)
+
+
+def result_updates(
+    results, attempts: Optional[Dict[str, int]] = None
+) -> Tuple[List[StatusUpdate], List[Tuple[str, str, str]]]:
+    """
+    将 MAS 提交结果转换为状态更新
+    :param results: SmsSendResult 列表
+    :param attempts: 提交失败的短信 id -> 已尝试次数，未达到 [queue] max_attempts 的将重试（retrying），
+        其余失败的短信记为 failed
+    :return: (状态更新, [(msg_group, 手机号, 短信 id)])
+    """
+    attempts = attempts or {}
+    updates, receipts = [], []
+    for result in results:
+        for sms in result.batch.items:
+            if not (message_id := sms.get("id")):
+                continue
+            if result.success:
+                updates.append(
+                    (
+                        message_id,
+                        SENT,
+                        {"msg_group": result.msg_group, "provider": result.provider},
+                        sms.get("room", ""),
+                    )
+                )
+                if result.msg_group:
+                    receipts.append((result.msg_group, sms["phone_number"], message_id))
+            else:
+                updates.append(
+                    (
+                        message_id,
+                        (
+                            RETRYING
+                            if attempts.get(message_id, settings.queue.max_attempts)
+                            < settings.queue.max_attempts
+                            else FAILED
+                        ),
+                        {
+                            "error": result.error[:200],
+                            "provider": result.provider,
+                            "attempts": attempts.get(message_id),
+                        },
+                        sms.get("room", ""),
+                    )
+                )
+    return updates, receipts
+
+
+def queue_receipts(pipe, receipts: List[Tuple[str, str, str]]):
+    ttl = settings.status.ttl
+    for msg_group, phone_number, message_id in receipts:
+        key = RECEIPT_KEY.format(msg_group=msg_group)
+        pipe.hset(key, phone_number, message_id)
+        pipe.expire(key, ttl)
+
+
+def status_emits(updates: Iterable[StatusUpdate], now: float) -> List[Emit]:
+    """带有房间的状态更新转换为 sms_status 事件"""
+    return [
+        (SioEvent.SMS_STATUS.value, {"id": message_id, "status": status, "at": now, **fields}, room)
+        for message_id, status, fields, room in updates
+        if room
+    ]
+
+
+def push(updates: Iterable[StatusUpdate], now: float):
+    """放入发布缓冲区后台批量推送，不等待 Redis，失败不影响状态记录"""
+    for event, data, room in status_emits(updates, now):
+        EMITTER.emit_nowait(event, data, room)
+
+
+async def update(
+    updates: List[StatusUpdate], receipts: Optional[List[Tuple[str, str, str]]] = None
+):
+    """一次往返写入多条状态"""
+    if not settings.status.enabled or not (updates or receipts):
+        return
+    now = time.time()
+    async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+        queue_updates(pipe, updates, now)
+        queue_receipts(pipe, receipts or [])
+        await pipe.execute()
+    push(updates, now)
+
+
+async def record_accepted(accepted: List[Tuple[str, str, str]], send_at: Optional[float] = None):
+    """
+    记录已入队的短信，入队状态不推送
+    :param accepted: [(短信 id, 手机号, 房间)]
+    :param send_at: 定时发送的时间戳
+    """
+    status = SCHEDULED if send_at is not None else QUEUED
+    await update(
+        [
+            (message_id, status, {"phone": phone_number, "room": room, "send_at": send_at}, "")
+            for message_id, phone_number, room in accepted
+        ]
+    )
+
+
+async def record_results(results, attempts: Optional[Dict[str, int]] = None):
+    """blocking 消费者记录每条短信的提交结果，attempts 为提交失败的短信 id -> 已尝试次数"""
+    await update(*result_updates(results, attempts))
+
+
+def record_results_sync(results):
+    """poll 模式的 MasTask 使用"""
+    if not settings.status.enabled or not results:
+        return
+    updates, receipts = result_updates(results)
+    now = time.time()
+    with REDIS.pipeline(transaction=False) as pipe:
+        queue_updates(pipe, updates, now)
+        queue_receipts(pipe, receipts)
+        pipe.execute()
+    if emits := status_emits(updates, now):
+        try:
+            EMITTER.emit_many_sync(emits, coalesce=False)
+        except Exception as e:
+            LOG.warning(f"推送短信状态失败: {e}")
+
+
+async def lookup(ids: List[str]) -> dict:
+    """批量查询状态，不存在或已过期的为 None"""
+    async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+        for message_id in ids:
+            pipe.hgetall(STATUS_KEY.format(id=message_id))
+        records = await pipe.execute()
+    return {message_id: record or None for message_id, record in zip(ids, records)}
+
+
+def parse_report(report: dict) -> Tuple[str, str, str, str]:
+    """
+    解析一条 MAS 状态报告
+    :return: (msg_group, 手机号, 状态, 状态码)
+    >>> report = {"msgGroup": "g1", "mobile": "138", "reportStatus": "CM:0000"}
+    >>> parse_report({**report, "errorCode": "DELIVRD"})
+    ('g1', '138', 'delivered', 'DELIVRD')
+    >>> parse_report({**report, "reportStatus": "CM:1001", "errorCode": "UNDELIV"})
+    ('g1', '138', 'undelivered', 'UNDELIV')
+    """
+    code = str(report.get("errorCode") or report.get("reportStatus") or "")
+    delivered = code in DELIVERED_CODES or report.get("reportStatus") in DELIVERED_CODES
+    return (
+        str(report.get("msgGroup") or ""),
+        str(report.get("mobile") or ""),
+        DELIVERED if delivered else UNDELIVERED,
+        code,
+    )
+
+
+async def ingest_reports(reports: List[dict]) -> dict:
+    """
+    批量写入 MAS 状态报告：一次往返按 msgGroup + 手机号查出短信 id，再一次往返写入全部状态
+    :return: 各结果的条数
+
+    提交成功时记录的 msgGroup + 手机号关联到短信，状态报告覆盖 sent，之前各状态的时间保留：
+
+    >>> import asyncio
+    >>> from cores.sms import SmsBatch, SmsSendResult
+    >>> reports = [
+    ...     {"msgGroup": "g1", "mobile": "138", "reportStatus": "CM:0000"},
+    ...     {"msgGroup": "g1", "mobile": "139", "reportStatus": "CM:1001", "errorCode": "UNDELIV"},
+    ...     {"msgGroup": "g2", "mobile": "138", "reportStatus": "CM:0000"},
+    ... ]
+    >>> async def deliver():
+    ...     await record_accepted([("m1", "138", ""), ("m2", "139", "")])
+    ...     sms = [{"id": "m1", "phone_number": "138"}, {"id": "m2", "phone_number": "139"}]
+    ...     batch = SmsBatch(mobiles=["138", "139"], content="hi", items=sms)
+    ...     await record_results([SmsSendResult(batch=batch, success=True, msg_group="g1")])
+    ...     print(await ingest_reports(reports))
+    ...     for message_id, record in (await lookup(["m1", "m2"])).items():
+    ...         times = sorted(name for name in record if name.endswith("_at"))
+    ...         print(message_id, record["status"], record["report_code"], record["phone"], times)
+    >>> asyncio.run(deliver())
+    {'delivered': 1, 'undelivered': 1, 'unmatched': 1}
+    m1 delivered CM:0000 138 ['delivered_at', 'queued_at', 'sent_at']
+    m2 undelivered UNDELIV 139 ['queued_at', 'sent_at', 'undelivered_at']
+    """
+    parsed = [parse_report(report) for report in reports]
+    async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+        for msg_group, phone_number, _, _ in parsed:
+            pipe.hget(RECEIPT_KEY.format(msg_group=msg_group), phone_number)
+        ids = await pipe.execute()
+
+    matched = [(message_id, report) for message_id, report in zip(ids, parsed) if message_id]
+    now = time.time()
+    updates = [
+        (message_id, status, {"report_code": code}, "")
+        for message_id, (_, _, status, code) in matched
+    ]
+    async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+        queue_updates(pipe, updates, now)
+        for message_id, _ in matched:
+            pipe.hget(STATUS_KEY.format(id=message_id), "room")
+        rooms = (await pipe.execute())[len(updates) * 2 :] if updates else []
+
+    push(
+        [
+            (message_id, status, fields, room or "")
+            for (message_id, status, fields, _), room in zip(updates, rooms)
+        ],
+        now,
+    )
+    counts = {DELIVERED: 0, UNDELIVERED: 0, "unmatched": len(parsed) - len(matched)}
+    for _, status, _, _ in updates:
+        counts[status] += 1
+    for result, count in counts.items():
+        if count:
+            SMS_REPORT_TOTAL.inc(count, result=result)
+    return counts
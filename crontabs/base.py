@@ -3,16 +3,11 @@ import os
 import traceback
 
 import schedule
-import socketio
 from schedule import Job
 
-from cores.config import settings
 from cores.log import LOG
 from cores.messager import MESSAGE_FACTORY
 
-redis_manager = socketio.AsyncRedisManager(settings.redis.db_url)
-sio = socketio.AsyncServer(client_manager=redis_manager)
-
 
 class ScriptMeta(type):
     """
@@ -22,48 +17,58 @@ class ScriptMeta(type):
 
     """
 
+    @staticmethod
+    def pop_schedule_job(instance, kwargs: dict):
+        """获取 schedule_job，取出后清空，防止被重复调用"""
+        schedule_job = kwargs.pop("schedule_job", None) or getattr(instance, "schedule_job", None)
+        if schedule_job:
+            setattr(instance, "schedule_job", None)
+            assert isinstance(schedule_job, Job), "schedule_job 必须是 schedule.Job 类型"
+        return schedule_job
+
+    @classmethod
+    def wrap_async(cls, original_call, name):
+        async def new_call(self, *args, **kwargs):
+            try:
+                if schedule_job := cls.pop_schedule_job(self, kwargs):
+                    # 添加定时任务，支持异步
+                    async def wrapped_job():
+                        await self(*args, **kwargs)
+
+                    schedule_job.do(lambda: asyncio.create_task(wrapped_job()))
+
+                # 调用原始的 __call__ 方法
+                return await original_call(self, *args, **kwargs)
+            except Exception as e:
+                # 捕获并处理异常
+                self.handle_exception(e, name)
+
+        return new_call
+
+    @classmethod
+    def wrap_sync(cls, original_call, name):
+        def new_call(self, *args, **kwargs):
+            try:
+                if schedule_job := cls.pop_schedule_job(self, kwargs):
+                    # 添加定时任务
+                    schedule_job.do(self, *args, **kwargs)
+
+                # 调用原始的 __call__ 方法
+                return original_call(self, *args, **kwargs)
+            except Exception as e:
+                # 捕获并处理异常
+                self.handle_exception(e, name)
+
+        return new_call
+
     def __new__(cls, name, bases, dct):
         # 获取 __call__ 方法
         original_call = dct.get("__call__")
 
         if asyncio.iscoroutinefunction(original_call):  # 判断是否是异步函数
-            async def new_call(self, *args, **kwargs):
-                try:
-                    # 获取 schedule_job
-                    if schedule_job := kwargs.pop("schedule_job", None) or getattr(self, "schedule_job", None):
-                        # 防止 schedule_job 被重复调用
-                        setattr(self, "schedule_job", None)
-                        assert isinstance(schedule_job, Job), "schedule_job 必须是 schedule.Job 类型"
-
-                        # 添加定时任务，支持异步
-                        async def wrapped_job():
-                            await self(*args, **kwargs)
-
-                        schedule_job.do(lambda: asyncio.create_task(wrapped_job()))
-
-                    # 调用原始的 __call__ 方法
-                    return await original_call(self, *args, **kwargs)
-                except Exception as e:
-                    # 捕获并处理异常
-                    self.handle_exception(e, name)
-
+            new_call = cls.wrap_async(original_call, name)
         else:
-            def new_call(self, *args, **kwargs):
-                try:
-                    # 获取 schedule_job
-                    if schedule_job := kwargs.pop("schedule_job", None) or getattr(self, "schedule_job", None):
-                        # 防止 schedule_job 被重复调用
-                        setattr(self, "schedule_job", None)
-                        assert isinstance(schedule_job, Job), "schedule_job 必须是 schedule.Job 类型"
-
-                        # 添加定时任务
-                        schedule_job.do(self, *args, **kwargs)
-
-                    # 调用原始的 __call__ 方法
-                    return original_call(self, *args, **kwargs)
-                except Exception as e:
-                    # 捕获并处理异常
-                    self.handle_exception(e, name)
+            new_call = cls.wrap_sync(original_call, name)
 
         # 替换原始 __call__ 方法
         dct["__call__"] = new_call
@@ -98,8 +103,8 @@ class BaseScript(metaclass=ScriptMeta):
                             "icon": {
                                 "tag": "standard_icon",
                                 "token": "lan_outlined",
-                                "color": "grey"
-                            }
+                                "color": "grey",
+                            },
                         },
                         {
                             "tag": "markdown",
@@ -109,8 +114,8 @@ class BaseScript(metaclass=ScriptMeta):
                             "icon": {
                                 "tag": "standard_icon",
                                 "token": "computer_outlined",
-                                "color": "grey"
-                            }
+                                "color": "grey",
+                            },
                         },
                         {
                             "tag": "markdown",
@@ -120,9 +125,9 @@ class BaseScript(metaclass=ScriptMeta):
                             "icon": {
                                 "tag": "standard_icon",
                                 "token": "ram_outlined",
-                                "color": "grey"
-                            }
-                        }
+                                "color": "grey",
+                            },
+                        },
                     ]
                 },
                 "i18n_header": {
@@ -174,5 +179,5 @@ async def main():
         LOG.info("Clean up and exit")
 
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     asyncio.run(main())
@@ -1,52 +1,220 @@
+import asyncio
+import contextlib
 import json
 import time
+from typing import List
 
 import schedule
 
+from cores.config import settings
 from cores.log import LOG
+from cores.metrics import CONSUMER_BATCH_SIZE, flush_sync, run_flusher, start_exporter
 from cores.redis import REDIS
-from cores.sms import MasSMS
+from cores.sms import (
+    SMS_ROUTER,
+    SmsBatch,
+    SmsSendError,
+    SmsSendResult,
+    group_messages,
+    send_batches,
+)
+from cores.sms_queue import (
+    SMS_QUEUE_KEY,
+    LaneScheduler,
+    lane_key,
+    make_queue,
+    promote_scheduled_sync,
+)
+from cores.sms_status import record_results, record_results_sync
 from crontabs.base import BaseScript
 
 
+def build_batches(sms_batch: list) -> List[SmsBatch]:
+    """将队列中的短信按内容分组，组装为尽量少的 MAS 提交"""
+    batches = group_messages(sms_batch, max_mobiles=settings.mas.max_mobiles)
+    LOG.info(f"发送短信 {len(sms_batch)} 条，合并为 {len(batches)} 次提交")
+    return batches
+
+
+def send_batch(sms_batch: list):
+    """将一批短信经路由提交，并记录每条短信的状态；某次提交在所有供应商都失败时，该次及之后的短信记为 failed"""
+    batches = build_batches(sms_batch)
+    results = []
+    try:
+        for batch in batches:
+            results.append(result := SMS_ROUTER.send_sync(batch))
+            if not result.success:
+                raise SmsSendError(f"短信发送失败: {result.error}")
+    except Exception as e:
+        results.extend(
+            SmsSendResult(batch=batch, success=False, error=repr(e))
+            for batch in batches[len(results) :]
+        )
+        raise
+    finally:
+        record_results_sync(results)
+
+
 class MasTask(BaseScript):
     schedule_job = schedule.every(5).seconds
 
+    def __init__(self):
+        self.scheduler = LaneScheduler.from_config(settings.queue)
+
     def __call__(self, *args, **kwargs):
         """
         每 5 秒消费 Redis 队列的短信，并批量发送
+        到期的定时短信先移入队列，再按优先级通道调度，验证码等高优先级短信不会排在群发之后
         """
-        sms_batch = []
+        if moved := promote_scheduled_sync():
+            LOG.info(f"定时短信到期入队 {moved} 条")
 
-        while len(sms_batch) < 100:  # 限制一次最多批量100条短信
-            sms_data = REDIS.rpop("sms_queue")
-            if not sms_data:
-                break
-            sms_batch.append(json.loads(sms_data))
+        sms_batch = []
+        for lane, quota in self.scheduler.plan(100):  # 限制一次最多批量100条短信
+            count = 100 - len(sms_batch) if quota is None else min(quota, 100 - len(sms_batch))
+            if count <= 0:
+                continue
+            items = REDIS.rpop(lane_key(SMS_QUEUE_KEY, lane), count) or []
+            self.scheduler.visited(lane)
+            sms_batch.extend(json.loads(sms_data) for sms_data in items)
 
         LOG.info(f"获取到短信队列: {sms_batch}")
 
         if sms_batch:
-            messages = {
-                sms["phone_number"]: sms["message"] for sms in sms_batch
-            }
-            phone_numbers = list(messages.keys())
-            if len(phone_numbers) == 1:
-                LOG.info(f"单条发送短信: {messages}")
-                MasSMS.send_sms(phone_numbers[0], messages[phone_numbers[0]])
-            else:
-                LOG.info(f"批量发送短信: {messages}")
-                MasSMS.send_sms(phone_numbers, messages)
+            send_batch(sms_batch)
+
+
+class MasConsumer(BaseScript):
+    """
+    阻塞等待 Redis 队列，短信到达后在攒批窗口结束时立即发送
+    空闲时阻塞在 BRPOP / BLMOVE / XREADGROUP 上，不占用 CPU
+
+    按每次提交的结果分别确认或重试，部分失败时告警（返回 None）：
+
+    >>> import base64, httpx
+    >>> from dataclasses import replace
+    >>> from unittest import mock
+    >>> from cores.http import _clients
+    >>> from cores.redis import ASYNC_REDIS
+    >>> from cores.sms_status import lookup
+    >>> def mas(request):
+    ...     content = json.loads(base64.b64decode(json.loads(request.content)))["content"]
+    ...     ok = content != "bad"
+    ...     return httpx.Response(200, json={"success": ok, "rspcod": "" if ok else "IllegalMac"})
+    >>> _clients["mas"] = httpx.AsyncClient(transport=httpx.MockTransport(mas))
+    >>> config = replace(
+    ...     settings.queue, consumer_mode="blocking", reliable=True, linger=0,
+    ...     retry_base_delay=60, retry_max_delay=60,
+    ... )
+    >>> async def consume_once():
+    ...     with mock.patch.object(settings, "queue", config):
+    ...         consumer = MasConsumer()
+    ...     sms = [{"id": "1", "message": "ok"}, {"id": "2", "message": "bad"}]
+    ...     await ASYNC_REDIS.lpush(
+    ...         SMS_QUEUE_KEY, *(json.dumps({**item, "phone_number": "138"}) for item in sms)
+    ...     )
+    ...     with mock.patch.object(BaseScript, "_feishu_alarm") as alarm:
+    ...         print(await consumer(), alarm.called)
+    ...     normal = consumer.queue.lanes["normal"]
+    ...     print(await ASYNC_REDIS.llen(normal.processing_key))
+    ...     print(await ASYNC_REDIS.zrange(normal.delayed_key, 0, -1))
+    ...     statuses = await lookup(["1", "2"])
+    ...     print({message_id: status["status"] for message_id, status in statuses.items()})
+    >>> asyncio.run(consume_once())
+    None True
+    0
+    ['{"id": "2", "message": "bad", "phone_number": "138", "attempts": 1}']
+    {'1': 'sent', '2': 'retrying'}
+    >>> del _clients["mas"]
+    """
+
+    def __init__(self):
+        self.config = settings.queue
+        self.last_sent_at = 0.0
+        self.queue = make_queue(self.config)
+
+    async def async_init(self):
+        """恢复本消费者上次未确认的短信"""
+        if recovered := await self.queue.recover():
+            LOG.warning(f"恢复未确认短信 {recovered} 条")
+
+    async def __call__(self, *args, **kwargs):
+        await self.queue.maintain()
+        sms_batch = await self.queue.pop_batch()
+        if not sms_batch:
+            return 0
+
+        # 供应商有频率限制时，保持两批之间的最小间隔
+        if (wait := self.last_sent_at + self.config.min_send_interval - time.monotonic()) > 0:
+            await asyncio.sleep(wait)
+
+        LOG.info(f"获取到短信队列: {sms_batch}")
+        CONSUMER_BATCH_SIZE.observe(len(sms_batch))
+        sms_list = [json.loads(sms_data) for sms_data in sms_batch]
+        raw = {id(sms): sms_data for sms, sms_data in zip(sms_list, sms_batch)}
+        try:
+            results = await send_batches(build_batches(sms_list))
+        except Exception:
+            await self.queue.fail(sms_batch)
+            raise
+        finally:
+            self.last_sent_at = time.monotonic()
+
+        # 按每次提交的结果分别确认或重试
+        succeeded = [
+            raw[id(sms)] for result in results if result.success for sms in result.batch.items
+        ]
+        await self.queue.ack(succeeded)
+        failed = [sms for result in results if not result.success for sms in result.batch.items]
+        attempted = await self.queue.fail([raw[id(sms)] for sms in failed]) if failed else {}
+        attempts = {
+            sms.get("id"): attempted[raw[id(sms)]] for sms in failed if raw[id(sms)] in attempted
+        }
+        await record_results(results, attempts)
+        if failed:
+            retrying = sum(1 for n in attempted.values() if n < self.config.max_attempts)
+            LOG.warning(f"短信发送失败 {len(failed)} 条，其中 {retrying} 条将重试")
+            raise SmsSendError(
+                "短信发送失败: "
+                f"{[(result.error, result.response) for result in results if not result.success]}"
+            )
+        return len(sms_batch)
+
+
+async def consume():
+    # 定期写入指标，退出时取消并等待其写入剩余指标
+    flusher = asyncio.create_task(run_flusher()) if settings.metrics.enabled else None
+    try:
+        if settings.metrics.enabled and settings.metrics.worker_port:
+            await start_exporter(settings.metrics.worker_port)
+
+        consumer = MasConsumer()
+        await consumer.async_init()
+        while True:
+            # 异常已由 BaseScript 告警，此时返回 None，稍等后重试，避免 Redis 故障时空转
+            if await consumer() is None:
+                await asyncio.sleep(1)
+    finally:
+        if flusher:
+            flusher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await flusher
 
 
 def main():
+    if settings.queue.consumer_mode == "blocking":
+        asyncio.run(consume())
+        return
+
     script = MasTask()
     script()
+    if settings.metrics.enabled:
+        schedule.every(settings.metrics.flush_interval).seconds.do(flush_sync)
 
     while True:
         schedule.run_pending()
         time.sleep(1)
 
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     main()